@@ -1,10 +1,12 @@
 # See LICENSE for licensing information
 __all__ = [
+   'benchmark',
    'config',
    'connection',
    'counter',
    'crypto',
    'data_collector',
+   'generate',
    'inject',
    'log',
    'plot',
@@ -0,0 +1,829 @@
+#!/usr/bin/env python
+'''
+Reproducible benchmarks for PrivCount's performance-sensitive code.
+
+Each benchmark times one code path on synthetic inputs, and the results are
+written out as JSON, so they can be compared between PrivCount versions:
+python privcount/benchmark.py -o before.json
+...
+python privcount/benchmark.py -o after.json
+
+See LICENSE for licensing information
+'''
+import sys
+import os
+import argparse
+import json
+import logging
+import yaml
+
+from random import Random
+from tempfile import mkdtemp
+from shutil import rmtree
+from time import time
+from twisted.internet import reactor
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from privcount.config import normalise_path
+from privcount.counter import SecureCounters, counter_modulus
+from privcount.crypto import generate_keypair, load_private_key_file, encrypt, decrypt
+from privcount.data_collector import Aggregator
+from privcount.protocol import TorControlClientProtocol, get_privcount_version
+from privcount.statistics_noise import get_noise_allocation
+from privcount.traffic_model import TrafficModel
+
+# the test directory in the privcount source tree
+PRIVCOUNT_TEST_DIRECTORY = os.path.join(os.path.dirname(__file__),
+                                        os.path.pardir, 'test')
+
+DEFAULT_COUNTERS_PATH = os.path.join(PRIVCOUNT_TEST_DIRECTORY,
+                                     'counters.bins.yaml')
+DEFAULT_TRAFFIC_MODEL_PATH = os.path.join(PRIVCOUNT_TEST_DIRECTORY,
+                                          'traffic.model.json')
+DEFAULT_EVENTS_PATH = os.path.join(PRIVCOUNT_TEST_DIRECTORY, 'events.txt')
+
+# synthetic event values, loosely based on test/events.txt
+EVENT_PORTS = [80, 443, 22, 6667, 6881, 1214, 4662, 12345, 53, 6699, 7000,
+               8080]
+EVENT_IPS = (['10.0.0.{}'.format(i) for i in xrange(200)] +
+             ['2001:db8::{:x}'.format(i) for i in xrange(50)])
+EVENT_START_TIME = 1480000000.0
+
+def make_histogram(n_bins, sigma=0.0):
+    '''
+    Return a counter with n_bins bins of width 1.0, with an inf upper bound
+    on the last bin, and sigma
+    '''
+    bins = [[float(i), float(i + 1)] for i in xrange(n_bins - 1)]
+    bins.append([float(n_bins - 1), float('inf')])
+    return { 'bins': bins, 'sigma': sigma }
+
+def make_histogram_counters(n_counters, n_bins, sigma=0.0):
+    '''
+    Return a counters structure containing n_counters histograms, each with
+    n_bins bins
+    '''
+    return dict(('BenchHistogram{}'.format(i), make_histogram(n_bins, sigma))
+                for i in xrange(n_counters))
+
+def load_counters(counters_path, traffic_model):
+    '''
+    Load the bins from counters_path, and add the bins for traffic_model, if
+    it is not None. Sets every sigma to zero.
+    Returns a counters structure.
+    '''
+    with open(counters_path, 'r') as fin:
+        counters = yaml.load(fin)['counters']
+    if traffic_model is not None:
+        counters.update(traffic_model.get_bins_init_config())
+    for key in counters:
+        counters[key]['sigma'] = 0.0
+    return counters
+
+def load_traffic_model_config(traffic_model_path):
+    '''
+    Load the traffic model config from traffic_model_path.
+    Returns None if the path does not exist.
+    '''
+    if traffic_model_path is None or not os.path.exists(traffic_model_path):
+        logging.warning("No traffic model at '{}', skipping traffic model benchmarks"
+                        .format(traffic_model_path))
+        return None
+    with open(traffic_model_path, 'r') as fin:
+        return json.load(fin)
+
+def format_event_time(ts):
+    '''
+    Format ts like tor does
+    '''
+    return '{:.6f}'.format(ts)
+
+def synthetic_bytes_events(rng, n_events, n_streams):
+    '''
+    Return n_events PRIVCOUNT_STREAM_BYTES_TRANSFERRED events, spread over
+    n_streams streams on circuit 1.
+    The first event on each stream is outbound, because some traffic models
+    can't start with an inbound packet.
+    '''
+    events = []
+    seen_streams = set()
+    stream_times = {}
+    for _ in xrange(n_events):
+        strmid = rng.randint(1, n_streams)
+        outbound = rng.randint(0, 1) if strmid in seen_streams else 1
+        seen_streams.add(strmid)
+        ts = stream_times.get(strmid, EVENT_START_TIME) + rng.expovariate(10.0)
+        stream_times[strmid] = ts
+        events.append(['PRIVCOUNT_STREAM_BYTES_TRANSFERRED', '1', '1',
+                       str(strmid), str(outbound),
+                       str(rng.choice([498, 1500, 4000, 20000])),
+                       format_event_time(ts)])
+    return events
+
+def synthetic_stream_events(rng, n_events, n_streams=None):
+    '''
+    Return n_events PRIVCOUNT_STREAM_ENDED events.
+    If n_streams is None, use a different stream for each event. Otherwise,
+    use streams 1 to n_streams on circuit 1, in order.
+    '''
+    events = []
+    for i in xrange(n_events):
+        if n_streams is None:
+            (chanid, circid, strmid) = (rng.randint(1, 30),
+                                        rng.randint(1, 40), i + 1)
+        else:
+            (chanid, circid, strmid) = (1, 1, (i % n_streams) + 1)
+        start = EVENT_START_TIME + rng.random() * 1000.0
+        events.append(['PRIVCOUNT_STREAM_ENDED', str(chanid), str(circid),
+                       str(strmid), str(rng.choice(EVENT_PORTS)),
+                       str(rng.choice([5, 100, 5000, 10**6])),
+                       str(rng.choice([0, 7, 300, 70000])),
+                       format_event_time(start),
+                       format_event_time(start + rng.expovariate(0.1)),
+                       'example.com', '192.0.2.1'])
+    return events
+
+def synthetic_circuit_events(rng, n_events):
+    '''
+    Return n_events PRIVCOUNT_CIRCUIT_ENDED events, a mixture of entry,
+    exit, and middle circuits
+    '''
+    events = []
+    for _ in xrange(n_events):
+        start = EVENT_START_TIME + rng.random() * 1000.0
+        events.append(['PRIVCOUNT_CIRCUIT_ENDED', str(rng.randint(1, 30)),
+                       str(rng.randint(1, 40)),
+                       str(rng.choice([0, 3, 10, 5000])),
+                       str(rng.choice([0, 4, 20, 90000])),
+                       str(rng.randint(0, 10000)), str(rng.randint(0, 10000)),
+                       format_event_time(start),
+                       format_event_time(start + rng.expovariate(0.01)),
+                       rng.choice(EVENT_IPS), str(rng.randint(0, 1)),
+                       '192.0.2.2', str(rng.randint(0, 1))])
+    return events
+
+def synthetic_connection_events(rng, n_events):
+    '''
+    Return n_events PRIVCOUNT_CONNECTION_ENDED events
+    '''
+    events = []
+    for _ in xrange(n_events):
+        start = EVENT_START_TIME + rng.random() * 1000.0
+        events.append(['PRIVCOUNT_CONNECTION_ENDED', str(rng.randint(1, 30)),
+                       format_event_time(start),
+                       format_event_time(start + rng.expovariate(0.01)),
+                       rng.choice(EVENT_IPS), str(rng.randint(0, 1))])
+    return events
+
+def synthetic_client_circuit_events(rng, n_events):
+    '''
+    Return n_events PRIVCOUNT_CIRCUIT_ENDED events on entry circuits, each
+    from a different client IP address. One in five addresses is IPv6.
+    '''
+    events = []
+    for i in xrange(n_events):
+        if i % 5 == 0:
+            ip = '2001:db8::{:x}:{:x}'.format(i >> 16, i & 0xffff)
+        else:
+            ip = '10.{}.{}.{}'.format((i >> 16) & 0xff, (i >> 8) & 0xff,
+                                      i & 0xff)
+        start = EVENT_START_TIME + rng.random() * 1000.0
+        events.append(['PRIVCOUNT_CIRCUIT_ENDED', str(rng.randint(1, 30)),
+                       str(rng.randint(1, 40)),
+                       str(rng.choice([0, 3, 10, 5000])),
+                       str(rng.choice([0, 4, 20, 90000])),
+                       '0', '0',
+                       format_event_time(start),
+                       format_event_time(start + rng.expovariate(0.01)),
+                       ip, '1', '192.0.2.2', '0'])
+    return events
+
+def synthetic_mixed_events(rng, n_events):
+    '''
+    Return n_events stream, circuit, and connection events, in random order
+    '''
+    n_each = n_events // 3 + 1
+    events = (synthetic_stream_events(rng, n_each) +
+              synthetic_circuit_events(rng, n_each) +
+              synthetic_connection_events(rng, n_each))
+    rng.shuffle(events)
+    return events[:n_events]
+
+def load_events(events_path, event_code, n_events):
+    '''
+    Load the event_code events from events_path, and repeat them until there
+    are n_events events.
+    Returns a list of events, or None if there are no event_code events.
+    '''
+    with open(events_path, 'r') as fin:
+        file_events = [line.strip().split(' ') for line in fin
+                       if line.startswith(event_code + ' ')]
+    if len(file_events) == 0:
+        return None
+    return [file_events[i % len(file_events)] for i in xrange(n_events)]
+
+def synthetic_viterbi_observations(rng, n_observations):
+    '''
+    Return a list of n_observations (direction, delay) packet observations,
+    starting with an outbound packet
+    '''
+    obs = [('+', long(rng.expovariate(1.0/10000.0)))]
+    for _ in xrange(n_observations - 1):
+        obs.append((rng.choice(['+', '-']),
+                    long(rng.expovariate(1.0/10000.0))))
+    return obs
+
+def time_calls(func, args_list):
+    '''
+    Call func(*args) for each args in args_list
+    Returns the elapsed time in seconds
+    '''
+    start_time = time()
+    for args in args_list:
+        func(*args)
+    return time() - start_time
+
+# the maximum time the reactor waits in each iteration, when we are waiting
+# for a deferred without running the reactor
+WAIT_ITERATE_SECONDS = 0.01
+
+def wait_for_deferred(deferred):
+    '''
+    Iterate the reactor until deferred fires, and return its result.
+    If deferred fails, raise its exception.
+    Benchmarks and tests don't run the reactor, so they use this to wait for
+    aggregator shards and threads.
+    '''
+    results = []
+    deferred.addBoth(results.append)
+    while len(results) == 0:
+        reactor.iterate(WAIT_ITERATE_SECONDS)
+    if isinstance(results[0], Failure):
+        results[0].raiseException()
+    return results[0]
+
+def wait_for_stop(aggregator):
+    '''
+    Stop aggregator, and return its counts when any shards and threads have
+    finished.
+    '''
+    return wait_for_deferred(aggregator.stop())
+
+def make_aggregator(counters, traffic_model_config, **kwargs):
+    '''
+    Return an Aggregator for counters, that is not connected to tor, and has
+    no share keepers. kwargs are passed to Aggregator.
+    '''
+    return Aggregator(counters, traffic_model_config, [], {'*': 1.0},
+                      counter_modulus(), None, 600, **kwargs)
+
+def bench_counter_increment(args, rng):
+    values = [(rng.uniform(0.0, args.bins),)
+              for _ in xrange(args.increments)]
+    secure_counters = SecureCounters({'BenchHistogram':
+                                      make_histogram(args.bins)},
+                                     counter_modulus())
+    handle = secure_counters.get_counter_handle('BenchHistogram')
+    return (args.increments, 'increments',
+            time_calls(handle.increment, values))
+
+def bench_counter_increment_name(args, rng):
+    values = [('BenchHistogram', rng.uniform(0.0, args.bins))
+              for _ in xrange(args.increments)]
+    secure_counters = SecureCounters({'BenchHistogram':
+                                      make_histogram(args.bins)},
+                                     counter_modulus())
+    return (args.increments, 'increments',
+            time_calls(secure_counters.increment, values))
+
+def bench_counter_increment_many(args, rng):
+    values = [rng.uniform(0.0, args.bins) for _ in xrange(args.increments)]
+    secure_counters = SecureCounters({'BenchHistogram':
+                                      make_histogram(args.bins)},
+                                     counter_modulus())
+    return (args.increments, 'increments',
+            time_calls(secure_counters.increment_many,
+                       [('BenchHistogram', values)]))
+
+def bench_counter_blind(args, rng):
+    secure_counters = SecureCounters(make_histogram_counters(args.histograms,
+                                                             args.bins),
+                                     counter_modulus())
+    uids = ['sk{}'.format(i) for i in xrange(args.share_keepers)]
+    return (args.histograms * args.bins * args.share_keepers,
+            'blinding values',
+            time_calls(secure_counters.generate_blinding_shares, [(uids,)]))
+
+def bench_counter_noise(args, rng):
+    secure_counters = SecureCounters(make_histogram_counters(args.histograms,
+                                                             args.bins,
+                                                             sigma=1000.0),
+                                     counter_modulus())
+    return (args.histograms * args.bins, 'noise values',
+            time_calls(secure_counters.generate_noise, [(1.0,)]))
+
+def bench_counter_tally(args, rng):
+    counters = make_histogram_counters(args.histograms, args.bins)
+    client_counts = []
+    for _ in xrange(args.data_collectors):
+        secure_counters = SecureCounters(counters, counter_modulus())
+        for key in counters:
+            secure_counters.increment_many(key,
+                                           [rng.uniform(0.0, args.bins)
+                                            for _ in xrange(args.bins)])
+        client_counts.append(secure_counters.detach_counts())
+    tallied_counter = SecureCounters(counters, counter_modulus())
+    return (args.data_collectors * args.histograms * args.bins, 'counts',
+            time_calls(tallied_counter.tally_counters, [(client_counts,)]))
+
+def bench_aggregator_events(args, events, traffic_model_config=None,
+                            setup_events=[], counter_prefix=None):
+    '''
+    Handle setup_events, then time handling events.
+    If counter_prefix is not None, only use the counters that start with
+    counter_prefix.
+    '''
+    traffic_model = None
+    if traffic_model_config is not None:
+        traffic_model = TrafficModel(traffic_model_config)
+    counters = load_counters(args.counters_path, traffic_model)
+    if counter_prefix is not None:
+        counters = dict([(name, counters[name]) for name in counters
+                         if name.startswith(counter_prefix)])
+    aggregator = make_aggregator(counters, traffic_model_config)
+    for event in setup_events:
+        aggregator.handle_event(event)
+    return (len(events), 'events',
+            time_calls(aggregator.handle_event,
+                       [(event,) for event in events]))
+
+def bench_aggregator_bytes(args, rng):
+    if args.traffic_model_config is None:
+        return None
+    events = synthetic_bytes_events(rng, args.events, args.streams)
+    return bench_aggregator_events(args, events,
+                                   traffic_model_config=args.traffic_model_config)
+
+def bench_aggregator_stream(args, rng):
+    return bench_aggregator_events(args,
+                                   synthetic_stream_events(rng, args.events))
+
+def bench_aggregator_stream_traffic_model(args, rng):
+    if args.traffic_model_config is None:
+        return None
+    # each stream has observations byte events
+    setup_events = synthetic_bytes_events(rng,
+                                          args.streams * args.observations,
+                                          args.streams)
+    events = synthetic_stream_events(rng, args.streams,
+                                     n_streams=args.streams)
+    return bench_aggregator_events(args, events,
+                                   traffic_model_config=args.traffic_model_config,
+                                   setup_events=setup_events)
+
+def bench_aggregator_stream_traffic_model_threads(args, rng):
+    '''
+    Time handling stream events, while 2 viterbi threads decode the streams.
+    Also reports the total time, including waiting for the threads to
+    finish.
+    '''
+    if args.traffic_model_config is None:
+        return None
+    setup_events = synthetic_bytes_events(rng,
+                                          args.streams * args.observations,
+                                          args.streams)
+    events = synthetic_stream_events(rng, args.streams,
+                                     n_streams=args.streams)
+    traffic_model = TrafficModel(args.traffic_model_config)
+    aggregator = make_aggregator(load_counters(args.counters_path,
+                                               traffic_model),
+                                 args.traffic_model_config,
+                                 viterbi_threads=2,
+                                 viterbi_queue_limit=args.streams)
+    for event in setup_events:
+        aggregator.handle_event(event)
+    # we don't have a fingerprint, so we don't have a noise weight
+    aggregator.noise_weight_value = 0.0
+    seconds = time_calls(aggregator.handle_event,
+                         [(event,) for event in events])
+    total_seconds = seconds + time_calls(wait_for_stop, [(aggregator,)])
+    return (len(events), 'events', seconds,
+            { 'total_seconds': total_seconds })
+
+def bench_aggregator_stream_file(args, rng):
+    events = load_events(args.events_path, 'PRIVCOUNT_STREAM_ENDED',
+                         args.events)
+    if events is None:
+        return None
+    return bench_aggregator_events(args, events)
+
+def bench_aggregator_circuit(args, rng):
+    return bench_aggregator_events(args,
+                                   synthetic_circuit_events(rng, args.events))
+
+def bench_aggregator_connection(args, rng):
+    return bench_aggregator_events(args,
+                                   synthetic_connection_events(rng,
+                                                               args.events))
+
+class NullEventFactory(object):
+    '''
+    A tor control protocol factory that ignores events
+    '''
+
+    def handle_event(self, event):
+        return True
+
+    def handle_events(self, events):
+        return True
+
+def bench_protocol_events(events, factory):
+    '''
+    Time a tor control protocol with a fake transport, which is receiving
+    events in the processing state, and passing them to factory.
+    '''
+    protocol = TorControlClientProtocol(factory)
+    protocol.makeConnection(StringTransport())
+    protocol.active_events = set([event[0] for event in events])
+    protocol.state = 'processing'
+    data = ''.join(['650 ' + ' '.join(event) + protocol.delimiter
+                    for event in events])
+    # deliver the data in chunks, like a socket would
+    chunk_size = 64*1024
+    chunks = [(data[i:i+chunk_size],)
+              for i in xrange(0, len(data), chunk_size)]
+    return (len(events), 'lines',
+            time_calls(protocol.dataReceived, chunks))
+
+def bench_protocol_lines(args, rng):
+    return bench_protocol_events(synthetic_mixed_events(rng, args.events),
+                                 NullEventFactory())
+
+def bench_protocol_aggregator(args, rng):
+    return bench_protocol_events(synthetic_mixed_events(rng, args.events),
+                                 make_aggregator(
+                                        load_counters(args.counters_path,
+                                                      None),
+                                        None))
+
+def bench_aggregator_mixed(args, rng):
+    return bench_aggregator_events(args,
+                                   synthetic_mixed_events(rng, args.events))
+
+def bench_aggregator_mixed_entry(args, rng):
+    return bench_aggregator_events(args,
+                                   synthetic_mixed_events(rng, args.events),
+                                   counter_prefix='Entry')
+
+def bench_aggregator_sharded(args, rng):
+    '''
+    Time handling events using args.shards aggregator shards, including
+    the time taken to wait for the shards to finish, and merge their counts.
+    '''
+    events = (synthetic_mixed_events(rng, args.events) +
+              synthetic_client_circuit_events(rng, args.events))
+    rng.shuffle(events)
+    aggregator = Aggregator(load_counters(args.counters_path, None), None,
+                            [], {'*': 1.0}, counter_modulus(), None, 600,
+                            shard_count=args.shards)
+    # we don't have a fingerprint, so we don't have a noise weight
+    aggregator.noise_weight_value = 0.0
+    return (len(events), 'events',
+            time_calls(aggregator.handle_event,
+                       [(event,) for event in events]) +
+            time_calls(wait_for_stop, [(aggregator,)]))
+
+def bench_aggregator_event_log(args, rng):
+    '''
+    Time reading events from an event log file, and handling them.
+    '''
+    events = synthetic_mixed_events(rng, args.events)
+    log_dir = mkdtemp()
+    try:
+        log_path = os.path.join(log_dir, 'events.txt')
+        with open(log_path, 'w') as fout:
+            for event in events:
+                fout.write('650 ' + ' '.join(event) + '\n')
+        aggregator = Aggregator(load_counters(args.counters_path, None),
+                                None, [], {'*': 1.0}, counter_modulus(),
+                                {'event_log': log_path}, 600)
+        seconds = time_calls(lambda: list(aggregator.read_event_log(
+                                             [log_path])),
+                             [()])
+    finally:
+        rmtree(log_dir)
+    return (len(events), 'events', seconds)
+
+def bench_aggregator_client_ips(args, rng):
+    aggregator = make_aggregator(load_counters(args.counters_path, None),
+                                 None)
+    events = synthetic_client_circuit_events(rng, args.events)
+    seconds = time_calls(aggregator.handle_event,
+                         [(event,) for event in events])
+    # the client IP count is exact, so it is only measured in benchmarks
+    # a client can be in both windows, so we count distinct clients, and
+    # the entries in each window
+    client_ips = len(set(aggregator.cli_ips_current) |
+                     set(aggregator.cli_ips_previous))
+    client_ip_entries = (len(aggregator.cli_ips_current) +
+                         len(aggregator.cli_ips_previous))
+    client_ips_bytes = (
+        Aggregator._get_client_ips_size(aggregator.cli_ips_current) +
+        Aggregator._get_client_ips_size(aggregator.cli_ips_previous))
+    return (len(events), 'events', seconds,
+            { 'client_ips': client_ips,
+              'client_ips_current': len(aggregator.cli_ips_current),
+              'client_ips_previous': len(aggregator.cli_ips_previous),
+              'bytes_per_client_ip_entry':
+                  float(client_ips_bytes) / client_ip_entries })
+
+def bench_aggregator_rotate(args, rng):
+    aggregator = make_aggregator(load_counters(args.counters_path, None),
+                                 None)
+    for event in synthetic_client_circuit_events(rng, args.events):
+        aggregator.handle_event(event)
+    # the first rotation counts the clients we saw in the previous window,
+    # the second counts their circuits in the current window
+    client_ip_count = (len(aggregator.cli_ips_previous) +
+                       len(aggregator.cli_ips_current))
+    return (client_ip_count, 'client IPs',
+            time_calls(aggregator._do_rotate, [(), ()]))
+
+def bench_traffic_model_viterbi(args, rng):
+    if args.traffic_model_config is None:
+        return None
+    traffic_model = TrafficModel(args.traffic_model_config)
+    obs_list = [(synthetic_viterbi_observations(rng, args.observations),)
+                for _ in xrange(args.streams)]
+    return (args.streams * args.observations, 'observations',
+            time_calls(traffic_model.run_viterbi, obs_list))
+
+def make_crypto_data(args, rng):
+    '''
+    Return a structure that is about the size of the blinding shares for
+    one share keeper
+    '''
+    return dict(('BenchHistogram{}'.format(i),
+                 [rng.randrange(counter_modulus()) for _ in xrange(args.bins)])
+                for i in xrange(args.histograms))
+
+def get_crypto_key(args):
+    '''
+    Load the private key, generating a temporary key if needed
+    '''
+    if hasattr(args, 'crypto_private_key'):
+        return args.crypto_private_key
+    if args.crypto_key is None:
+        key_dir = mkdtemp()
+        try:
+            key_path = os.path.join(key_dir, 'benchmark.pem')
+            logging.info("Generating RSA key '{}'".format(key_path))
+            generate_keypair(key_path)
+            args.crypto_private_key = load_private_key_file(key_path)
+        finally:
+            rmtree(key_dir)
+    else:
+        args.crypto_private_key = load_private_key_file(
+                                      normalise_path(args.crypto_key))
+    return args.crypto_private_key
+
+def bench_crypto_encrypt(args, rng):
+    private_key = get_crypto_key(args)
+    data = make_crypto_data(args, rng)
+    return (args.crypto_iterations, 'encryptions',
+            time_calls(encrypt, [(private_key.public_key(), data)] *
+                       args.crypto_iterations))
+
+def bench_crypto_decrypt(args, rng):
+    private_key = get_crypto_key(args)
+    ciphertext = encrypt(private_key.public_key(),
+                         make_crypto_data(args, rng))
+    return (args.crypto_iterations, 'decryptions',
+            time_calls(decrypt, [(private_key, ciphertext)] *
+                       args.crypto_iterations))
+
+def bench_noise_allocation(args, rng):
+    noise_parameters = {
+        'privacy': {
+            'epsilon': 0.3,
+            'delta': 1e-3,
+            'excess_noise_ratio': 3.0,
+            },
+        'counters': dict(('BenchCounter{}'.format(i),
+                          { 'sensitivity': float(rng.randint(1, 100)),
+                            'estimated_value': float(rng.randint(1, 10**6)) })
+                         for i in xrange(args.histograms)),
+        }
+    return (args.histograms, 'counters',
+            time_calls(get_noise_allocation, [(noise_parameters,)]))
+
+# benchmark name: function(args, rng)
+# Each function returns (operation count, operation unit, elapsed seconds),
+# optionally followed by a dict of extra results, or None if the benchmark
+# was skipped
+BENCHMARKS = [
+    ('counter_increment', bench_counter_increment),
+    ('counter_increment_name', bench_counter_increment_name),
+    ('counter_increment_many', bench_counter_increment_many),
+    ('counter_blind', bench_counter_blind),
+    ('counter_noise', bench_counter_noise),
+    ('counter_tally', bench_counter_tally),
+    ('aggregator_bytes', bench_aggregator_bytes),
+    ('aggregator_stream', bench_aggregator_stream),
+    ('aggregator_stream_file', bench_aggregator_stream_file),
+    ('aggregator_stream_traffic_model', bench_aggregator_stream_traffic_model),
+    ('aggregator_stream_traffic_model_threads', bench_aggregator_stream_traffic_model_threads),
+    ('aggregator_circuit', bench_aggregator_circuit),
+    ('aggregator_connection', bench_aggregator_connection),
+    ('aggregator_mixed', bench_aggregator_mixed),
+    ('aggregator_mixed_entry', bench_aggregator_mixed_entry),
+    ('aggregator_sharded', bench_aggregator_sharded),
+    ('aggregator_event_log', bench_aggregator_event_log),
+    ('aggregator_client_ips', bench_aggregator_client_ips),
+    ('aggregator_rotate', bench_aggregator_rotate),
+    ('protocol_lines', bench_protocol_lines),
+    ('protocol_aggregator', bench_protocol_aggregator),
+    ('traffic_model_viterbi', bench_traffic_model_viterbi),
+    ('crypto_encrypt', bench_crypto_encrypt),
+    ('crypto_decrypt', bench_crypto_decrypt),
+    ('noise_allocation', bench_noise_allocation),
+    ]
+
+def get_benchmark_names():
+    '''
+    Returns a list of the benchmark names, in the order they are run
+    '''
+    return [name for (name, _) in BENCHMARKS]
+
+# the benchmarks that load counters from counters_path
+COUNTERS_PATH_BENCHMARKS = ([name for name in get_benchmark_names()
+                             if name.startswith('aggregator_')] +
+                            ['protocol_aggregator'])
+# the benchmarks that load events from events_path
+EVENTS_PATH_BENCHMARKS = ['aggregator_stream_file']
+
+def check_input_path(path, option, selected, path_benchmarks):
+    '''
+    If any benchmark in selected is in path_benchmarks, check that path
+    exists. If it doesn't, raise a ValueError explaining how to use option
+    to choose another file.
+    '''
+    needed = [name for name in selected if name in path_benchmarks]
+    if len(needed) == 0 or os.path.exists(path):
+        return
+    raise ValueError("Benchmarks {} need the file '{}', which does not exist. The default {} is in the test directory of the privcount source tree. Use {} to choose another file, or --benchmarks to skip these benchmarks."
+                     .format(', '.join(needed), path, option, option))
+
+def get_benchmark_parameters(args):
+    '''
+    Returns a dictionary containing the value of every benchmark argument in
+    args, so that results are only compared when they use the same inputs.
+    '''
+    parser = argparse.ArgumentParser()
+    add_benchmark_args(parser)
+    parameter_names = vars(parser.parse_args([])).keys()
+    return dict((name, getattr(args, name)) for name in parameter_names)
+
+def run_benchmarks(args):
+    '''
+    Run the benchmarks named in args.benchmarks, or all benchmarks if it is
+    None.
+    Returns a results structure.
+    '''
+    selected = args.benchmarks
+    if selected is None:
+        selected = get_benchmark_names()
+    for name in selected:
+        if name not in get_benchmark_names():
+            raise ValueError("Unknown benchmark '{}', valid benchmarks are: {}"
+                             .format(name, ', '.join(get_benchmark_names())))
+
+    args.counters_path = normalise_path(args.counters_path)
+    args.events_path = normalise_path(args.events_path)
+    check_input_path(args.counters_path, '--counters-path', selected,
+                     COUNTERS_PATH_BENCHMARKS)
+    check_input_path(args.events_path, '--events-path', selected,
+                     EVENTS_PATH_BENCHMARKS)
+    args.traffic_model_config = load_traffic_model_config(
+                                    args.traffic_model_path)
+
+    results = {}
+    for (name, func) in BENCHMARKS:
+        if name not in selected:
+            continue
+        logging.info("Running benchmark {}".format(name))
+        # use the same random values for each benchmark, regardless of which
+        # other benchmarks are selected
+        result = func(args, Random('{} {}'.format(args.seed, name)))
+        if result is None:
+            logging.warning("Skipped benchmark {}".format(name))
+            continue
+        (count, unit, seconds) = result[:3]
+        rate = count / seconds if seconds > 0.0 else None
+        logging.info("{}: {} {} in {:.3f} seconds ({:.0f} {}/sec)"
+                     .format(name, count, unit, seconds, rate or 0.0, unit))
+        results[name] = {
+            'count': count,
+            'unit': unit,
+            'seconds': seconds,
+            'rate': rate,
+            }
+        if len(result) > 3:
+            logging.info("{}: {}".format(name, result[3]))
+            results[name].update(result[3])
+
+    return {
+        'version': get_privcount_version(),
+        'parameters': get_benchmark_parameters(args),
+        'benchmarks': results,
+        }
+
+def run_benchmark(args):
+    '''
+    Run the benchmarks, and write the results as JSON
+    '''
+    results = run_benchmarks(args)
+    if args.output == '-':
+        json.dump(results, sys.stdout, sort_keys=True, indent=4)
+        print ""
+    else:
+        with open(normalise_path(args.output), 'w') as fout:
+            json.dump(results, fout, sort_keys=True, indent=4)
+        logging.info("Wrote benchmark results to '{}'".format(args.output))
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    ap = argparse.ArgumentParser(description="Benchmark PrivCount",
+                                 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_benchmark_args(ap)
+    args = ap.parse_args()
+    run_benchmark(args)
+
+def add_benchmark_args(parser):
+    parser.add_argument('-b', '--benchmarks',
+                        help="a comma-separated list of benchmarks to run (default: all benchmarks: {})".format(','.join(get_benchmark_names())),
+                        type=lambda s: s.split(','),
+                        default=None)
+    parser.add_argument('-o', '--output',
+                        help="a file PATH for the JSON results, may be '-' for STDOUT",
+                        default='-')
+    parser.add_argument('--seed',
+                        help="the seed for the synthetic inputs",
+                        type=int,
+                        default=1)
+    parser.add_argument('--bins',
+                        help="the number of bins in each synthetic histogram",
+                        type=int,
+                        default=100)
+    parser.add_argument('--histograms',
+                        help="the number of synthetic histograms for blinding, noise, tallying, encryption, and noise allocation",
+                        type=int,
+                        default=50)
+    parser.add_argument('--increments',
+                        help="the number of counter increments",
+                        type=int,
+                        default=200000)
+    parser.add_argument('--share-keepers',
+                        help="the number of share keepers for blinding",
+                        type=int,
+                        default=5)
+    parser.add_argument('--data-collectors',
+                        help="the number of data collector results for tallying",
+                        type=int,
+                        default=10)
+    parser.add_argument('--events',
+                        help="the number of events for each event type",
+                        type=int,
+                        default=20000)
+    parser.add_argument('--streams',
+                        help="the number of streams processed by the traffic model",
+                        type=int,
+                        default=20)
+    parser.add_argument('--shards',
+                        help="the number of aggregator shard processes",
+                        type=int,
+                        default=4)
+    parser.add_argument('--observations',
+                        help="the number of byte events or packet observations for each stream processed by the traffic model",
+                        type=int,
+                        default=20)
+    parser.add_argument('--crypto-iterations',
+                        help="the number of encryptions and decryptions",
+                        type=int,
+                        default=10)
+    parser.add_argument('--crypto-key',
+                        help="a file PATH to an RSA private key for encryption (default: generate a new key)",
+                        default=None)
+    parser.add_argument('--counters-path',
+                        help="a file PATH to a counters bins config for the aggregator",
+                        default=normalise_path(DEFAULT_COUNTERS_PATH))
+    parser.add_argument('--events-path',
+                        help="a file PATH to a PrivCount event log, its stream events are repeated for the aggregator file benchmarks",
+                        default=normalise_path(DEFAULT_EVENTS_PATH))
+    parser.add_argument('--traffic-model-path',
+                        help="a file PATH to a traffic model config for the aggregator and viterbi benchmarks",
+                        default=normalise_path(DEFAULT_TRAFFIC_MODEL_PATH))
+
+if __name__ == "__main__":
+    sys.exit(main())
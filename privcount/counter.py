@@ -9,9 +9,18 @@ See LICENSE for licensing information
 import logging
 import sys
 
+from os import urandom
+from binascii import hexlify
 from random import SystemRandom
 from copy import deepcopy
-from math import sqrt, isnan
+from bisect import bisect_right
+from math import sqrt, isnan, log, cos, sin, pi
+
+# numpy is optional: SecureCounters.increment_many() is faster with numpy
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from privcount.statistics_noise import DEFAULT_SIGMA_TOLERANCE, DEFAULT_DUMMY_COUNTER_NAME
 from privcount.log import format_period, format_elapsed_time_since, format_delay_time_until
@@ -47,6 +56,21 @@ def counter_modulus():
     # modulus was limited to 2**64 when sample() only unpacked 8 bytes
     #return 2L**64L
 
+def get_modulus_mask(modulus):
+    '''
+    If modulus is an integral power of two, return a bitmask that reduces
+    values modulo modulus. Otherwise, return None.
+    For any integer x (including negative integers), and power of two
+    modulus, x & get_modulus_mask(modulus) == x % modulus, because python
+    integers behave like infinite-width two's complement integers.
+    '''
+    modulus = long(modulus)
+    assert modulus > 0
+    if modulus & (modulus - 1L) == 0L:
+        return modulus - 1L
+    else:
+        return None
+
 def min_blinded_counter_value():
     '''
     The hard-coded minimum value for a blinded counter
@@ -942,17 +966,23 @@ def noise(sigma, sum_of_sq, p_exit):
     returns a floating-point value between +sigma and -sigma, scaled by
     noise_weight
     '''
-    sigma_i = p_exit * sigma / sqrt(sum_of_sq)
+    sigma_i = noise_sigma(sigma, sum_of_sq, p_exit)
     # the noise needs to be cryptographically secure, because knowing the RNG
     # state could allow an adversary to remove the noise
     random_sample = SystemRandom().gauss(0, sigma_i)
     return random_sample
 
-def sample(modulus):
+def noise_sigma(sigma, sum_of_sq, p_exit):
     '''
-    Sample a uniformly distributed value from the SystemRandom CSPRNG
-    (uses rejection sampling to avoid bias)
-    returns a long uniformly distributed in [0, modulus)
+    Returns the standard deviation used by noise(), which is sigma, scaled by
+    the noise weight p_exit, and the overall sum_of_sq bandwidth
+    '''
+    return p_exit * sigma / sqrt(sum_of_sq)
+
+def get_sample_bit_count(modulus):
+    '''
+    Returns the number of random bits needed to sample values in
+    [0, modulus), using rejection sampling
     '''
     # sanitise input
     modulus = long(modulus)
@@ -965,6 +995,17 @@ def sample(modulus):
     # check the bit count is sane
     assert modulus <= 2L**sample_bit_count
     assert modulus >= 2L**(sample_bit_count-1)
+    return sample_bit_count
+
+def sample(modulus):
+    '''
+    Sample a uniformly distributed value from the SystemRandom CSPRNG
+    (uses rejection sampling to avoid bias)
+    returns a long uniformly distributed in [0, modulus)
+    '''
+    # sanitise input
+    modulus = long(modulus)
+    sample_bit_count = get_sample_bit_count(modulus)
     ## Unbiased sampling through rejection sampling
     while True:
         # sample that many bits
@@ -976,6 +1017,118 @@ def sample(modulus):
             break
     return v
 
+class BufferedSampler(object):
+    '''
+    Sample uniformly distributed values from the os.urandom CSPRNG, reading
+    random bytes in large chunks, rather than making a system call for each
+    value
+    (uses rejection sampling to avoid bias, like sample())
+    Each instance has its own buffer, so instances must not be shared between
+    threads or processes. Create a new instance for each batch of values.
+    '''
+
+    BUFFER_BYTE_COUNT = 64*1024
+    '''
+    The number of bytes read from os.urandom each time the buffer is empty
+    '''
+
+    def __init__(self, buffer_byte_count=BUFFER_BYTE_COUNT):
+        self.buffer_byte_count = buffer_byte_count
+        self.buffer = ''
+        self.offset = 0
+
+    def _get_bytes(self, byte_count):
+        '''
+        Return byte_count unused random bytes from the buffer, refilling it
+        if needed
+        '''
+        if self.offset + byte_count > len(self.buffer):
+            # any leftover bytes are discarded: they are never reused
+            self.buffer = urandom(max(self.buffer_byte_count, byte_count))
+            self.offset = 0
+        random_bytes = self.buffer[self.offset:self.offset + byte_count]
+        self.offset += byte_count
+        return random_bytes
+
+    def sample_list(self, modulus, count):
+        '''
+        returns a list of count longs, each uniformly distributed in
+        [0, modulus)
+        '''
+        # sanitise input
+        modulus = long(modulus)
+        sample_bit_count = get_sample_bit_count(modulus)
+        # read whole bytes, and discard the extra low bits, like getrandbits()
+        sample_byte_count = (sample_bit_count + 7) // 8
+        extra_bit_count = sample_byte_count * 8 - sample_bit_count
+        values = []
+        while len(values) < count:
+            v = (long(hexlify(self._get_bytes(sample_byte_count)), 16)
+                 >> extra_bit_count)
+            # the maximum rejection rate is 1 in 2, when modulus is 2**N + 1
+            if v < modulus:
+                values.append(v)
+        return values
+
+    def sample(self, modulus):
+        '''
+        returns a long uniformly distributed in [0, modulus)
+        '''
+        return self.sample_list(modulus, 1)[0]
+
+    # the number of bits in a uniform float value
+    FLOAT_BIT_COUNT = 53
+
+    def sample_gaussian_list(self, count):
+        '''
+        returns a list of count floats, each sampled from a gaussian
+        distribution with mean 0 and standard deviation 1
+        Uses the Box-Muller transform on uniform 53-bit values. Uses numpy
+        to transform all the values at once, if it is available.
+        '''
+        # Box-Muller produces values in pairs
+        pair_count = (count + 1) // 2
+        # get two 53-bit uniform values for each pair
+        # 7 bytes is 56 bits: discard the extra low bits, like getrandbits()
+        byte_count = 7 * 2 * pair_count
+        extra_bit_count = 7 * 8 - BufferedSampler.FLOAT_BIT_COUNT
+        scale = 2.0**-BufferedSampler.FLOAT_BIT_COUNT
+        random_bytes = self._get_bytes(byte_count)
+        if numpy is not None:
+            # pad each 7-byte value to an 8-byte big-endian integer
+            padded = numpy.zeros((2 * pair_count, 8), dtype=numpy.uint8)
+            padded[:, 1:] = numpy.frombuffer(random_bytes,
+                                             dtype=numpy.uint8).reshape(-1, 7)
+            uniforms = ((padded.view('>u8').ravel() >> extra_bit_count)
+                        .astype(numpy.float64) * scale)
+            # u1 is in (0, 1], so that log(u1) is finite
+            u1 = 1.0 - uniforms[:pair_count]
+            # u2 is in [0, 1)
+            u2 = uniforms[pair_count:]
+            radius = numpy.sqrt(-2.0 * numpy.log(u1))
+            angle = 2.0 * pi * u2
+            values = numpy.concatenate((radius * numpy.cos(angle),
+                                        radius * numpy.sin(angle)))
+            return values[:count].tolist()
+        values = []
+        for i in xrange(pair_count):
+            u1 = 1.0 - scale * (long(hexlify(random_bytes[14*i:14*i + 7]),
+                                     16) >> extra_bit_count)
+            u2 = scale * (long(hexlify(random_bytes[14*i + 7:14*i + 14]), 16)
+                          >> extra_bit_count)
+            radius = sqrt(-2.0 * log(u1))
+            values.append(radius * cos(2.0 * pi * u2))
+            values.append(radius * sin(2.0 * pi * u2))
+        return values[:count]
+
+    def clear(self):
+        '''
+        Forget the unused random bytes in the buffer.
+        Does not securely delete, as python does not have secure delete.
+        '''
+        self.buffer = ''
+        self.offset = 0
+
 def sample_randint(a, b):
     """
     Like random.randint(), returns a random long N such that a <= N <= b.
@@ -1098,7 +1251,7 @@ class SecureCounters(object):
 
     data collector:
     init(), generate_blinding_shares(), detach_blinding_shares(),
-    generate_noise(), increment()[repeated],
+    generate_noise(), get_counter_handles(), increment()[repeated],
     detach_counts()
     the blinding shares are sent to each share keeper
     the counts are sent to the tally server at the end
@@ -1119,40 +1272,111 @@ class SecureCounters(object):
 
     def __init__(self, counters, modulus):
         '''
-        deepcopy counters and initialise each counter to 0L
+        Initialise each counter to 0L, using the bins in counters
         cast modulus to long and store it
         '''
-        self.counters = deepcopy(counters)
         self.modulus = long(modulus)
+        # counter_modulus() is a power of two, so we can use a bitmask rather
+        # than %. Other moduli use %.
+        self.modulus_mask = get_modulus_mask(self.modulus)
         self.shares = None
 
+        # Rather than storing a [bin_min, bin_max, count] list for each bin,
+        # we store the bin boundaries once, as immutable tuples, and a flat
+        # list of counts for each counter. The blinding factors and noise use
+        # the same flat list format. The counters are only converted to the
+        # counters format at detach_counts() and detach_blinding_shares().
+        # bins is, e.g.: ((0.0, 512.0), (512.0, inf)) for bin_left, bin_right
+        self.bins = {}
+        # any other items in each counter (like sigma), in the order they
+        # were configured
+        self.counter_items = {}
+        for key in counters:
+            assert('bins' in counters[key])
+            for item in counters[key]['bins']:
+                assert len(item) == 2
+            self.bins[key] = tuple((item[0], item[1])
+                                   for item in counters[key]['bins'])
+            self.counter_items[key] = deepcopy(dict(
+                                            (k, v) for k, v
+                                            in counters[key].iteritems()
+                                            if k != 'bins'))
+
         # initialize all counters to 0L
         # counters use unlimited length integers to avoid overflow
-        for key in self.counters:
-            assert('bins' in self.counters[key])
-            for item in self.counters[key]['bins']:
-                assert len(item) == 2
-                # bin is now, e.g.: [0.0, 512.0, 0L] for bin_left, bin_right,
-                # count
-                item.append(0L)
+        self.counts = self._zero_counts()
+
+        # build a sorted index of the bins in each counter, so that
+        # increment() can find a bin using a binary search
+        self.bin_index = {}
+        # and, if we have numpy, array versions of the index, for
+        # increment_many()
+        self.bin_arrays = {}
+        for key in self.bins:
+            self.bin_index[key] = SecureCounters._build_bin_index(
+                                                 self.bins[key])
+            if numpy is not None and self.bin_index[key] is not None:
+                (bin_mins, positions) = self.bin_index[key]
+                self.bin_arrays[key] = (
+                    numpy.array(bin_mins, dtype=numpy.float64),
+                    numpy.array([self.bins[key][i][1] for i in positions],
+                                dtype=numpy.float64))
+
+    def _zero_counts(self):
+        '''
+        Return a flat counts structure, with a count of 0L for each bin
+        '''
+        return dict((key, [0L] * len(self.bins[key])) for key in self.bins)
 
-        # take a copy of the zeroed counters to use when generating blinding
-        # factors
-        self.zero_counters = deepcopy(self.counters)
+    def _to_counters(self, counts):
+        '''
+        Convert the flat counts structure counts to a counters structure,
+        with a [bin_min, bin_max, count] list for each bin, and the other
+        counter items. This is the format used by the tally server and the
+        network protocol.
+        '''
+        counters = {}
+        for key in counts:
+            counter = deepcopy(self.counter_items[key])
+            counter['bins'] = [[bin_min, bin_max, count]
+                               for ((bin_min, bin_max), count)
+                               in zip(self.bins[key], counts[key])]
+            counters[key] = counter
+        return counters
+
+    @staticmethod
+    def _build_bin_index(bins):
+        '''
+        Build a bin lookup index for the bins in a single counter.
+        Returns a tuple containing a list of bin minimums, sorted in
+        ascending order, and a list of the positions of those bins in bins.
+        If any bins overlap, a value can be in multiple bins, so a binary
+        search can't be used. In that case, returns None.
+        '''
+        positions = sorted(xrange(len(bins)),
+                           key=lambda i: (bins[i][0], bins[i][1]))
+        for i in xrange(len(positions) - 1):
+            prev_max = bins[positions[i]][1]
+            next_min = bins[positions[i+1]][0]
+            # an inf bin_max includes inf, so it overlaps any later bin
+            if prev_max > next_min or prev_max == SecureCounters.INF:
+                return None
+        bin_mins = [bins[i][0] for i in positions]
+        return (bin_mins, positions)
 
     def _check_counter(self, counter):
         '''
-        Check that the keys and bins in counter match self.counters
+        Check that the keys and bins in counter match self.bins
         Also check that each bin has a count.
         If these checks pass, return True. Otherwise, return False.
         '''
-        for key in self.counters:
+        for key in self.bins:
             if key not in counter:
                 return False
             # disregard sigma, it's only required at the data collectors
             if 'bins' not in counter[key]:
                 return False
-            num_bins = len(self.counters[key]['bins'])
+            num_bins = len(self.bins[key])
             if num_bins == 0:
                 return False
             if num_bins != len(counter[key]['bins']):
@@ -1163,50 +1387,51 @@ class SecureCounters(object):
                     return False
         return True
 
-    def _derive_all_counters(self, blinding_factors, positive):
+    def _derive_all_counters(self, blinding_factors, positive, sampler=None):
         '''
-        If blinding_factors is None, generate and apply a counters structure
-        containing uniformly random blinding factors.
-        Otherwise, apply the passed blinding factors.
+        If blinding_factors is None, generate and apply a flat counts structure
+        containing uniformly random blinding factors, using sampler.
+        Otherwise, apply the passed blinding factors, which must be a counters
+        structure.
         If positive is True, apply blinding factors. Otherwise, apply
         unblinding factors.
-        Returns the applied (un)blinding factors, or None on error.
+        Returns the applied (un)blinding factors as a flat counts structure,
+        or None on error.
         '''
-        # if there are no blinding_factors, initialise them to zero
-        generate_factors = False
-        if blinding_factors is None:
-            blinding_factors = deepcopy(self.zero_counters)
-            generate_factors = True
-
-        # validate that the counter data structures match
-        if not self._check_counter(blinding_factors):
-            return None
+        if blinding_factors is not None:
+            # validate that the counter data structures match
+            if not self._check_counter(blinding_factors):
+                return None
 
         # determine the blinding factors
-        for key in blinding_factors:
-            for item in blinding_factors[key]['bins']:
-                if generate_factors:
-                    original_factor = None
-                else:
-                    original_factor = long(item[2])
-                blinding_factor = derive_blinding_factor(original_factor,
-                                                         self.modulus,
-                                                         positive=positive)
-                item[2] = blinding_factor
+        derived_factors = {}
+        for key in self.bins:
+            if blinding_factors is None:
+                # derive_blinding_factor() would make a system call for each
+                # value, so we sample the secrets in bulk
+                original_factors = sampler.sample_list(self.modulus,
+                                                       len(self.bins[key]))
+            else:
+                original_factors = [long(item[2]) for item
+                                    in blinding_factors[key]['bins']]
+            derived_factors[key] = [derive_blinding_factor(original_factor,
+                                                           self.modulus,
+                                                           positive=positive)
+                                    for original_factor in original_factors]
 
         # add the blinding factors to the counters
-        self._tally_counter(blinding_factors)
+        self._add_counts(derived_factors)
 
         # return the applied blinding factors
-        return blinding_factors
+        return derived_factors
 
-    def _blind(self):
+    def _blind(self, sampler):
         '''
-        Generate and apply a counters structure containing uniformly random
-        blinding factors.
+        Generate and apply a flat counts structure containing uniformly random
+        blinding factors from sampler, a BufferedSampler.
         Returns the generated blinding factors.
         '''
-        generated_counters = self._derive_all_counters(None, True)
+        generated_counters = self._derive_all_counters(None, True, sampler)
         # since we generate blinding factors based on our own inputs, a
         # failure here is a programming bug
         assert generated_counters is not None
@@ -1215,7 +1440,7 @@ class SecureCounters(object):
     def _unblind(self, blinding_factors):
         '''
         Generate unblinding factors from blinding_factors, and apply them to
-        self.counters.
+        self.counts.
         Returns the applied unblinding factors.
         '''
         # since we generate unblinding factors based on network input, a
@@ -1228,35 +1453,70 @@ class SecureCounters(object):
         uid.
         '''
         self.shares = {}
+        sampler = BufferedSampler()
         for uid in uids:
             # add blinding factors to all of the counters
-            blinding_factors = self._blind()
+            blinding_factors = self._blind(sampler)
             # the caller can add additional annotations to this dictionary
             self.shares[uid] = {'secret': blinding_factors, 'sk_uid': uid}
+        # don't keep any unused random bytes around
+        sampler.clear()
+
+    NOISE_BATCH = 'batch'
+    '''
+    Generate the noise for all bins at once, using
+    BufferedSampler.sample_gaussian_list().
+    '''
 
-    def generate_noise(self, noise_weight):
+    NOISE_SYSTEM_RANDOM = 'systemrandom'
+    '''
+    Generate the noise for each bin separately, using noise(), which calls
+    SystemRandom().gauss().
+    '''
+
+    def generate_noise(self, noise_weight, noise_method=NOISE_BATCH):
         '''
         Generate and apply noise for each counter.
+        noise_method is NOISE_BATCH or NOISE_SYSTEM_RANDOM.
         '''
+        assert noise_method in [SecureCounters.NOISE_BATCH,
+                                SecureCounters.NOISE_SYSTEM_RANDOM]
         # generate noise for each counter independently
-        noise_values = deepcopy(self.zero_counters)
-        for key in noise_values:
-            for item in noise_values[key]['bins']:
-                sigma = noise_values[key]['sigma']
-                sampled_noise = noise(sigma, 1, noise_weight)
-                # exact halfway values are rounded towards even integers
-                # values over 2**53 are not integer-accurate
-                # but we don't care, because it's just noise
-                item[2] = long(round(sampled_noise))
+        if noise_method == SecureCounters.NOISE_BATCH:
+            sampler = BufferedSampler()
+            bin_count = sum(len(bins) for bins in self.bins.values())
+            standard_values = sampler.sample_gaussian_list(bin_count)
+            # don't keep any unused random bytes around
+            sampler.clear()
+        noise_values = {}
+        offset = 0
+        for key in self.bins:
+            sigma = self.counter_items[key]['sigma']
+            bin_count = len(self.bins[key])
+            if noise_method == SecureCounters.NOISE_BATCH:
+                sigma_i = noise_sigma(sigma, 1, noise_weight)
+                sampled_noise = [sigma_i * standard_value
+                                 for standard_value
+                                 in standard_values[offset:offset + bin_count]]
+                offset += bin_count
+            else:
+                sampled_noise = [noise(sigma, 1, noise_weight)
+                                 for _ in xrange(bin_count)]
+            # exact halfway values are rounded towards even integers
+            # values over 2**53 are not integer-accurate
+            # but we don't care, because it's just noise
+            noise_values[key] = [long(round(value))
+                                 for value in sampled_noise]
 
         # add the noise to each counter
-        self._tally_counter(noise_values)
+        self._add_counts(noise_values)
 
     def detach_blinding_shares(self):
         '''
         Deletes this class' reference to self.shares.
         Does not securely delete, as python does not have secure delete.
-        Detaches and returns the value of self.shares.
+        Detaches and returns the value of self.shares, with each secret
+        converted to a counters structure.
         Typically, the caller then uses encrypt() on the returned shares.
         '''
         shares = self.shares
@@ -1265,6 +1525,10 @@ class SecureCounters(object):
         # deallocation is implementation-dependent
         del self.shares
         self.shares = None
+        if shares is not None:
+            for uid in shares:
+                shares[uid]['secret'] = self._to_counters(
+                                                   shares[uid]['secret'])
         return shares
 
     def import_blinding_share(self, share):
@@ -1286,6 +1550,11 @@ class SecureCounters(object):
     This constant must be outside the range of every possible counter.
     '''
 
+    INF = float('inf')
+    '''
+    The upper bound of the last bin in most counters.
+    '''
+
     @staticmethod
     def is_single_bin_value(value):
         if isnan(SecureCounters.SINGLE_BIN):
@@ -1302,14 +1571,15 @@ class SecureCounters(object):
         '''
         if bin_value >= bin_min:
             # any value is <= inf, so we don't need to check if bin_value is inf
-            if bin_value < bin_max or bin_max == float('inf'):
+            if bin_value < bin_max or bin_max == SecureCounters.INF:
                 return True
         return False
 
     def increment(self, counter_name, bin=SINGLE_BIN, inc=1):
         '''
         Increment a bin in counter counter_name by inc.
-        Uses is_in_bin() to work out which bin to increment.
+        Uses a binary search on the bin index to find the bin to increment,
+        with the same semantics as is_in_bin().
         Example:
             secure_counters.increment('ExampleHistogram',
                                       bin=25,
@@ -1321,21 +1591,183 @@ class SecureCounters(object):
                                       bin=SINGLE_BIN,
                                       inc=1)
         '''
-        if self.counters is not None and counter_name in self.counters:
+        if self.counts is not None and counter_name in self.counts:
             # You must pass SINGLE_BIN if counter_name is a single bin
-            if len(self.counters[counter_name]['bins']) == 1:
+            if len(self.bins[counter_name]) == 1:
                 assert(SecureCounters.is_single_bin_value(bin))
                 bin = 1.0
             else:
                 assert(not SecureCounters.is_single_bin_value(bin))
                 bin = float(bin)
-            for item in self.counters[counter_name]['bins']:
-                if SecureCounters.is_in_bin(item[0], item[1], bin):
-                    item[2] = ((long(item[2]) + long(inc))
-                               % self.modulus)
+            bins = self.bins[counter_name]
+            counts = self.counts[counter_name]
+            index = self.bin_index[counter_name]
+            if index is None:
+                # overlapping bins: a value can be in any number of bins
+                for i in xrange(len(bins)):
+                    if SecureCounters.is_in_bin(bins[i][0], bins[i][1], bin):
+                        counts[i] = self._reduce(counts[i] + long(inc))
+                return
+            (bin_mins, positions) = index
+            # find the last bin with bin_min <= bin
+            i = bisect_right(bin_mins, bin) - 1
+            if i < 0:
+                return
+            i = positions[i]
+            (bin_min, bin_max) = bins[i]
+            # this is is_in_bin(), inlined
+            # we must check bin_min, because bisect doesn't handle nan
+            if bin >= bin_min and (bin < bin_max or
+                                   bin_max == SecureCounters.INF):
+                # this is _reduce(), inlined
+                # counts are always longs, so we only need to cast inc
+                if self.modulus_mask is not None:
+                    counts[i] = (counts[i] + long(inc)) & self.modulus_mask
+                else:
+                    counts[i] = (counts[i] + long(inc)) % self.modulus
 
-    def _tally_counter(self, counter):
-        if self.counters == None:
+    NUMPY_MIN_VALUES = 32
+    '''
+    increment_many() only uses numpy when there are at least this many values,
+    because numpy has a large fixed overhead for each call.
+    '''
+
+    def increment_many(self, counter_name, values, incs=None):
+        '''
+        Increment counter_name once for each bin value in values.
+        If incs is None, increment by 1 for each value. Otherwise, incs must
+        be a sequence the same length as values, and each value is
+        incremented by the corresponding inc.
+        This has the same result as calling increment() for each value, but
+        bins all the values at once, then does one modular addition for each
+        bin that was touched.
+        Example:
+            secure_counters.increment_many('ExampleHistogram',
+                                           [25, 1024, 25])
+
+        If there is only one bin for the counter, you must pass SINGLE_BIN
+        for each value.
+        '''
+        if self.counts is None or counter_name not in self.counts:
+            return
+        if incs is not None:
+            assert len(incs) == len(values)
+        if len(values) == 0:
+            return
+        counts = self.counts[counter_name]
+        # You must pass SINGLE_BIN if counter_name is a single bin
+        if len(self.bins[counter_name]) == 1:
+            for value in values:
+                assert(SecureCounters.is_single_bin_value(value))
+            if incs is None:
+                total = long(len(values))
+            else:
+                total = sum(long(inc) for inc in incs)
+            counts[0] = self._reduce(counts[0] + total)
+            return
+        if (counter_name in self.bin_arrays and
+            len(values) >= SecureCounters.NUMPY_MIN_VALUES):
+            bin_totals = self._bin_many_numpy(counter_name, values, incs)
+        else:
+            bin_totals = self._bin_many_python(counter_name, values, incs)
+        for (i, total) in bin_totals.iteritems():
+            counts[i] = self._reduce(counts[i] + total)
+
+    def _bin_many_python(self, counter_name, values, incs):
+        '''
+        Bin values using the bin index for counter_name.
+        Returns a dict mapping each bin position that was touched to the
+        total of the incs (or the count of values) in that bin.
+        '''
+        bins = self.bins[counter_name]
+        index = self.bin_index[counter_name]
+        bin_totals = {}
+        for j in xrange(len(values)):
+            value = values[j]
+            assert(not SecureCounters.is_single_bin_value(value))
+            value = float(value)
+            inc = 1L if incs is None else long(incs[j])
+            if index is None:
+                # overlapping bins: a value can be in any number of bins
+                for i in xrange(len(bins)):
+                    if SecureCounters.is_in_bin(bins[i][0], bins[i][1],
+                                                value):
+                        bin_totals[i] = bin_totals.get(i, 0L) + inc
+                continue
+            (bin_mins, positions) = index
+            i = bisect_right(bin_mins, value) - 1
+            if i < 0:
+                continue
+            i = positions[i]
+            if SecureCounters.is_in_bin(bins[i][0], bins[i][1], value):
+                bin_totals[i] = bin_totals.get(i, 0L) + inc
+        return bin_totals
+
+    def _bin_many_numpy(self, counter_name, values, incs):
+        '''
+        Bin values using numpy's searchsorted on the bin arrays for
+        counter_name, which must not have overlapping bins.
+        Returns a dict mapping each bin position that was touched to the
+        total of the incs (or the count of values) in that bin.
+        '''
+        (bin_mins, bin_maxs) = self.bin_arrays[counter_name]
+        (_, positions) = self.bin_index[counter_name]
+        value_array = numpy.asarray(values, dtype=numpy.float64)
+        assert(not numpy.isnan(value_array).any())
+        # find the last bin with bin_min <= value
+        sorted_indexes = numpy.searchsorted(bin_mins, value_array,
+                                            side='right') - 1
+        # values below the first bin get an index of -1
+        is_binned = sorted_indexes >= 0
+        sorted_indexes[~is_binned] = 0
+        # this is is_in_bin(), vectorised
+        item_maxs = bin_maxs[sorted_indexes]
+        is_binned &= value_array >= bin_mins[sorted_indexes]
+        is_binned &= ((value_array < item_maxs) |
+                      (item_maxs == SecureCounters.INF))
+        bin_totals = {}
+        if incs is None:
+            sorted_totals = numpy.bincount(sorted_indexes[is_binned],
+                                           minlength=len(positions))
+            for i in numpy.flatnonzero(sorted_totals):
+                bin_totals[positions[i]] = long(sorted_totals[i])
+        else:
+            # incs can be arbitrary-precision longs, so sum them in python
+            for (i, j) in zip(sorted_indexes[is_binned].tolist(),
+                              numpy.flatnonzero(is_binned).tolist()):
+                i = positions[i]
+                bin_totals[i] = bin_totals.get(i, 0L) + long(incs[j])
+        return bin_totals
+
+    def _reduce(self, value):
+        '''
+        Return value modulo self.modulus, using a bitmask if possible.
+        '''
+        if self.modulus_mask is not None:
+            return value & self.modulus_mask
+        else:
+            return value % self.modulus
+
+    def _add_counts(self, counts):
+        '''
+        Add the flat counts structure counts to self.counts.
+        counts must have been created by this class, so it is not checked.
+        '''
+        for key in self.counts:
+            tally_counts = self.counts[key]
+            add_counts = counts[key]
+            for i in xrange(len(tally_counts)):
+                tally_counts[i] = self._reduce(tally_counts[i] + add_counts[i])
+
+    def tally_counter(self, counter):
+        '''
+        Validate counter, which comes from the network, and add it to the
+        running tally. counter is not modified or retained.
+        Returns True on success, and False if counter does not match
+        self.bins. On failure, the tally is not modified.
+        Once all the counters have been added, call adjust_counts_signed().
+        '''
+        if self.counts == None:
             return False
 
         # validate that the counter data structures match
@@ -1343,34 +1775,188 @@ class SecureCounters(object):
             return False
 
         # ok, the counters match
-        for key in self.counters:
-            num_bins = len(self.counters[key]['bins'])
-            for i in xrange(num_bins):
-                tally_bin = self.counters[key]['bins'][i]
-                tally_bin[2] = ((long(tally_bin[2]) +
-                                 long(counter[key]['bins'][i][2]))
-                                % self.modulus)
+        # counter comes from the network, so we cast it to long
+        self._add_counts(dict((key, [long(item[2]) for item
+                                     in counter[key]['bins']])
+                              for key in self.counts))
 
         # success
         return True
 
+    def adjust_counts_signed(self):
+        '''
+        Adjust the tallied counts so that they can register negative counts.
+        (Negative counts are possible if noise is negative.)
+        Call this once, after all the counters have been tallied.
+        '''
+        for key in self.counts:
+            tally_counts = self.counts[key]
+            for i in xrange(len(tally_counts)):
+                tally_counts[i] = adjust_count_signed(tally_counts[i],
+                                                      self.modulus)
+
     def tally_counters(self, counters):
         # first add up all of the counters together
         for counter in counters:
-            if not self._tally_counter(counter):
+            if not self.tally_counter(counter):
                 return False
         # now adjust so our tally can register negative counts
-        # (negative counts are possible if noise is negative)
-        for key in self.counters:
-            for tally_bin in self.counters[key]['bins']:
-                tally_bin[2] = adjust_count_signed(tally_bin[2], self.modulus)
+        self.adjust_counts_signed()
         return True
 
     def detach_counts(self):
-        counts = self.counters
-        self.counters = None
-        return counts
+        '''
+        Detaches and returns the counts, as a counters structure.
+        '''
+        counts = self.counts
+        self.counts = None
+        if counts is None:
+            return None
+        return self._to_counters(counts)
+
+    def get_counter_handle(self, counter_name):
+        '''
+        Returns a handle that increments counter_name, with the same results
+        as increment() and increment_many(). Handles resolve the counter's
+        bins and counts once, so they are faster than passing the counter
+        name on every call.
+        If counter_name is not configured, returns a handle that does nothing.
+        Handles must not be used after detach_counts().
+        Example:
+            handle = secure_counters.get_counter_handle('ExampleHistogram')
+            handle.increment(bin=25, inc=1)
+        '''
+        if self.counts is None or counter_name not in self.counts:
+            return NULL_COUNTER_HANDLE
+        bins = self.bins[counter_name]
+        if len(bins) == 1:
+            # increment() always puts single bin values in bin 1.0
+            (bin_min, bin_max) = bins[0]
+            if not SecureCounters.is_in_bin(bin_min, bin_max, 1.0):
+                return NULL_COUNTER_HANDLE
+            return SingleBinCounterHandle(self, counter_name)
+        if self.bin_index[counter_name] is None:
+            # overlapping bins use the slow path in increment()
+            return CounterHandle(self, counter_name)
+        return HistogramCounterHandle(self, counter_name)
+
+    def get_counter_handles(self, counter_names):
+        '''
+        Returns a dict containing a handle for each counter in counter_names.
+        See get_counter_handle() for details.
+        '''
+        return dict((counter_name, self.get_counter_handle(counter_name))
+                    for counter_name in counter_names)
+
+class CounterHandle(object):
+    '''
+    A handle for a single counter in a SecureCounters instance.
+    Returned by SecureCounters.get_counter_handle().
+    This base class passes each call through to the SecureCounters instance,
+    it is used for counters with overlapping bins.
+    '''
+
+    __slots__ = ('counter_name', 'secure_counters', 'counts', 'modulus',
+                 'modulus_mask')
+
+    def __init__(self, secure_counters, counter_name):
+        self.secure_counters = secure_counters
+        self.counter_name = counter_name
+        # the counts list is modified in place, so we can keep a reference
+        self.counts = secure_counters.counts[counter_name]
+        self.modulus = secure_counters.modulus
+        self.modulus_mask = secure_counters.modulus_mask
+
+    def increment(self, bin=SecureCounters.SINGLE_BIN, inc=1):
+        '''
+        See SecureCounters.increment()
+        '''
+        self.secure_counters.increment(self.counter_name, bin=bin, inc=inc)
+
+    def increment_many(self, values, incs=None):
+        '''
+        See SecureCounters.increment_many()
+        '''
+        self.secure_counters.increment_many(self.counter_name, values,
+                                            incs=incs)
+
+class SingleBinCounterHandle(CounterHandle):
+    '''
+    A handle for a counter with a single bin.
+    increment() ignores bin, rather than checking that it is SINGLE_BIN.
+    '''
+
+    __slots__ = ()
+
+    def increment(self, bin=SecureCounters.SINGLE_BIN, inc=1):
+        '''
+        Add inc to the counter.
+        '''
+        # this is _reduce(), inlined
+        # counts are always longs, so we only need to cast inc
+        if self.modulus_mask is not None:
+            self.counts[0] = (self.counts[0] + long(inc)) & self.modulus_mask
+        else:
+            self.counts[0] = (self.counts[0] + long(inc)) % self.modulus
+
+class HistogramCounterHandle(CounterHandle):
+    '''
+    A handle for a counter with multiple non-overlapping bins.
+    increment() requires a numeric bin value, it does not accept SINGLE_BIN.
+    '''
+
+    __slots__ = ('bin_mins', 'bin_maxs', 'positions')
+
+    def __init__(self, secure_counters, counter_name):
+        super(HistogramCounterHandle, self).__init__(secure_counters,
+                                                     counter_name)
+        bins = secure_counters.bins[counter_name]
+        (self.bin_mins, self.positions) = secure_counters.bin_index[
+                                                                 counter_name]
+        # the bin maxs, in the same order as bin_mins
+        self.bin_maxs = [bins[i][1] for i in self.positions]
+
+    def increment(self, bin, inc=1):
+        '''
+        Add inc to the bin containing bin, if there is one.
+        Like SecureCounters.increment(), values outside every bin, including
+        nan, are not counted.
+        '''
+        # You must not pass SINGLE_BIN for a histogram
+        assert(not SecureCounters.is_single_bin_value(bin))
+        bin = float(bin)
+        # find the last bin with bin_min <= bin
+        i = bisect_right(self.bin_mins, bin) - 1
+        if i < 0:
+            return
+        bin_max = self.bin_maxs[i]
+        # this is is_in_bin(), inlined
+        # we must check bin_min, because bisect doesn't handle nan
+        if bin >= self.bin_mins[i] and (bin < bin_max or
+                                        bin_max == SecureCounters.INF):
+            i = self.positions[i]
+            counts = self.counts
+            # this is _reduce(), inlined
+            if self.modulus_mask is not None:
+                counts[i] = (counts[i] + long(inc)) & self.modulus_mask
+            else:
+                counts[i] = (counts[i] + long(inc)) % self.modulus
+
+class NullCounterHandle(object):
+    '''
+    A handle for a counter that is not configured. It does nothing.
+    '''
+
+    __slots__ = ()
+
+    def increment(self, bin=SecureCounters.SINGLE_BIN, inc=1):
+        pass
+
+    def increment_many(self, values, incs=None):
+        pass
 
+# handles are stateless when the counter is not configured, so we share one
+NULL_COUNTER_HANDLE = NullCounterHandle()
 
 """
 def prob_exit(consensus_path, my_fingerprint, fingerprint_pool=None):
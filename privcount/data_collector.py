@@ -3,29 +3,354 @@
 import os
 import logging
 import math
+import socket
+import signal
 import string
+import struct
 import sys
 import cPickle as pickle
 import yaml
 
-from time import time
+from time import time, clock
 from copy import deepcopy
+from bisect import bisect_right
+from collections import deque
 from base64 import b64decode
 
-from twisted.internet import task, reactor, ssl
-from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet import defer, error, task, reactor, ssl, threads
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import ReconnectingClientFactory, ProcessProtocol
+from twisted.python.threadpool import ThreadPool
+from zope.interface import implementer
 
 from privcount.config import normalise_path, choose_secret_handshake_path
 from privcount.connection import connect, disconnect, validate_connection_config, choose_a_connection, get_a_control_password
-from privcount.counter import SecureCounters, counter_modulus, add_counter_limits_to_config, combine_counters, has_noise_weight, get_noise_weight, count_bins
+from privcount.counter import SecureCounters, counter_modulus, add_counter_limits_to_config, combine_counters, has_noise_weight, get_noise_weight, count_bins, get_valid_counters, get_events_for_counters, NULL_COUNTER_HANDLE, PRIVCOUNT_COUNTER_EVENTS, BYTES_EVENT, STREAM_EVENT, CIRCUIT_EVENT, CONNECTION_EVENT
 from privcount.crypto import get_public_digest_string, load_public_key_string, encrypt
 from privcount.log import log_error, format_delay_time_wait, format_last_event_time_since, format_elapsed_time_since, errorCallback
 from privcount.node import PrivCountClient, EXPECTED_EVENT_INTERVAL_MAX, EXPECTED_CONTROL_ESTABLISH_MAX
 from privcount.protocol import PrivCountClientProtocol, TorControlClientProtocol, get_privcount_version
-from privcount.traffic_model import TrafficModel, check_traffic_model_config
+from privcount.traffic_model import TrafficModel, StreamPacketBuffer, check_traffic_model_config
 
 SINGLE_BIN = SecureCounters.SINGLE_BIN
 
+# the directory containing the privcount package, shard processes import
+# privcount from this directory
+PRIVCOUNT_PARENT_DIRECTORY = os.path.dirname(os.path.dirname(
+                                 os.path.abspath(__file__)))
+
+# The stream classes, in class id order. Ports that are not in any other
+# class are in the 'other' class.
+STREAM_CLASSES = ['other', 'web', 'interactive', 'p2p']
+
+# The ports in each stream class. Each item is a port, or an inclusive
+# [first, last] port range.
+# If a port is in multiple classes, the earliest class in STREAM_CLASSES wins.
+DEFAULT_PORT_CLASSES = {
+    'web': [80, 443],
+    'interactive': [22, 194, 994, [6660, 6670], 6679, 6697, 7000],
+    'p2p': [1214, [4661, 4666], [6346, 6429], 6699, [6881, 6999]],
+}
+
+# The indexes of the values available to stream counters, in the tuple of
+# values that _handle_stream_event() passes to the stream counters
+(STREAM_SINGLE_BIN, STREAM_ONE, STREAM_TOTAL_BYTES, STREAM_WRITE_BYTES,
+ STREAM_READ_BYTES, STREAM_RATIO, STREAM_LIFETIME) = range(7)
+
+# The counters incremented for each stream, by stream class.
+# Each item is (counter name, bin value index, inc value index).
+# The 'all' counters are incremented for every stream.
+STREAM_CLASS_COUNTERS = {
+    'all': [
+        ('ExitStreamCount', STREAM_SINGLE_BIN, STREAM_ONE),
+        ('ExitStreamByteCount', STREAM_SINGLE_BIN, STREAM_TOTAL_BYTES),
+        ('ExitStreamOutboundByteCount', STREAM_WRITE_BYTES, STREAM_ONE),
+        ('ExitStreamInboundByteCount', STREAM_READ_BYTES, STREAM_ONE),
+        ('ExitStreamByteRatio', STREAM_RATIO, STREAM_ONE),
+        ('ExitStreamLifeTime', STREAM_LIFETIME, STREAM_ONE),
+    ],
+    'web': [
+        ('ExitWebStreamCount', STREAM_SINGLE_BIN, STREAM_ONE),
+        ('ExitWebStreamByteCount', STREAM_SINGLE_BIN, STREAM_TOTAL_BYTES),
+        ('ExitWebStreamOutboundByteCount', STREAM_WRITE_BYTES, STREAM_ONE),
+        ('ExitWebStreamInboundByteCount', STREAM_READ_BYTES, STREAM_ONE),
+        ('ExitWebStreamByteRatio', STREAM_RATIO, STREAM_ONE),
+        ('ExitWebStreamLifeTime', STREAM_LIFETIME, STREAM_ONE),
+    ],
+    'interactive': [
+        ('ExitInteractiveStreamCount', STREAM_SINGLE_BIN, STREAM_ONE),
+        ('ExitInteractiveStreamByteCount', STREAM_SINGLE_BIN, STREAM_TOTAL_BYTES),
+        ('ExitInteractiveStreamOutboundByteCount', STREAM_WRITE_BYTES, STREAM_ONE),
+        ('ExitInteractiveStreamInboundByteCount', STREAM_READ_BYTES, STREAM_ONE),
+        ('ExitInteractiveStreamByteRatio', STREAM_RATIO, STREAM_ONE),
+        ('ExitInteractiveStreamLifeTime', STREAM_LIFETIME, STREAM_ONE),
+    ],
+    'p2p': [
+        ('ExitP2PStreamCount', STREAM_SINGLE_BIN, STREAM_ONE),
+        ('ExitP2PStreamByteCount', STREAM_SINGLE_BIN, STREAM_TOTAL_BYTES),
+        ('ExitP2PStreamOutboundByteCount', STREAM_WRITE_BYTES, STREAM_ONE),
+        ('ExitP2PStreamInboundByteCount', STREAM_READ_BYTES, STREAM_ONE),
+        ('ExitP2PStreamByteRatio', STREAM_RATIO, STREAM_ONE),
+        ('ExitP2PStreamLifeTime', STREAM_LIFETIME, STREAM_ONE),
+    ],
+    'other': [
+        ('ExitOtherPortStreamCount', STREAM_SINGLE_BIN, STREAM_ONE),
+        ('ExitOtherPortStreamByteCount', STREAM_SINGLE_BIN, STREAM_TOTAL_BYTES),
+        ('ExitOtherPortStreamOutboundByteCount', STREAM_WRITE_BYTES, STREAM_ONE),
+        ('ExitOtherPortStreamInboundByteCount', STREAM_READ_BYTES, STREAM_ONE),
+        ('ExitOtherPortStreamByteRatio', STREAM_RATIO, STREAM_ONE),
+        ('ExitOtherPortStreamLifeTime', STREAM_LIFETIME, STREAM_ONE),
+    ],
+}
+
+# The number of valid TCP ports, including port 0
+PORT_COUNT = 65536
+
+def check_port_classes_config(port_classes):
+    '''
+    Check that port_classes is a dict of stream class names and port lists,
+    in the format used by DEFAULT_PORT_CLASSES.
+    Returns True if port_classes is valid, and False if it is not.
+    '''
+    if not isinstance(port_classes, dict):
+        return False
+    for stream_class in port_classes:
+        # there are only counters for the existing stream classes
+        if stream_class not in STREAM_CLASSES or stream_class == 'other':
+            logging.warning("Unknown stream class '{}' in port classes, valid classes are: {}"
+                            .format(stream_class,
+                                    ', '.join(STREAM_CLASSES[1:])))
+            return False
+        for item in port_classes[stream_class]:
+            if isinstance(item, list):
+                if len(item) != 2 or item[0] > item[1]:
+                    return False
+                ports = item
+            else:
+                ports = [item]
+            for port in ports:
+                if not isinstance(port, int) or port < 0 or port >= PORT_COUNT:
+                    return False
+    return True
+
+def build_port_class_table(port_classes=None):
+    '''
+    Returns a bytearray of length PORT_COUNT, containing the index in
+    STREAM_CLASSES of the class of each port.
+    The ports for each class in port_classes replace the ports in
+    DEFAULT_PORT_CLASSES for that class.
+    '''
+    merged_classes = dict(DEFAULT_PORT_CLASSES)
+    if port_classes is not None:
+        merged_classes.update(port_classes)
+    # 0 is 'other'
+    table = bytearray(PORT_COUNT)
+    # apply the lowest priority classes first, so higher priority classes
+    # overwrite them
+    for class_id in reversed(xrange(1, len(STREAM_CLASSES))):
+        for item in merged_classes.get(STREAM_CLASSES[class_id], []):
+            if isinstance(item, list):
+                (first, last) = item
+            else:
+                (first, last) = (item, item)
+            for port in xrange(first, last + 1):
+                table[port] = class_id
+    return table
+
+DEFAULT_PORT_CLASS_TABLE = build_port_class_table()
+
+def pack_ip_address(ip):
+    '''
+    Returns ip as a packed 4-byte IPv4 or 16-byte IPv6 address string.
+    If ip is not a valid IP address, returns ip unmodified.
+    '''
+    family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+    try:
+        return socket.inet_pton(family, ip)
+    except (socket.error, ValueError):
+        return ip
+
+class ClientIPRecord(object):
+    '''
+    The circuits from a client IP address in a rotation window.
+    '''
+
+    __slots__ = ('is_active', 'num_active_completed',
+                 'num_inactive_completed')
+
+    def __init__(self):
+        self.is_active = False
+        self.num_active_completed = 0
+        self.num_inactive_completed = 0
+
+class TimingWheel(object):
+    '''
+    Finds keys that have not been used for timeout_ticks ticks.
+
+    Each slot in the wheel holds the keys that were last used in a tick.
+    The caller stores the tick when each key was last used, so the key can
+    be moved to the current tick's slot when it is used again, and removed
+    when the caller removes it. When a slot times out, its keys are
+    returned, and the caller expires them.
+    Slots are only created for ticks that have keys, so idle ticks use no
+    memory.
+    Using a key, removing a key, and advancing the wheel all take amortized
+    O(1) time per key.
+    '''
+
+    def __init__(self, timeout_ticks):
+        assert timeout_ticks > 0
+        self.tick = 0
+        self.timeout_ticks = timeout_ticks
+        # a dict of tick: set of keys last used in that tick
+        self.slots = {}
+
+    def touch(self, key, last_tick):
+        '''
+        Record that key was used in the current tick. last_tick is the tick
+        when key was last used, or None if it has never been used.
+        Returns the current tick, which the caller should store for key.
+        '''
+        if last_tick != self.tick:
+            self.remove(key, last_tick)
+            self.slots.setdefault(self.tick, set()).add(key)
+        return self.tick
+
+    def remove(self, key, last_tick):
+        '''
+        Remove key, which was last used in last_tick, from the wheel.
+        Call this when the caller removes the key's state.
+        '''
+        slot = self.slots.get(last_tick)
+        if slot is None:
+            return
+        slot.discard(key)
+        if len(slot) == 0:
+            del self.slots[last_tick]
+
+    def get_key_count(self):
+        '''
+        Returns the number of keys in the wheel.
+        '''
+        return sum(len(slot) for slot in self.slots.itervalues())
+
+    def advance(self):
+        '''
+        Move to the next tick.
+        Returns a tuple containing the tick that has just timed out, and the
+        keys that were last used in that tick. The caller should expire
+        these keys.
+        '''
+        self.tick += 1
+        expired_tick = self.tick - self.timeout_ticks
+        return (expired_tick, self.slots.pop(expired_tick, set()))
+
+class EventStats(object):
+    '''
+    Counts the events of one type that were received, skipped, handled and
+    rejected, and keeps histograms of the time taken to handle a sample of
+    the handled events (latency), and the time from each sampled event's end
+    time to when we handled it (lag). Lag includes the time the event spent
+    in tor and in our buffers, and any clock differences between tor and us.
+    '''
+
+    __slots__ = ('received_count', 'skipped_count', 'handled_count',
+                 'rejected_count', 'latency_count', 'latency_total',
+                 'latency_bin_counts', 'lag_count', 'lag_total',
+                 'lag_bin_counts')
+
+    # the bin boundaries for the histograms, in seconds
+    LATENCY_BOUNDS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+    LAG_BOUNDS = (0.0, 0.01, 0.1, 1.0, 10.0, 60.0, 600.0)
+
+    def __init__(self):
+        self.received_count = 0
+        self.skipped_count = 0
+        self.handled_count = 0
+        self.rejected_count = 0
+        self.latency_count = 0
+        self.latency_total = 0.0
+        self.latency_bin_counts = [0] * (len(EventStats.LATENCY_BOUNDS) + 1)
+        self.lag_count = 0
+        self.lag_total = 0.0
+        self.lag_bin_counts = [0] * (len(EventStats.LAG_BOUNDS) + 1)
+
+    def add_latency(self, latency):
+        '''
+        Add latency, the time taken to handle an event, to the histogram.
+        '''
+        self.latency_count += 1
+        self.latency_total += latency
+        self.latency_bin_counts[bisect_right(EventStats.LATENCY_BOUNDS,
+                                             latency)] += 1
+
+    def add_lag(self, lag):
+        '''
+        Add lag, the time from an event's end time to when we handled it,
+        to the histogram.
+        '''
+        self.lag_count += 1
+        self.lag_total += lag
+        self.lag_bin_counts[bisect_right(EventStats.LAG_BOUNDS, lag)] += 1
+
+    @staticmethod
+    def _get_bins(bounds, bin_values):
+        '''
+        Return a list of [bin_min, bin_max, value] lists for bounds and
+        bin_values, in the same format as the counter bins.
+        '''
+        bin_mins = (float('-inf'),) + bounds
+        bin_maxs = bounds + (float('inf'),)
+        return [[bin_min, bin_max, value] for (bin_min, bin_max, value)
+                in zip(bin_mins, bin_maxs, bin_values)]
+
+    @staticmethod
+    def _get_fractions(bin_counts, total_count):
+        '''
+        Return a list containing the fraction of total_count in each of
+        bin_counts, or None if total_count is 0.
+        '''
+        if total_count == 0:
+            return None
+        return [float(count) / total_count for count in bin_counts]
+
+    def get_context(self, exact_counts=False):
+        '''
+        Return a dictionary containing the mean latency and lag, and the
+        fraction of the sampled events in each histogram bin.
+        The events are sampled at a fixed interval, so the histogram bin
+        counts are close to the exact event counts. If exact_counts is True,
+        include the bin counts, and the exact event counts.
+        '''
+        context = {
+            'latency_mean': (self.latency_total / self.latency_count
+                             if self.latency_count > 0 else None),
+            'lag_mean': (self.lag_total / self.lag_count
+                         if self.lag_count > 0 else None),
+            }
+        latency_fractions = EventStats._get_fractions(self.latency_bin_counts,
+                                                      self.latency_count)
+        if latency_fractions is not None:
+            context['latency_fractions'] = EventStats._get_bins(
+                EventStats.LATENCY_BOUNDS, latency_fractions)
+        lag_fractions = EventStats._get_fractions(self.lag_bin_counts,
+                                                  self.lag_count)
+        if lag_fractions is not None:
+            context['lag_fractions'] = EventStats._get_bins(
+                EventStats.LAG_BOUNDS, lag_fractions)
+        if exact_counts:
+            context.update({
+                'received_count': self.received_count,
+                'skipped_count': self.skipped_count,
+                'handled_count': self.handled_count,
+                'rejected_count': self.rejected_count,
+                'latency_bins': EventStats._get_bins(EventStats.LATENCY_BOUNDS,
+                                                     self.latency_bin_counts),
+                'lag_bins': EventStats._get_bins(EventStats.LAG_BOUNDS,
+                                                 self.lag_bin_counts),
+                })
+        return context
+
 # using reactor: pylint: disable=E1101
 # method docstring missing: pylint: disable=C0111
 # line too long: pylint: disable=C0301
@@ -99,7 +424,8 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
                  }
         # store the latest context, so we have it even when the aggregator goes away
         if self.aggregator is not None:
-            self.context.update(self.aggregator.get_context())
+            self.context.update(self.aggregator.get_context(
+                exact_counts=self.config['context_exact_counts']))
         # and include the latest context values in the status
         status.update(self.context)
         return status
@@ -115,7 +441,8 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             self.expected_aggregator_start_time is not None and
             self.expected_aggregator_start_time < time()):
             aggregator_live_time = time() - self.expected_aggregator_start_time
-            if ((self.aggregator.protocol is None or
+            if (self.aggregator.event_log_path is None and
+                (self.aggregator.protocol is None or
                  self.aggregator.protocol.state != "processing") and
                 aggregator_live_time > EXPECTED_CONTROL_ESTABLISH_MAX):
                 logging.warning("Aggregator has been running {}, but is not connected to the control port. Is your control port working?"
@@ -215,7 +542,15 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
                                      config['noise_weight'],
                                      counter_modulus(),
                                      self.config['event_source'],
-                                     self.config['rotate_period'])
+                                     self.config['rotate_period'],
+                                     port_classes=self.config.get('port_classes'),
+                                     stream_packet_limit=self.config.get('stream_packet_limit'),
+                                     state_timeout=self.config.get('state_timeout'),
+                                     rotate_in_thread=self.config.get('rotate_in_thread', False),
+                                     shard_count=self.config.get('aggregator_shards', 1),
+                                     viterbi_threads=self.config.get('viterbi_threads', 0),
+                                     viterbi_queue_limit=self.config.get('viterbi_queue_limit'),
+                                     viterbi_overflow=self.config.get('viterbi_overflow'))
 
         defer_time = config['defer_time'] if 'defer_time' in config else 0.0
         logging.info("got start command from tally server, starting aggregator in {}".format(format_delay_time_wait(defer_time, 'at')))
@@ -264,18 +599,19 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
         the TS wants us to stop the current collection phase
         they may or may not want us to send back our counters
         stop the node from running
-        return a dictionary containing counters (if available and wanted)
-        and the local and start configs
+        return a Deferred that fires with a dictionary containing counters
+        (if available and wanted) and the local and start configs
         '''
         logging.info("got command to stop collection phase")
 
-        counts = None
+        counts_deferred = defer.succeed(None)
         if self.is_aggregator_pending:
             self.is_aggregator_pending = False
             assert self.aggregator is None
             logging.info("Aggregator deferred, counts never started")
         elif self.aggregator is not None:
-            counts = self.aggregator.stop()
+            # the aggregator waits for its shards to send their counts
+            counts_deferred = self.aggregator.stop()
             # TODO: secure delete
             del self.aggregator
             self.aggregator = None
@@ -284,7 +620,9 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
 
         self.expected_aggregator_start_time = None
 
-        return self.check_stop_config(config, counts)
+        counts_deferred.addCallback(
+            lambda counts: self.check_stop_config(config, counts))
+        return counts_deferred
 
     DEFAULT_ROTATE_PERIOD = 600
 
@@ -324,11 +662,43 @@ class DataCollector(ReconnectingClientFactory, PrivCountClient):
             dc_conf['sigma_decrease_tolerance'] = \
                 self.get_valid_sigma_decrease_tolerance(dc_conf)
 
+            if 'port_classes' in dc_conf:
+                assert check_port_classes_config(dc_conf['port_classes'])
+
+            if 'stream_packet_limit' in dc_conf:
+                assert dc_conf['stream_packet_limit'] > 0
+
+            if 'state_timeout' in dc_conf:
+                assert dc_conf['state_timeout'] > 0
+
+            if 'rotate_in_thread' in dc_conf:
+                assert isinstance(dc_conf['rotate_in_thread'], bool)
+
+            dc_conf.setdefault('context_exact_counts', False)
+            assert isinstance(dc_conf['context_exact_counts'], bool)
+
+            if 'aggregator_shards' in dc_conf:
+                assert dc_conf['aggregator_shards'] >= 1
+
+            if 'viterbi_threads' in dc_conf:
+                assert dc_conf['viterbi_threads'] >= 0
+
+            if 'viterbi_queue_limit' in dc_conf:
+                assert dc_conf['viterbi_queue_limit'] > 0
+
+            if 'viterbi_overflow' in dc_conf:
+                assert dc_conf['viterbi_overflow'] in Aggregator.VITERBI_OVERFLOW_POLICIES
+
             assert dc_conf['name'] != ''
 
             assert validate_connection_config(dc_conf['tally_server_info'],
                                               must_have_ip=True)
-            assert validate_connection_config(dc_conf['event_source'])
+            event_log_path = Aggregator.get_event_log_path(
+                dc_conf['event_source'])
+            if event_log_path is not None:
+                assert os.path.exists(event_log_path)
+            else:
+                assert validate_connection_config(dc_conf['event_source'])
 
             assert 'share_keepers' in dc_conf
 
@@ -362,8 +732,36 @@ class Aggregator(ReconnectingClientFactory):
     '''
 
     def __init__(self, counters, traffic_model_config, sk_uids,
-                 noise_weight, modulus, tor_control_port, rotate_period):
+                 noise_weight, modulus, tor_control_port, rotate_period,
+                 port_classes=None, stream_packet_limit=None,
+                 state_timeout=None, rotate_in_thread=False, shard_count=1,
+                 viterbi_threads=0, viterbi_queue_limit=None,
+                 viterbi_overflow=None):
+        # if shard_count is more than 1, process events in shard_count
+        # worker processes, each with its own unblinded counters, and add
+        # their counts to our counts at stop()
+        self.shard_protocols = None
+        self.shard_batches = None
+        # the state context from each shard's last rotation
+        self.shard_state_contexts = None
+        # the shards that are too far behind for us to send them events
+        self.paused_shards = set()
+        # the protocol and event log fields are used to pause events
+        self.protocol = None
+        self.event_log_task = None
+        if shard_count > 1:
+            self._start_shards(shard_count,
+                               (counters, traffic_model_config, [],
+                                noise_weight, modulus, None, rotate_period),
+                               dict(port_classes=port_classes,
+                                    stream_packet_limit=stream_packet_limit,
+                                    state_timeout=state_timeout))
+
         self.secure_counters = SecureCounters(counters, modulus)
+        # resolve each counter once per round, unconfigured counters get a
+        # handle that does nothing
+        self.counter_handles = self.secure_counters.get_counter_handles(
+                                                        get_valid_counters())
         self.collection_counters = counters
         # we can't generate the noise yet, because we don't know the
         # DC fingerprint
@@ -373,6 +771,29 @@ class Aggregator(ReconnectingClientFactory):
         self.traffic_model = None
         if traffic_model_config is not None:
             self.traffic_model = TrafficModel(traffic_model_config)
+        # the maximum number of packets we buffer for each stream
+        if stream_packet_limit is None:
+            stream_packet_limit = Aggregator.DEFAULT_STREAM_PACKET_LIMIT
+        self.stream_packet_limit = stream_packet_limit
+        # if viterbi_threads is more than 0, decode streams using the
+        # traffic model in a pool of viterbi_threads threads, so that
+        # decoding large streams doesn't block event processing
+        self._start_viterbi_pool(viterbi_threads, viterbi_queue_limit,
+                                 viterbi_overflow)
+        # expire circuit and stream state that hasn't been used for
+        # state_timeout seconds, checking every rotation
+        # the extra tick makes sure that state is kept for at least
+        # state_timeout
+        if state_timeout is None:
+            state_timeout = Aggregator.DEFAULT_STATE_TIMEOUT
+        timeout_ticks = int(math.ceil(float(state_timeout) /
+                                      rotate_period)) + 1
+        self.circ_info_wheel = TimingWheel(timeout_ticks)
+        self.strm_bytes_wheel = TimingWheel(timeout_ticks)
+        self.evicted_circ_info_count = 0
+        self.evicted_circ_info_bytes = 0
+        self.evicted_strm_bytes_count = 0
+        self.evicted_strm_bytes_bytes = 0
 
         self.noise_weight_config = noise_weight
         self.noise_weight_value = None
@@ -382,15 +803,41 @@ class Aggregator(ReconnectingClientFactory):
         self.protocol = None
         self.rotator = None
         self.tor_control_port = tor_control_port
+        # if the event source is a recorded event log, we read events from
+        # the log, rather than connecting to tor
+        self.event_log_path = Aggregator.get_event_log_path(tor_control_port)
+        self.event_log_task = None
+        self.event_log_next_rotate_time = None
+        self.event_log_file_count = 0
+        self.event_log_read_bytes = 0
+        self.event_log_line_count = 0
+        self.event_log_rejected_count = 0
+        self.event_log_start_time = None
+        self.event_log_end_time = None
         self.rotate_period = rotate_period
+        # classify stream ports using a lookup table
+        if port_classes is None:
+            self.port_class_table = DEFAULT_PORT_CLASS_TABLE
+        else:
+            self.port_class_table = build_port_class_table(port_classes)
+        # the configured stream counters for each stream class
+        self.stream_class_counters = self._build_stream_class_counters()
+        # skip any event processing that the configured counters don't use
+        self._build_processing_plan()
 
         self.last_event_time = None
+        # an EventStats for each event type
+        self.event_stats = {}
+        self.event_stats_countdown = Aggregator.EVENT_STATS_SAMPLE_INTERVAL
         self.num_rotations = 0
         self.circ_info = {}
         self.strm_bytes = {}
         self.cli_ips_rotated = time()
         self.cli_ips_current = {}
         self.cli_ips_previous = {}
+        # summarise rotated client IPs in a thread, rather than the reactor
+        self.rotate_in_thread = rotate_in_thread
+        self.pending_rotations = 0
 
         self.nickname = None
         self.orport_list = []
@@ -400,6 +847,574 @@ class Aggregator(ReconnectingClientFactory):
         self.address = None
         self.fingerprint = None
 
+    # the default maximum number of packets we buffer for each stream
+    # streams with more packets are processed in multiple parts, so their
+    # memory usage and processing time is bounded
+    DEFAULT_STREAM_PACKET_LIMIT = 10*TrafficModel.MAX_STREAM_PACKET_COUNT
+
+    # the default number of seconds that circuit and stream state is kept
+    # after it was last used
+    # Tor closes most circuits within an hour, but some long-lived
+    # circuits can last for days
+    DEFAULT_STATE_TIMEOUT = 24*60*60
+
+    # the default maximum number of streams waiting for viterbi threads
+    DEFAULT_VITERBI_QUEUE_LIMIT = 100
+
+    # when the viterbi queue is full, decode the stream in the reactor thread
+    # this slows down event processing, and tor buffers events until we
+    # catch up
+    VITERBI_OVERFLOW_INLINE = 'inline'
+    # when the viterbi queue is full, don't count the stream's packets
+    VITERBI_OVERFLOW_DROP = 'drop'
+    VITERBI_OVERFLOW_POLICIES = [VITERBI_OVERFLOW_INLINE,
+                                 VITERBI_OVERFLOW_DROP]
+
+    def _start_viterbi_pool(self, viterbi_threads, viterbi_queue_limit=None,
+                            viterbi_overflow=None):
+        '''
+        If viterbi_threads is more than 0, and we have a traffic model,
+        start a pool of viterbi_threads threads for decoding streams.
+        At most viterbi_queue_limit streams can be waiting for the pool.
+        After that, streams are handled using the viterbi_overflow policy.
+        '''
+        if viterbi_queue_limit is None:
+            viterbi_queue_limit = Aggregator.DEFAULT_VITERBI_QUEUE_LIMIT
+        if viterbi_overflow is None:
+            viterbi_overflow = Aggregator.VITERBI_OVERFLOW_INLINE
+        assert viterbi_overflow in Aggregator.VITERBI_OVERFLOW_POLICIES
+        self.viterbi_threads = viterbi_threads
+        self.viterbi_queue_limit = viterbi_queue_limit
+        self.viterbi_overflow = viterbi_overflow
+        # the counter increments from each decoded stream, appended by the
+        # pool threads, and removed by the reactor thread
+        self.viterbi_results = deque()
+        self.viterbi_pending = 0
+        self.viterbi_pending_max = 0
+        self.viterbi_submitted = 0
+        self.viterbi_overflowed = 0
+        # the Deferreds waiting for viterbi_pending to reach 0
+        self.viterbi_drain_deferreds = []
+        # the processing time for decoded streams
+        self.viterbi_times = TrafficModel.new_stream_times()
+        self.viterbi_pool = None
+        if viterbi_threads > 0 and self.traffic_model is not None:
+            self.viterbi_pool = ThreadPool(minthreads=0,
+                                           maxthreads=viterbi_threads,
+                                           name='PrivCountViterbi')
+            self.viterbi_pool.start()
+
+    def _process_packet_buffer(self, strm_start_ts, packet_buffer):
+        '''
+        Increment the traffic model counters using the packets in
+        packet_buffer, decoding them in the viterbi pool if we have one.
+        Does not modify the packets in packet_buffer.
+        Streams that reach the stream packet limit are decoded in parts, in
+        order, and each part continues the path from the end of the last
+        part.
+        '''
+        # we didn't count some earlier packets on the stream, so we can't
+        # continue its path
+        if packet_buffer.is_dropped:
+            return
+
+        # the pool threads use their own copy of the delays
+        if packet_buffer.pending_delays is not None:
+            # an earlier part of the stream is being decoded, so queue these
+            # packets until we know the state at the end of that part
+            packet_start_time = clock()
+            packet_buffer.pending_delays.append(
+                packet_buffer.get_packet_delays(strm_start_ts))
+            self.viterbi_times['packet_seconds'] += clock() - packet_start_time
+            self._add_viterbi_pending()
+            return
+
+        if self.viterbi_pool is None:
+            self.traffic_model.increment_packet_buffer_counters(
+                strm_start_ts, packet_buffer, self.secure_counters,
+                stream_times=self.viterbi_times)
+            return
+
+        if self.viterbi_pending >= self.viterbi_queue_limit:
+            self.viterbi_overflowed += 1
+            if self.viterbi_overflow == Aggregator.VITERBI_OVERFLOW_DROP:
+                logging.debug("Viterbi queue full, not counting stream packets")
+                packet_buffer.is_dropped = True
+            else:
+                self.traffic_model.increment_packet_buffer_counters(
+                    strm_start_ts, packet_buffer, self.secure_counters,
+                    stream_times=self.viterbi_times)
+            return
+
+        packet_start_time = clock()
+        observed_packet_delays = packet_buffer.get_packet_delays(strm_start_ts)
+        self.viterbi_times['packet_seconds'] += clock() - packet_start_time
+        packet_buffer.pending_delays = deque()
+        self._add_viterbi_pending()
+        self._submit_packet_delays(packet_buffer, observed_packet_delays)
+
+    def _add_viterbi_pending(self):
+        '''
+        Count a part of a stream that is waiting to be decoded.
+        '''
+        self.viterbi_pending += 1
+        self.viterbi_pending_max = max(self.viterbi_pending,
+                                       self.viterbi_pending_max)
+
+    def _submit_packet_delays(self, packet_buffer, observed_packet_delays):
+        '''
+        Decode observed_packet_delays from packet_buffer's stream in the
+        viterbi pool, continuing from packet_buffer.last_state.
+        If the pool has stopped, decode them in this thread.
+        '''
+        if self.viterbi_pool is None:
+            self.viterbi_results.append(self._get_viterbi_result(
+                packet_buffer, observed_packet_delays,
+                packet_buffer.last_state))
+            return
+        self.viterbi_submitted += 1
+        self.viterbi_pool.callInThread(self._decode_packet_delays,
+                                       packet_buffer, observed_packet_delays,
+                                       packet_buffer.last_state)
+
+    def _get_viterbi_result(self, packet_buffer, observed_packet_delays,
+                            prev_state):
+        '''
+        Decode observed_packet_delays using the traffic model, continuing
+        from prev_state. Returns a viterbi_results item.
+        '''
+        stream_times = TrafficModel.new_stream_times()
+        (counter_incs, last_state) = self.traffic_model.decode_packet_delays(
+                                                observed_packet_delays,
+                                                prev_state=prev_state,
+                                                stream_times=stream_times)
+        return (packet_buffer, last_state, counter_incs, stream_times)
+
+    def _decode_packet_delays(self, packet_buffer, observed_packet_delays,
+                              prev_state):
+        '''
+        Decode observed_packet_delays using the traffic model, and queue
+        the counter increments for the reactor thread.
+        If we have stopped counting, discard the stream instead.
+        Called in a viterbi pool thread.
+        '''
+        # we stopped counting while the stream was queued, so there is no
+        # point decoding it
+        if self.secure_counters is None:
+            reactor.callFromThread(self._discard_viterbi_stream,
+                                   packet_buffer)
+            return
+        try:
+            result = self._get_viterbi_result(packet_buffer,
+                                              observed_packet_delays,
+                                              prev_state)
+        except Exception as e:
+            logging.warning("Failed to decode stream in viterbi pool: {}"
+                            .format(e))
+            reactor.callFromThread(self._discard_viterbi_stream,
+                                   packet_buffer)
+            return
+        self.viterbi_results.append(result)
+        reactor.callFromThread(self._increment_viterbi_results)
+
+    def _discard_viterbi_stream(self, packet_buffer):
+        '''
+        Discard the part of packet_buffer's stream that the viterbi pool
+        didn't decode, and any parts queued after it. The rest of the stream
+        is not counted.
+        '''
+        self.viterbi_pending -= 1
+        if packet_buffer.pending_delays is not None:
+            self.viterbi_pending -= len(packet_buffer.pending_delays)
+        packet_buffer.pending_delays = None
+        packet_buffer.is_dropped = True
+        self._check_viterbi_drained()
+
+    def _increment_viterbi_results(self):
+        '''
+        Increment the counters using the results queued by the viterbi pool,
+        and submit the next queued part of each stream.
+        '''
+        while len(self.viterbi_results) > 0:
+            (packet_buffer, last_state, counter_incs,
+             stream_times) = self.viterbi_results.popleft()
+            self.viterbi_pending -= 1
+            TrafficModel.add_stream_times(self.viterbi_times, stream_times)
+            packet_buffer.last_state = last_state
+            if len(packet_buffer.pending_delays) > 0:
+                self._submit_packet_delays(
+                    packet_buffer, packet_buffer.pending_delays.popleft())
+            else:
+                packet_buffer.pending_delays = None
+            # we stopped counting while the stream was being decoded
+            if self.secure_counters is None:
+                continue
+            TrafficModel.increment_counters(counter_incs,
+                                            self.secure_counters)
+        self._check_viterbi_drained()
+
+    def _check_viterbi_drained(self):
+        '''
+        If there are no streams waiting to be decoded, fire the Deferreds
+        from _drain_viterbi_pool().
+        '''
+        if self.viterbi_pending > 0:
+            return
+        drain_deferreds = self.viterbi_drain_deferreds
+        self.viterbi_drain_deferreds = []
+        for drain_deferred in drain_deferreds:
+            drain_deferred.callback(None)
+
+    def _drain_viterbi_pool(self):
+        '''
+        Returns a Deferred that fires when the viterbi pool has decoded all
+        the streams in its queue, and the counters have been incremented
+        using the results. The reactor keeps running while we wait.
+        '''
+        if self.viterbi_pool is None or self.viterbi_pending == 0:
+            return defer.succeed(None)
+        logging.info("Waiting for {} streams to be decoded by the viterbi pool"
+                     .format(self.viterbi_pending))
+        drain_deferred = defer.Deferred()
+        self.viterbi_drain_deferreds.append(drain_deferred)
+        return drain_deferred
+
+    def _stop_viterbi_pool(self):
+        '''
+        Stop the viterbi pool. Call this after _drain_viterbi_pool() has
+        fired, so the pool threads are idle, and stopping them doesn't block
+        the reactor.
+        '''
+        if self.viterbi_pool is None:
+            return
+        self.viterbi_pool.stop()
+        self.viterbi_pool = None
+
+    def get_event_stats_context(self, exact_counts=False):
+        '''
+        Return a dictionary containing the EventStats context for each event
+        type. If exact_counts is True, include the exact event counts.
+        '''
+        return dict((event_code, stats.get_context(exact_counts=exact_counts))
+                    for (event_code, stats) in self.event_stats.iteritems())
+
+    def get_viterbi_context(self, exact_counts=False):
+        '''
+        Return a dictionary containing the viterbi pool configuration.
+        If exact_counts is True, include the queue depth, and the exact
+        number of streams submitted to the pool, and overflowed.
+        '''
+        context = {
+            'thread_count': self.viterbi_threads,
+            'queue_limit': self.viterbi_queue_limit,
+            'overflow_policy': self.viterbi_overflow,
+            }
+        if exact_counts:
+            context.update({
+                'pending_streams': self.viterbi_pending,
+                'pending_streams_max': self.viterbi_pending_max,
+                'submitted_streams': self.viterbi_submitted,
+                'overflowed_streams': self.viterbi_overflowed,
+                })
+        return context
+
+    def get_viterbi_times_context(self, exact_counts=False):
+        '''
+        Return a dictionary containing the time taken to decode streams
+        using the traffic model. If exact_counts is True, include the exact
+        number of streams and packets decoded.
+        '''
+        context = dict(self.viterbi_times)
+        if not exact_counts:
+            del context['stream_count']
+            del context['packet_count']
+        return context
+
+    # the number of events we send to a shard at a time
+    SHARD_BATCH_SIZE = 1000
+
+    # the messages we send to shards, each message is a (command, payload)
+    # tuple
+    # the payload is a (shard, aggregator_args, aggregator_kwargs, log_level)
+    # tuple, this is always the first message
+    SHARD_START = 'start'
+    # the payload is a newline-separated list of events, with space-separated
+    # items
+    SHARD_EVENTS = 'events'
+    # the payload is the rotation time, and the shard replies with its state
+    SHARD_ROTATE = 'rotate'
+    # the payload is None, and the shard replies with its counts
+    SHARD_STOP = 'stop'
+    # the payload is the start time of the current rotation window
+    SHARD_START_WINDOW = 'start_window'
+
+    # the messages shards send to us
+    # the payload is the shard's state context after a rotation
+    SHARD_STATE = 'state'
+    # the payload is the shard's counts
+    SHARD_COUNTS = 'counts'
+
+    # the command that runs a shard process, using the same python as us
+    SHARD_PYTHON_COMMAND = 'from privcount.data_collector import run_aggregator_shard; run_aggregator_shard()'
+
+    def _start_shards(self, shard_count, shard_args, shard_kwargs):
+        '''
+        Start shard_count processes, each running an Aggregator created using
+        shard_args and shard_kwargs.
+        The shards are new processes, rather than forks of this process, so
+        they don't inherit the reactor's file descriptors, signal handlers,
+        or threads.
+        '''
+        self.shard_protocols = []
+        self.shard_batches = []
+        self.shard_state_contexts = [None] * shard_count
+        self.paused_shards = set()
+        # make sure the shards import the same privcount as us
+        env = dict(os.environ)
+        python_paths = [PRIVCOUNT_PARENT_DIRECTORY]
+        if env.get('PYTHONPATH'):
+            python_paths.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(python_paths)
+        log_level = logging.getLogger().getEffectiveLevel()
+        for shard in xrange(shard_count):
+            protocol = AggregatorShardProtocol(self, shard)
+            reactor.spawnProcess(protocol, sys.executable,
+                                 args=[sys.executable, '-c',
+                                       Aggregator.SHARD_PYTHON_COMMAND],
+                                 env=env,
+                                 # messages on stdin and stdout, log lines
+                                 # on stderr
+                                 childFDs=dict([(0, 'w'), (1, 'r'),
+                                                (2, 'r')]))
+            protocol.send_message(Aggregator.SHARD_START,
+                                  (shard, shard_args, shard_kwargs,
+                                   log_level))
+            self.shard_protocols.append(protocol)
+            self.shard_batches.append([])
+        logging.info("Started {} aggregator shard processes"
+                     .format(shard_count))
+
+    def _send_shard_message(self, shard, command, payload):
+        '''
+        Send command and payload to shard.
+        The message is written when the shard's pipe is ready, so this never
+        blocks. If the shard falls behind, its protocol pauses our event
+        sources until the shard catches up.
+        Returns True on success, and False if the shard has failed.
+        '''
+        if not self.shard_protocols[shard].send_message(command, payload):
+            logging.warning("Failed to send {} to aggregator shard {}, it has exited"
+                            .format(command, shard))
+            return False
+        return True
+
+    def _send_shard_events(self, shard):
+        '''
+        Send the batched events for shard.
+        Returns True on success, and False if the shard has failed.
+        '''
+        batch = self.shard_batches[shard]
+        if len(batch) == 0:
+            return True
+        self.shard_batches[shard] = []
+        return self._send_shard_message(shard, Aggregator.SHARD_EVENTS,
+                                        "\n".join(batch))
+
+    def _send_shard_command(self, command, payload=None):
+        '''
+        Send the batched events for every shard, then send command and
+        payload to every shard.
+        Returns True on success, and False if any shard has failed.
+        '''
+        success = True
+        for shard in xrange(len(self.shard_protocols)):
+            if not self._send_shard_events(shard):
+                success = False
+            elif not self._send_shard_message(shard, command, payload):
+                success = False
+        return success
+
+    def _shard_event(self, event_code, items):
+        '''
+        Add the event to the batch for its shard, sending the batch if it is
+        full.
+        Returns False if the event has the wrong number of items, or its
+        shard has failed. Otherwise, returns True.
+        '''
+        expected_items = Aggregator.EVENT_ITEMS.get(event_code)
+        if expected_items is None:
+            return True
+        if len(items) != expected_items:
+            return False
+
+        # entry circuits are counted per client IP, so we send all the
+        # circuits from each client to the same shard
+        # different strings can represent the same IPv6 address, so we use
+        # the packed address
+        if event_code == CIRCUIT_EVENT and int(items[9]) > 0:
+            shard_key = pack_ip_address(items[8])
+        else:
+            # exit circuits, and their streams and stream bytes, have the
+            # same channel
+            shard_key = items[0]
+        shard = hash(shard_key) % len(self.shard_batches)
+
+        batch = self.shard_batches[shard]
+        batch.append(event_code + " " + " ".join(items))
+        if len(batch) >= Aggregator.SHARD_BATCH_SIZE:
+            return self._send_shard_events(shard)
+        return True
+
+    def _handle_shard_state(self, shard, state_context):
+        '''
+        Store state_context, the state context that shard sent after its
+        last rotation.
+        '''
+        self.shard_state_contexts[shard] = state_context
+
+    def _pause_events(self, shard):
+        '''
+        Stop reading events, because shard has fallen behind.
+        '''
+        if len(self.paused_shards) == 0:
+            logging.debug("Aggregator shard {} is behind, pausing events"
+                          .format(shard))
+            if self.protocol is not None and self.protocol.transport is not None:
+                self.protocol.transport.pauseProducing()
+            if self.event_log_task is not None:
+                self.event_log_task.pause()
+        self.paused_shards.add(shard)
+
+    def _resume_events(self, shard):
+        '''
+        Start reading events again, if no other shards are behind.
+        '''
+        if shard not in self.paused_shards:
+            return
+        self.paused_shards.remove(shard)
+        if len(self.paused_shards) == 0:
+            logging.debug("Aggregator shards have caught up, resuming events")
+            if self.protocol is not None and self.protocol.transport is not None:
+                self.protocol.transport.resumeProducing()
+            if self.event_log_task is not None:
+                self.event_log_task.resume()
+
+    def _stop_shards(self, counts_are_valid=True):
+        '''
+        Stop the shard processes.
+        If counts_are_valid, wait for each shard to process its events, and
+        add its counts to our counts. Otherwise, kill the shards.
+        Returns a Deferred that fires with True if the shard counts were
+        added, and False otherwise.
+        '''
+        shard_protocols = self.shard_protocols
+        shard_batches = self.shard_batches
+        self.shard_protocols = None
+        self.shard_batches = None
+        if not counts_are_valid:
+            for protocol in shard_protocols:
+                protocol.kill()
+            self._release_paused_events()
+            return defer.succeed(False)
+        # the shards need the events we have batched before they stop
+        counts_deferreds = []
+        for (shard, protocol) in enumerate(shard_protocols):
+            batch = shard_batches[shard]
+            if len(batch) > 0:
+                protocol.send_message(Aggregator.SHARD_EVENTS,
+                                      "\n".join(batch))
+            counts_deferreds.append(protocol.stop())
+        stop_deferred = defer.gatherResults(counts_deferreds)
+        stop_deferred.addCallback(self._add_shard_counts)
+        return stop_deferred
+
+    def _add_shard_counts(self, shard_counts_list):
+        '''
+        Add the counts from each shard in shard_counts_list to our counts.
+        Returns True if every shard's counts were added, and False otherwise.
+        '''
+        self._release_paused_events()
+        # we stopped counting while the shards were stopping
+        if self.secure_counters is None:
+            return False
+        for (shard, shard_counts) in enumerate(shard_counts_list):
+            # the counts are blinded, so we can only use them if every
+            # shard returns its counts
+            if (shard_counts is None or
+                not self.secure_counters.tally_counter(shard_counts)):
+                logging.warning("Invalid counts from aggregator shard {}, discarding all counts"
+                                .format(shard))
+                return False
+        return True
+
+    def _release_paused_events(self):
+        '''
+        Resume our event sources, if any shards paused them.
+        '''
+        for shard in list(self.paused_shards):
+            self._resume_events(shard)
+    def _build_stream_class_counters(self):
+        '''
+        Returns a list containing a tuple for each class in STREAM_CLASSES.
+        Each tuple contains an (increment method, bin index, inc index) item
+        for each configured counter in STREAM_CLASS_COUNTERS for that class,
+        and for all streams.
+        '''
+        stream_class_counters = []
+        for stream_class in STREAM_CLASSES:
+            class_counters = []
+            for (counter_name, bin_index, inc_index) in (
+                    STREAM_CLASS_COUNTERS['all'] +
+                    STREAM_CLASS_COUNTERS[stream_class]):
+                handle = self.counter_handles[counter_name]
+                # skip unconfigured counters
+                if handle is NULL_COUNTER_HANDLE:
+                    continue
+                class_counters.append((handle.increment, bin_index,
+                                       inc_index))
+            stream_class_counters.append(tuple(class_counters))
+        return stream_class_counters
+
+    def _build_processing_plan(self):
+        '''
+        Work out which events and event details are used by the configured
+        counters, using PRIVCOUNT_COUNTER_EVENTS, and store the results in
+        the plan_* instance variables. The event handlers skip parsing and
+        state tracking that no configured counter uses.
+        '''
+        counters = set(self.collection_counters.keys())
+        known_counters = counters.intersection(get_valid_counters())
+        self.plan_events = get_events_for_counters(known_counters)
+        if self.traffic_model is not None:
+            self.plan_events |= { BYTES_EVENT, STREAM_EVENT }
+        self.plan_circuit_streams = False
+        self.plan_entry_circuits = False
+        self.plan_client_ips = False
+        self.plan_exit_circuits = False
+        for counter in known_counters:
+            counter_events = PRIVCOUNT_COUNTER_EVENTS[counter]
+            if CIRCUIT_EVENT not in counter_events:
+                continue
+            # the counters that use stream and circuit events need circ_info,
+            # and they are all exit counters
+            if STREAM_EVENT in counter_events:
+                self.plan_circuit_streams = True
+                self.plan_exit_circuits = True
+            elif counter.startswith('Entry'):
+                self.plan_entry_circuits = True
+                # these counters are incremented in _do_rotate
+                if (counter.startswith('EntryClientIP') or
+                    counter.endswith('ClientIPCount')):
+                    self.plan_client_ips = True
+            elif counter.startswith('Exit'):
+                self.plan_exit_circuits = True
+        logging.info("Processing events: {}, circuit stream tracking: {}, entry circuits: {}, client IP tracking: {}, exit circuits: {}"
+                     .format(" ".join(sorted(self.plan_events)),
+                             self.plan_circuit_streams,
+                             self.plan_entry_circuits,
+                             self.plan_client_ips,
+                             self.plan_exit_circuits))
+
     def buildProtocol(self, addr):
         if self.protocol is not None:
             if self.protocol.isConnected():
@@ -427,7 +1442,11 @@ class Aggregator(ReconnectingClientFactory):
     def start(self):
         '''
         start the aggregator, and connect to the control port
+        If the event source is an event log, read events from the log instead
         '''
+        if self.event_log_path is not None:
+            self._start_event_log()
+            return
         # This call can return a list of connectors, or a single connector
         self.connector_list = connect(self, self.tor_control_port)
         # Twisted doesn't want a list of connectors, it only wants one
@@ -439,10 +1458,207 @@ class Aggregator(ReconnectingClientFactory):
         if self.protocol is not None:
             self.protocol.startCollection(self.collection_counters)
 
+    @staticmethod
+    def get_event_log_path(event_source):
+        '''
+        If event_source is an event log config, return its normalised path.
+        Otherwise, return None.
+        '''
+        if isinstance(event_source, dict) and 'event_log' in event_source:
+            return normalise_path(event_source['event_log'])
+        return None
+
+    @staticmethod
+    def get_event_log_files(event_log_path):
+        '''
+        If event_log_path is a directory, return a sorted list of the files
+        in it, skipping hidden files.
+        Otherwise, return a list containing event_log_path.
+        '''
+        if not os.path.isdir(event_log_path):
+            return [event_log_path]
+        event_log_files = []
+        for filename in sorted(os.listdir(event_log_path)):
+            file_path = os.path.join(event_log_path, filename)
+            if not filename.startswith('.') and os.path.isfile(file_path):
+                event_log_files.append(file_path)
+        return event_log_files
+
+    # the number of bytes we read from an event log at a time
+    # each read is processed without yielding to the reactor
+    EVENT_LOG_READ_SIZE = 64*1024
+
+    def _start_event_log(self):
+        '''
+        Add noise to the counters, then read the events in the event log, as
+        fast as the reactor allows.
+        '''
+        # there is no relay to tell us its fingerprint, so we use the
+        # configured fingerprint, or the default noise weight
+        fingerprint = self.tor_control_port.get('fingerprint')
+        if fingerprint is None or not self.set_fingerprint(fingerprint):
+            self.generate_noise()
+        # generating noise stops the round if we don't have a noise weight
+        if self.secure_counters is None:
+            return
+        event_log_files = Aggregator.get_event_log_files(self.event_log_path)
+        logging.info("Reading events from {} event log files in {}"
+                     .format(len(event_log_files), self.event_log_path))
+        self.event_log_start_time = time()
+        self.event_log_task = task.cooperate(
+            self.read_event_log(event_log_files))
+        event_log_deferred = self.event_log_task.whenDone()
+        event_log_deferred.addCallback(self._finish_event_log)
+        event_log_deferred.addErrback(lambda failure:
+                                      failure.trap(task.TaskStopped))
+        event_log_deferred.addErrback(errorCallback)
+
+    def read_event_log(self, event_log_files):
+        '''
+        A generator that reads the events in each file in event_log_files,
+        in order, and yields after each read.
+        Events have the same format as tor control port events, but the
+        leading "650 " is optional. Blank lines and lines starting with "#"
+        are ignored. Rotations happen at event times, rather than wall clock
+        times.
+        Stops when all the files have been read, or the counters have been
+        stopped.
+        '''
+        for event_log_file in event_log_files:
+            logging.info("Reading events from {}".format(event_log_file))
+            self.event_log_file_count += 1
+            with open(event_log_file, 'rb') as fin:
+                partial_line = ''
+                while True:
+                    data = fin.read(Aggregator.EVENT_LOG_READ_SIZE)
+                    if len(data) == 0:
+                        break
+                    self.event_log_read_bytes += len(data)
+                    lines = (partial_line + data).split('\n')
+                    partial_line = lines.pop()
+                    if not self._handle_event_log_lines(lines):
+                        return
+                    yield None
+                if (len(partial_line) > 0 and
+                    not self._handle_event_log_lines([partial_line])):
+                    return
+
+    def _handle_event_log_lines(self, lines):
+        '''
+        Handle the events in lines from an event log, logging and skipping
+        any invalid events.
+        Rotations happen before the first event that ends after the rotation
+        time, so they don't depend on how the log is split into files or
+        reads.
+        Returns False if the counters have been stopped, and True otherwise.
+        '''
+        handle_event = self.handle_event
+        event_time_index = Aggregator.EVENT_TIME_INDEX
+        next_rotate_time = self.event_log_next_rotate_time
+        if next_rotate_time is None:
+            next_rotate_time = float('-inf')
+        for line in lines:
+            items = line.split()
+            if len(items) == 0 or items[0].startswith('#'):
+                continue
+            if items[0] == '650':
+                items = items[1:]
+            self.event_log_line_count += 1
+            time_index = event_time_index.get(items[0])
+            if time_index is not None:
+                try:
+                    event_time = float(items[time_index + 1])
+                except (ValueError, IndexError):
+                    event_time = None
+                if (event_time is not None and
+                    event_time >= next_rotate_time and
+                    not math.isinf(event_time)):
+                    self._rotate_to_event_time(event_time)
+                    next_rotate_time = self.event_log_next_rotate_time
+            if not handle_event(items):
+                if self.secure_counters is None:
+                    return False
+                self.event_log_rejected_count += 1
+                logging.warning("Skipping invalid event in event log: {}"
+                                .format(line.strip()))
+        return True
+
+    def _rotate_to_event_time(self, event_time):
+        '''
+        Do any rotations that happened before event_time. The first event
+        time starts the first rotation window.
+        If there is a long gap between events, skip the rotations after all
+        the client IP and circuit state has expired.
+        '''
+        if self.event_log_next_rotate_time is None:
+            self._start_rotation_window(event_time)
+            self.event_log_next_rotate_time = event_time + self.rotate_period
+        if event_time < self.event_log_next_rotate_time:
+            return
+        rotate_count = int((event_time - self.event_log_next_rotate_time) //
+                           self.rotate_period) + 1
+        # two rotations count all the client IPs, and a full turn of the
+        # timing wheels expires all the state
+        max_rotate_count = max(2, self.circ_info_wheel.timeout_ticks)
+        if rotate_count > max_rotate_count:
+            logging.warning("Skipping {} rotations in a gap between events in the event log, before event time {}"
+                            .format(rotate_count - max_rotate_count,
+                                    event_time))
+        for i in xrange(rotate_count - min(rotate_count, max_rotate_count),
+                        rotate_count):
+            self._do_rotate(rotate_time=(self.event_log_next_rotate_time +
+                                         i*self.rotate_period))
+        self.event_log_next_rotate_time += rotate_count*self.rotate_period
+        # very large times don't have enough precision for the rotate period
+        if event_time >= self.event_log_next_rotate_time:
+            self.event_log_next_rotate_time = float('inf')
+
+    def _finish_event_log(self, _):
+        '''
+        Log a summary of the event log, after it has been read.
+        '''
+        self.event_log_task = None
+        self.event_log_end_time = time()
+        logging.info("Finished reading {} events ({} invalid) from {} event log files in {:.1f} seconds"
+                     .format(self.event_log_line_count,
+                             self.event_log_rejected_count,
+                             self.event_log_file_count,
+                             self.event_log_end_time -
+                             self.event_log_start_time))
+
+    def get_event_log_context(self, exact_counts=False):
+        '''
+        Return a dictionary containing the event log progress.
+        If exact_counts is True, include the exact number of bytes and lines
+        read, and rejected events.
+        '''
+        context = {
+            'path': self.event_log_path,
+            'file_count': self.event_log_file_count,
+            'start_time': self.event_log_start_time,
+            'end_time': self.event_log_end_time,
+            }
+        if exact_counts:
+            context.update({
+                'read_bytes': self.event_log_read_bytes,
+                'line_count': self.event_log_line_count,
+                'rejected_count': self.event_log_rejected_count,
+                })
+        return context
+
     def _stop_protocol(self):
         '''
         Stop protocol and connection activities.
         '''
+        # stop reading the event log
+        if self.event_log_task is not None:
+            event_log_task = self.event_log_task
+            self.event_log_task = None
+            try:
+                event_log_task.stop()
+            except task.TaskDone:
+                pass
+
         # don't try to reconnect
         self.stopTrying()
 
@@ -461,11 +1677,48 @@ class Aggregator(ReconnectingClientFactory):
 
     def _stop_secure_counters(self, counts_are_valid=True):
         '''
-        If counts_are_valid, detach and return the counts from secure counters.
-        Otherwise, return None.
+        If counts_are_valid, wait for the viterbi pool to decode its queued
+        streams, and for the counts from each shard, then detach the counts
+        from secure counters. Otherwise, delete the counts immediately, and
+        discard the queued streams.
+        Returns a Deferred that fires with the counts, or None if the counts
+        are not valid.
         '''
         # if we've already stopped counting due to an error, there are no
         # counters
+        if self.secure_counters is None:
+            return defer.succeed(None)
+
+        if not counts_are_valid:
+            if self.shard_protocols is not None:
+                stop_deferred = self._stop_shards(counts_are_valid=False)
+            else:
+                stop_deferred = defer.succeed(False)
+            # the counters are deleted immediately, so the viterbi pool
+            # discards the streams in its queue
+            stop_deferred.addCallback(self._detach_counts)
+            self._drain_viterbi_pool().addCallback(
+                lambda _: self._stop_viterbi_pool())
+            return stop_deferred
+
+        # wait for any streams that are being decoded
+        stop_deferred = self._drain_viterbi_pool()
+        stop_deferred.addCallback(lambda _: self._stop_viterbi_pool())
+        # add the counts from each shard to our counts
+        if self.shard_protocols is not None:
+            stop_deferred.addCallback(
+                lambda _: self._stop_shards(counts_are_valid=True))
+        else:
+            stop_deferred.addCallback(lambda _: True)
+        stop_deferred.addCallback(self._detach_counts)
+        return stop_deferred
+
+    def _detach_counts(self, counts_are_valid):
+        '''
+        If counts_are_valid, detach and return the counts from secure counters.
+        Otherwise, return None.
+        '''
+        # we stopped counting due to an error while we were waiting
         if self.secure_counters is None:
             return None
 
@@ -474,6 +1727,7 @@ class Aggregator(ReconnectingClientFactory):
         # TODO: secure delete?
         del self.secure_counters
         self.secure_counters = None
+        self.counter_handles = None
         if counts_are_valid:
             return counts
         else:
@@ -483,8 +1737,9 @@ class Aggregator(ReconnectingClientFactory):
         '''
         Stop counting, and stop connecting to the ControlPort and Tally Server.
         Retrieve the counts, and delete the counters.
-        If counts_are_valid is True, return the counts.
-        Otherwise, return None.
+        Returns a Deferred that fires when any shards have sent their counts.
+        If counts_are_valid is True, it fires with the counts. Otherwise, it
+        fires with None.
         '''
         # make sure we added noise
         if self.noise_weight_value is None and counts_are_valid:
@@ -494,6 +1749,10 @@ class Aggregator(ReconnectingClientFactory):
         # stop trying to collect data
         self._stop_protocol()
 
+        if self.pending_rotations > 0:
+            logging.warning("Stopping with {} client IP rotations in progress, their client IPs will not be counted"
+                            .format(self.pending_rotations))
+
         # stop using the counters
         return self._stop_secure_counters(counts_are_valid=counts_are_valid)
 
@@ -771,9 +2030,13 @@ class Aggregator(ReconnectingClientFactory):
         '''
         return self.fingerprint
 
-    def get_context(self):
+    def get_context(self, exact_counts=False):
         '''
         return a dictionary containing each available context item
+        If exact_counts is True, include the exact number of events,
+        circuits, and streams that we have processed. These counts are not
+        blinded or noised, so they should only be sent to the tally server
+        on test networks.
         '''
         context = {}
         if self.get_nickname() is not None:
@@ -794,6 +2057,20 @@ class Aggregator(ReconnectingClientFactory):
             context['last_event_time'] = self.last_event_time
         if self.noise_weight_value is not None:
             context['noise_weight_value'] = self.noise_weight_value
+        if exact_counts:
+            context['event_state'] = self.get_state_context()
+        context['event_stats'] = self.get_event_stats_context(
+            exact_counts=exact_counts)
+        if self.shard_state_contexts is not None:
+            context['aggregator_shards'] = len(self.shard_state_contexts)
+        if self.event_log_path is not None:
+            context['event_log'] = self.get_event_log_context(
+                exact_counts=exact_counts)
+        if self.traffic_model is not None:
+            context['viterbi_queue'] = self.get_viterbi_context(
+                exact_counts=exact_counts)
+            context['viterbi_times'] = self.get_viterbi_times_context(
+                exact_counts=exact_counts)
         return context
 
     def handle_event(self, event):
@@ -805,9 +2082,79 @@ class Aggregator(ReconnectingClientFactory):
             return False
 
         event_code, items = event[0], event[1:]
-        self.last_event_time = time()
+        event_start_time = time()
+        self.last_event_time = event_start_time
+
+        stats = self.event_stats.get(event_code)
+        if stats is None:
+            stats = EventStats()
+            self.event_stats[event_code] = stats
+        stats.received_count += 1
+
+        # skip events when no counter uses them
+        if event_code not in self.plan_events:
+            stats.skipped_count += 1
+            return True
+
+        # the shards process the events
+        if self.shard_batches is not None:
+            is_handled = self._shard_event(event_code, items)
+        else:
+            is_handled = self._dispatch_event(event_code, items)
+
+        if not is_handled:
+            stats.rejected_count += 1
+            return False
+        stats.handled_count += 1
+
+        # timing every event would slow down event processing, so we only
+        # time a sample of the handled events
+        self.event_stats_countdown -= 1
+        if self.event_stats_countdown <= 0:
+            self.event_stats_countdown = \
+                Aggregator.EVENT_STATS_SAMPLE_INTERVAL
+            Aggregator._sample_event_time(stats, event_code, items,
+                                          event_start_time)
+        return True
+
+    # time one in every EVENT_STATS_SAMPLE_INTERVAL handled events
+    EVENT_STATS_SAMPLE_INTERVAL = 16
 
-        # hand valid events off to the aggregator
+    @staticmethod
+    def _sample_event_time(stats, event_code, items, event_start_time):
+        '''
+        Add the latency and lag for the handled event_code event with items
+        to stats. The event was received at event_start_time.
+        '''
+        event_end_time = time()
+        stats.add_latency(event_end_time - event_start_time)
+        # the handler has checked the number of items, but it might not have
+        # parsed the end time
+        time_index = Aggregator.EVENT_TIME_INDEX.get(event_code)
+        if time_index is not None:
+            try:
+                stats.add_lag(event_end_time - float(items[time_index]))
+            except ValueError:
+                pass
+
+    def handle_events(self, events):
+        '''
+        Handle each event in events, in order.
+        Returns True if every event was handled. Returns False as soon as an
+        event fails, without handling the rest of the events.
+        '''
+        handle_event = self.handle_event
+        for event in events:
+            if not handle_event(event):
+                return False
+        return True
+
+    def _dispatch_event(self, event_code, items):
+        '''
+        Hand the event off to the handler for event_code.
+        Returns False if the event has the wrong number of items, or the
+        handler fails.
+        '''
         if event_code == 'PRIVCOUNT_STREAM_BYTES_TRANSFERRED':
             if len(items) == Aggregator.STREAM_BYTES_ITEMS:
                 return self._handle_bytes_event(items[:Aggregator.STREAM_BYTES_ITEMS])
@@ -852,8 +2199,23 @@ class Aggregator(ReconnectingClientFactory):
         # TODO: secure delete
         #del items
 
-        self.strm_bytes.setdefault(strmid, {}).setdefault(circid, [])
-        self.strm_bytes[strmid][circid].append([bw_bytes, is_outbound, ts])
+        packet_buffer = self.strm_bytes.setdefault(strmid, {}).get(circid)
+        if packet_buffer is None:
+            packet_buffer = StreamPacketBuffer()
+            self.strm_bytes[strmid][circid] = packet_buffer
+        packet_buffer.last_tick = self.strm_bytes_wheel.touch(
+            (strmid, circid), packet_buffer.last_tick)
+        packet_buffer.add_bytes_event(bw_bytes, is_outbound, ts)
+
+        # if the stream has too many packets, process the packets we have,
+        # and keep the time of the last packet for the next delay
+        if packet_buffer.packet_count >= self.stream_packet_limit:
+            logging.info("Stream packet limit: processing the first {} buffered packets before the stream ends"
+                         .format(self.stream_packet_limit))
+            # we don't know when the stream started, so the first packet
+            # has no delay
+            self._process_packet_buffer(None, packet_buffer)
+            packet_buffer.clear_packets()
         return True
 
     STREAM_ENDED_ITEMS = 10
@@ -875,149 +2237,74 @@ class Aggregator(ReconnectingClientFactory):
         if readbw < 0 or writebw < 0 or totalbw <= 0:
             return True
 
-        self.circ_info.setdefault(chanid, {}).setdefault(circid, {'num_streams': {'interactive':0, 'web':0, 'p2p':0, 'other':0}, 'stream_starttimes': {'interactive':[], 'web':[], 'p2p':[], 'other':[]}})
-
-        stream_class = Aggregator._classify_port(port)
-        self.circ_info[chanid][circid]['num_streams'][stream_class] += 1
-        self.circ_info[chanid][circid]['stream_starttimes'][stream_class].append(start)
-
-        # the amount we read from the stream is bound for the client
-        # the amount we write to the stream is bound to the server
-        ratio = Aggregator._encode_ratio(readbw, writebw)
-        lifetime = end-start
-
-        self.secure_counters.increment('ExitStreamCount',
-                                       bin=SINGLE_BIN,
-                                       inc=1)
-        self.secure_counters.increment('ExitStreamByteCount',
-                                       bin=SINGLE_BIN,
-                                       inc=totalbw)
-        self.secure_counters.increment('ExitStreamOutboundByteCount',
-                                       bin=writebw,
-                                       inc=1)
-        self.secure_counters.increment('ExitStreamInboundByteCount',
-                                       bin=readbw,
-                                       inc=1)
-        self.secure_counters.increment('ExitStreamByteRatio',
-                                       bin=ratio,
-                                       inc=1)
-        self.secure_counters.increment('ExitStreamLifeTime',
-                                       bin=lifetime,
-                                       inc=1)
-
-        if stream_class == 'web':
-            self.secure_counters.increment('ExitWebStreamCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
-            self.secure_counters.increment('ExitWebStreamByteCount',
-                                           bin=SINGLE_BIN,
-                                           inc=totalbw)
-            self.secure_counters.increment('ExitWebStreamOutboundByteCount',
-                                           bin=writebw,
-                                           inc=1)
-            self.secure_counters.increment('ExitWebStreamInboundByteCount',
-                                           bin=readbw,
-                                           inc=1)
-            self.secure_counters.increment('ExitWebStreamByteRatio',
-                                           bin=ratio,
-                                           inc=1)
-            self.secure_counters.increment('ExitWebStreamLifeTime',
-                                           bin=lifetime,
-                                           inc=1)
-        elif stream_class == 'interactive':
-            self.secure_counters.increment('ExitInteractiveStreamCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
-            self.secure_counters.increment('ExitInteractiveStreamByteCount',
-                                           bin=SINGLE_BIN,
-                                           inc=totalbw)
-            self.secure_counters.increment('ExitInteractiveStreamOutboundByteCount',
-                                           bin=writebw,
-                                           inc=1)
-            self.secure_counters.increment('ExitInteractiveStreamInboundByteCount',
-                                           bin=readbw,
-                                           inc=1)
-            self.secure_counters.increment('ExitInteractiveStreamByteRatio',
-                                           bin=ratio,
-                                           inc=1)
-            self.secure_counters.increment('ExitInteractiveStreamLifeTime',
-                                           bin=lifetime,
-                                           inc=1)
-        elif stream_class == 'p2p':
-            self.secure_counters.increment('ExitP2PStreamCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
-            self.secure_counters.increment('ExitP2PStreamByteCount',
-                                           bin=SINGLE_BIN,
-                                           inc=totalbw)
-            self.secure_counters.increment('ExitP2PStreamOutboundByteCount',
-                                           bin=writebw,
-                                           inc=1)
-            self.secure_counters.increment('ExitP2PStreamInboundByteCount',
-                                           bin=readbw,
-                                           inc=1)
-            self.secure_counters.increment('ExitP2PStreamByteRatio',
-                                           bin=ratio,
-                                           inc=1)
-            self.secure_counters.increment('ExitP2PStreamLifeTime',
-                                           bin=lifetime,
-                                           inc=1)
-        elif stream_class == 'other':
-            self.secure_counters.increment('ExitOtherPortStreamCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
-            self.secure_counters.increment('ExitOtherPortStreamByteCount',
-                                           bin=SINGLE_BIN,
-                                           inc=totalbw)
-            self.secure_counters.increment('ExitOtherPortStreamOutboundByteCount',
-                                           bin=writebw,
-                                           inc=1)
-            self.secure_counters.increment('ExitOtherPortStreamInboundByteCount',
-                                           bin=readbw,
-                                           inc=1)
-            self.secure_counters.increment('ExitOtherPortStreamByteRatio',
-                                           bin=ratio,
-                                           inc=1)
-            self.secure_counters.increment('ExitOtherPortStreamLifeTime',
-                                           bin=lifetime,
-                                           inc=1)
+        class_id = Aggregator._get_port_class_id(port, self.port_class_table)
+
+        if self.plan_circuit_streams:
+            circ = self.circ_info.setdefault(chanid, {}).setdefault(circid, {'num_streams': {'interactive':0, 'web':0, 'p2p':0, 'other':0}, 'stream_starttimes': {'interactive':[], 'web':[], 'p2p':[], 'other':[]}, 'last_tick': None})
+            circ['last_tick'] = self.circ_info_wheel.touch((chanid, circid),
+                                                           circ['last_tick'])
+            stream_class = STREAM_CLASSES[class_id]
+            circ['num_streams'][stream_class] += 1
+            circ['stream_starttimes'][stream_class].append(start)
+
+        class_counters = self.stream_class_counters[class_id]
+        if len(class_counters) > 0:
+            # the amount we read from the stream is bound for the client
+            # the amount we write to the stream is bound to the server
+            ratio = Aggregator._encode_ratio(readbw, writebw)
+            lifetime = end-start
+
+            # increment the configured counters for all streams, and this
+            # class
+            # the values are in STREAM_SINGLE_BIN, ..., STREAM_LIFETIME order
+            values = (SINGLE_BIN, 1, totalbw, writebw, readbw, ratio, lifetime)
+            for (increment, bin_index, inc_index) in class_counters:
+                increment(values[bin_index], values[inc_index])
 
         # if we have a traffic model object, then we should use our observations to find the
         # most likely path through the HMM, and then count some aggregate statistics
         # about that path
         if self.traffic_model is not None and strmid in self.strm_bytes and circid in self.strm_bytes[strmid]:
-            byte_events = self.strm_bytes[strmid][circid]
+            packet_buffer = self.strm_bytes[strmid][circid]
             strm_start_ts = start
             # let the model handle the model-specific counter increments
-            self.traffic_model.increment_traffic_counters(strm_start_ts, byte_events, self.secure_counters)
+            if packet_buffer.packet_count > 0:
+                self._process_packet_buffer(strm_start_ts, packet_buffer)
 
         # clear all 'traffic' data for this stream
         # TODO: secure delete
         if strmid in self.strm_bytes:
-            self.strm_bytes[strmid].pop(circid, None)
+            packet_buffer = self.strm_bytes[strmid].pop(circid, None)
+            if packet_buffer is not None:
+                self.strm_bytes_wheel.remove((strmid, circid),
+                                             packet_buffer.last_tick)
             if len(self.strm_bytes[strmid]) == 0:
                 self.strm_bytes.pop(strmid, None)
         return True
 
     @staticmethod
-    def _classify_port(port):
+    def _get_port_class_id(port, port_class_table=None):
         '''
-        Classify port into web, interactive, p2p, or other.
+        Returns the index in STREAM_CLASSES of the class of port, using
+        port_class_table from build_port_class_table(). If port_class_table
+        is None, use the default port classes.
         '''
-        p2p_ports = [1214]
-        for p in xrange(4661, 4666+1): p2p_ports.append(p)
-        for p in xrange(6346, 6429+1): p2p_ports.append(p)
-        p2p_ports.append(6699)
-        for p in xrange(6881, 6999+1): p2p_ports.append(p)
-
-        if port in [80, 443]:
-            return 'web'
-        elif port in [22, 194, 994, 6660, 6661, 6662, 6663, 6664, 6665, 6666, 6667, 6668, 6669, 6670, 6679, 6697, 7000]:
-            return 'interactive'
-        elif port in p2p_ports:
-            return 'p2p'
+        if port_class_table is None:
+            port_class_table = DEFAULT_PORT_CLASS_TABLE
+        if port >= 0 and port < len(port_class_table):
+            return port_class_table[port]
         else:
-            return 'other'
+            # 'other'
+            return 0
+
+    @staticmethod
+    def _classify_port(port, port_class_table=None):
+        '''
+        Classify port into web, interactive, p2p, or other.
+        See _get_port_class_id() for details.
+        '''
+        return STREAM_CLASSES[Aggregator._get_port_class_id(port,
+                                                            port_class_table)]
 
     @staticmethod
     def _encode_ratio(inval, outval):
@@ -1059,11 +2346,19 @@ class Aggregator(ReconnectingClientFactory):
     # 'PRIVCOUNT_CIRCUIT_ENDED', ChanID, CircID, NCellsIn, NCellsOut, ReadBWExit, WriteBWExit, TimeStart, TimeEnd, PrevIP, PrevIsClient, NextIP, NextIsEdge
     def _handle_circuit_event(self, items):
         assert(len(items) == Aggregator.CIRCUIT_ENDED_ITEMS)
+        handles = self.counter_handles
+
+        # skip circuits when no counter uses them
+        prevIsClient = True if int(items[9]) > 0 else False
+        if prevIsClient:
+            if not self.plan_entry_circuits:
+                return True
+        elif not self.plan_exit_circuits:
+            return True
 
         chanid, circid, ncellsin, ncellsout, readbwexit, writebwexit = [int(v) for v in items[0:6]]
         start, end = float(items[6]), float(items[7])
         previp = items[8]
-        prevIsClient = True if int(items[9]) > 0 else False
         nextip = items[10]
         nextIsEdge = True if int(items[11]) > 0 else False
 
@@ -1074,58 +2369,60 @@ class Aggregator(ReconnectingClientFactory):
         # stream bw info is only avail on exits
         if prevIsClient:
             # prev hop is a client, we are entry
-            self.secure_counters.increment('EntryCircuitCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
+            handles['EntryCircuitCount'].increment(bin=SINGLE_BIN,
+                                                   inc=1)
 
             # only count cells ratio on active circuits with legitimate transfers
             is_active = True if ncellsin + ncellsout >= 8 else False
             if is_active:
-                self.secure_counters.increment('EntryActiveCircuitCount',
-                                               bin=SINGLE_BIN,
-                                               inc=1)
-                self.secure_counters.increment('EntryCircuitInboundCellCount',
-                                               bin=ncellsin,
-                                               inc=1)
-                self.secure_counters.increment('EntryCircuitOutboundCellCount',
-                                               bin=ncellsout,
-                                               inc=1)
-                self.secure_counters.increment('EntryCircuitCellRatio', bin=Aggregator._encode_ratio(ncellsin, ncellsout), inc=1)
+                handles['EntryActiveCircuitCount'].increment(bin=SINGLE_BIN,
+                                                             inc=1)
+                handles['EntryCircuitInboundCellCount'].increment(bin=ncellsin,
+                                                                  inc=1)
+                handles['EntryCircuitOutboundCellCount'].increment(bin=ncellsout,
+                                                                   inc=1)
+                handles['EntryCircuitCellRatio'].increment(bin=Aggregator._encode_ratio(ncellsin, ncellsout),
+                                                           inc=1)
             else:
-                self.secure_counters.increment('EntryInactiveCircuitCount',
-                                               bin=SINGLE_BIN,
-                                               inc=1)
+                handles['EntryInactiveCircuitCount'].increment(bin=SINGLE_BIN,
+                                                               inc=1)
+
+            if not self.plan_client_ips:
+                return True
 
             # count unique client ips
+            # IP addresses are stored in packed form, to save memory
+            ip_key = pack_ip_address(previp)
             # we saw this client within current rotation window
-            self.cli_ips_current.setdefault(previp, {'is_active':False})
+            client = self.cli_ips_current.get(ip_key)
+            if client is None:
+                client = ClientIPRecord()
+                self.cli_ips_current[ip_key] = client
             if is_active:
-                self.cli_ips_current[previp]['is_active'] = True
+                client.is_active = True
             if start < self.cli_ips_rotated:
                 # we also saw the client in the previous rotation window
-                self.cli_ips_previous.setdefault(previp, {'is_active':False})
+                # (but we don't count its circuits in that window)
+                previous_client = self.cli_ips_previous.get(ip_key)
+                if previous_client is None:
+                    previous_client = ClientIPRecord()
+                    self.cli_ips_previous[ip_key] = previous_client
                 if is_active:
-                    self.cli_ips_previous[previp]['is_active'] = True
+                    previous_client.is_active = True
 
             # count number of completed circuits per client
-            self.cli_ips_current[previp].setdefault('num_active_completed',
-                                                    0)
-            self.cli_ips_current[previp].setdefault('num_inactive_completed',
-                                                    0)
             if is_active:
-                self.cli_ips_current[previp]['num_active_completed'] += 1
+                client.num_active_completed += 1
             else:
-                self.cli_ips_current[previp]['num_inactive_completed'] += 1
+                client.num_inactive_completed += 1
 
         elif nextIsEdge:
             # prev hop is a relay and next is an edge connection, we are exit
             # don't count single-hop exits
-            self.secure_counters.increment('ExitCircuitCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
-            self.secure_counters.increment('ExitCircuitLifeTime',
-                                           bin=(end - start),
-                                           inc=1)
+            handles['ExitCircuitCount'].increment(bin=SINGLE_BIN,
+                                                  inc=1)
+            handles['ExitCircuitLifeTime'].increment(bin=(end - start),
+                                                     inc=1)
 
             # check if we have any stream info in this circuit
             circ_is_known, has_completed_stream = False, False
@@ -1136,86 +2433,60 @@ class Aggregator(ReconnectingClientFactory):
 
             if circ_is_known and has_completed_stream:
                 # we have circuit info and at least one stream ended on it
-                self.secure_counters.increment('ExitActiveCircuitCount',
-                                               bin=SINGLE_BIN,
-                                               inc=1)
-                self.secure_counters.increment('ExitActiveCircuitLifeTime',
-                                               bin=(end - start),
-                                               inc=1)
+                handles['ExitActiveCircuitCount'].increment(bin=SINGLE_BIN,
+                                                            inc=1)
+                handles['ExitActiveCircuitLifeTime'].increment(bin=(end - start),
+                                                               inc=1)
 
                 # convenience
                 counts = self.circ_info[chanid][circid]['num_streams']
                 times = self.circ_info[chanid][circid]['stream_starttimes']
 
                 # first increment general counters
-                self.secure_counters.increment('ExitCircuitStreamCount',
-                                               bin=sum(counts.values()),
-                                               inc=1)
-                for isct in Aggregator._compute_interstream_creation_times(times['web'] + times['interactive'] + times['p2p'] + times['other']):
-                    self.secure_counters.increment('ExitCircuitInterStreamCreationTime',
-                                                   bin=isct,
-                                                   inc=1)
+                handles['ExitCircuitStreamCount'].increment(bin=sum(counts.values()),
+                                                            inc=1)
+                handles['ExitCircuitInterStreamCreationTime'].increment_many(Aggregator._compute_interstream_creation_times(times['web'] + times['interactive'] + times['p2p'] + times['other']))
 
                 # now only increment the classes that have positive counts
                 if counts['web'] > 0:
-                    self.secure_counters.increment('ExitWebCircuitCount',
-                                                   bin=SINGLE_BIN,
-                                                   inc=1)
-                    self.secure_counters.increment('ExitCircuitWebStreamCount',
-                                                   bin=counts['web'],
-                                                   inc=1)
-                    for isct in Aggregator._compute_interstream_creation_times(times['web']):
-                        self.secure_counters.increment('ExitCircuitWebInterStreamCreationTime',
-                                                       bin=isct,
-                                                       inc=1)
+                    handles['ExitWebCircuitCount'].increment(bin=SINGLE_BIN,
+                                                             inc=1)
+                    handles['ExitCircuitWebStreamCount'].increment(bin=counts['web'],
+                                                                   inc=1)
+                    handles['ExitCircuitWebInterStreamCreationTime'].increment_many(Aggregator._compute_interstream_creation_times(times['web']))
                 if counts['interactive'] > 0:
-                    self.secure_counters.increment('ExitInteractiveCircuitCount',
-                                                   bin=SINGLE_BIN,
-                                                   inc=1)
-                    self.secure_counters.increment('ExitCircuitInteractiveStreamCount',
-                                                   bin=counts['interactive'],
-                                                   inc=1)
-                    for isct in Aggregator._compute_interstream_creation_times(times['interactive']):
-                        self.secure_counters.increment('ExitCircuitInteractiveInterStreamCreationTime',
-                                                       bin=isct,
-                                                       inc=1)
+                    handles['ExitInteractiveCircuitCount'].increment(bin=SINGLE_BIN,
+                                                                     inc=1)
+                    handles['ExitCircuitInteractiveStreamCount'].increment(bin=counts['interactive'],
+                                                                           inc=1)
+                    handles['ExitCircuitInteractiveInterStreamCreationTime'].increment_many(Aggregator._compute_interstream_creation_times(times['interactive']))
                 if counts['p2p'] > 0:
-                    self.secure_counters.increment('ExitP2PCircuitCount',
-                                                   bin=SINGLE_BIN,
-                                                   inc=1)
-                    self.secure_counters.increment('ExitCircuitP2PStreamCount',
-                                                   bin=counts['p2p'],
-                                                   inc=1)
-                    for isct in Aggregator._compute_interstream_creation_times(times['p2p']):
-                        self.secure_counters.increment('ExitCircuitP2PInterStreamCreationTime',
-                                                       bin=isct,
-                                                       inc=1)
+                    handles['ExitP2PCircuitCount'].increment(bin=SINGLE_BIN,
+                                                             inc=1)
+                    handles['ExitCircuitP2PStreamCount'].increment(bin=counts['p2p'],
+                                                                   inc=1)
+                    handles['ExitCircuitP2PInterStreamCreationTime'].increment_many(Aggregator._compute_interstream_creation_times(times['p2p']))
                 if counts['other'] > 0:
-                    self.secure_counters.increment('ExitOtherPortCircuitCount',
-                                                   bin=SINGLE_BIN,
-                                                   inc=1)
-                    self.secure_counters.increment('ExitCircuitOtherPortStreamCount',
-                                                   bin=counts['other'],
-                                                   inc=1)
-                    for isct in Aggregator._compute_interstream_creation_times(times['other']):
-                        self.secure_counters.increment('ExitCircuitOtherPortInterStreamCreationTime',
-                                                       bin=isct,
-                                                       inc=1)
+                    handles['ExitOtherPortCircuitCount'].increment(bin=SINGLE_BIN,
+                                                                   inc=1)
+                    handles['ExitCircuitOtherPortStreamCount'].increment(bin=counts['other'],
+                                                                         inc=1)
+                    handles['ExitCircuitOtherPortInterStreamCreationTime'].increment_many(Aggregator._compute_interstream_creation_times(times['other']))
 
             else:
                 # either we dont know circ, or no streams ended on it
-                self.secure_counters.increment('ExitInactiveCircuitCount',
-                                               bin=SINGLE_BIN,
-                                               inc=1)
-                self.secure_counters.increment('ExitInactiveCircuitLifeTime',
-                                               bin=(end - start),
-                                               inc=1)
+                handles['ExitInactiveCircuitCount'].increment(bin=SINGLE_BIN,
+                                                              inc=1)
+                handles['ExitInactiveCircuitLifeTime'].increment(bin=(end - start),
+                                                                 inc=1)
 
             # cleanup
             # TODO: secure delete
             if circ_is_known:
                 # remove circ from channel
-                self.circ_info[chanid].pop(circid, None)
+                circ = self.circ_info[chanid].pop(circid)
+                self.circ_info_wheel.remove((chanid, circid),
+                                            circ['last_tick'])
                 # if that was the last circuit on channel, remove the channel too
                 if len(self.circ_info[chanid]) == 0:
                     self.circ_info.pop(chanid, None)
@@ -1223,9 +2494,26 @@ class Aggregator(ReconnectingClientFactory):
 
     CONNECTION_ENDED_ITEMS = 5
 
+    # the number of items in each event, without the event code
+    EVENT_ITEMS = {
+        BYTES_EVENT: STREAM_BYTES_ITEMS,
+        STREAM_EVENT: STREAM_ENDED_ITEMS,
+        CIRCUIT_EVENT: CIRCUIT_ENDED_ITEMS,
+        CONNECTION_EVENT: CONNECTION_ENDED_ITEMS,
+    }
+
+    # the index of the end time item in each event, without the event code
+    EVENT_TIME_INDEX = {
+        BYTES_EVENT: 5,
+        STREAM_EVENT: 7,
+        CIRCUIT_EVENT: 7,
+        CONNECTION_EVENT: 2,
+    }
+
     # 'PRIVCOUNT_CONNECTION_ENDED', ChanID, TimeStart, TimeEnd, IP, isClient
     def _handle_connection_event(self, items):
         assert(len(items) == Aggregator.CONNECTION_ENDED_ITEMS)
+        handles = self.counter_handles
 
         chanid = int(items[0])
         start, end = float(items[1]), float(items[2])
@@ -1236,59 +2524,493 @@ class Aggregator(ReconnectingClientFactory):
         #del items
 
         if isclient:
-            self.secure_counters.increment('EntryConnectionCount',
-                                           bin=SINGLE_BIN,
-                                           inc=1)
-            self.secure_counters.increment('EntryConnectionLifeTime',
-                                           bin=(end - start),
-                                           inc=1)
+            handles['EntryConnectionCount'].increment(bin=SINGLE_BIN,
+                                                      inc=1)
+            handles['EntryConnectionLifeTime'].increment(bin=(end - start),
+                                                         inc=1)
         return True
 
-    def _do_rotate(self):
+    def _start_rotation_window(self, start_time):
+        '''
+        Start the current rotation window at start_time, rather than the
+        time the aggregator was created. Used when the event times are not
+        the current time.
+        '''
+        self.cli_ips_rotated = start_time
+        if self.shard_protocols is not None:
+            self._send_shard_command(Aggregator.SHARD_START_WINDOW,
+                                     start_time)
+
+    def _do_rotate(self, rotate_time=None):
         '''
         This function is called using LoopingCall, so any exceptions will be
         turned into log messages.
+        If rotate_time is not None, use it as the rotation time, rather than
+        the current time.
         '''
         logging.info("rotating circuit window now, {}".format(format_last_event_time_since(self.last_event_time)))
 
+        # the shards rotate their own state, after processing the events we
+        # have already sent them, then send us their state context
+        if self.shard_protocols is not None:
+            self.cli_ips_rotated = time() if rotate_time is None else rotate_time
+            self.num_rotations += 1
+            self._send_shard_command(Aggregator.SHARD_ROTATE,
+                                     self.cli_ips_rotated)
+            return
+
         # it is safe to count the first rotation, because Tor only sends us
         # events that started inside the collection period
-        client_ips_active = 0
-        client_ips_inactive = 0
-
         # cli_ips_previous are the IPs from 2*period to period seconds ago,
         # or are empty for the first rotation
-        for ip in self.cli_ips_previous:
-            client = self.cli_ips_previous[ip]
-
-            if client['is_active']:
-                client_ips_active += 1
-            else:
-                client_ips_inactive += 1
-
-            num_active_completed = client.get('num_active_completed', 0)
-            self.secure_counters.increment('EntryClientIPActiveCircuitCount',
-                                           bin=num_active_completed,
-                                           inc=1)
-            num_inactive_completed = client.get('num_inactive_completed', 0)
-            self.secure_counters.increment('EntryClientIPInactiveCircuitCount',
-                                           bin=num_inactive_completed,
-                                           inc=1)
-
-        self.secure_counters.increment('EntryClientIPCount',
-                                       bin=SINGLE_BIN,
-                                       inc=(client_ips_active + client_ips_inactive))
-        self.secure_counters.increment('EntryActiveClientIPCount',
-                                       bin=SINGLE_BIN,
-                                       inc=client_ips_active)
-        self.secure_counters.increment('EntryInactiveClientIPCount',
-                                       bin=SINGLE_BIN,
-                                       inc=client_ips_inactive)
+        rotated_cli_ips = self.cli_ips_previous
 
         # reset for next interval
         # make cli_ips_previous the IPs from period to 0 seconds ago
         # TODO: secure delete IP addresses
         self.cli_ips_previous = self.cli_ips_current
         self.cli_ips_current = {}
-        self.cli_ips_rotated = time()
+        self.cli_ips_rotated = time() if rotate_time is None else rotate_time
         self.num_rotations += 1
+
+        # the rotated IPs are not used by any other code, so we can
+        # summarise them in a thread, and increment the counters when
+        # the thread finishes
+        if self.rotate_in_thread and len(rotated_cli_ips) > 0:
+            self.pending_rotations += 1
+            rotate_deferred = threads.deferToThread(
+                Aggregator._summarise_client_ips, rotated_cli_ips)
+            rotate_deferred.addCallback(self._increment_client_ip_counters,
+                                        from_thread=True)
+            rotate_deferred.addErrback(errorCallback)
+        else:
+            self._increment_client_ip_counters(
+                Aggregator._summarise_client_ips(rotated_cli_ips))
+
+        self._expire_state()
+
+    @staticmethod
+    def _summarise_client_ips(cli_ips):
+        '''
+        Summarise cli_ips, a dict of ClientIPRecords. Does not modify cli_ips.
+        Returns a tuple containing the number of active and inactive
+        clients, and a frequency map for the number of active and inactive
+        circuits per client.
+        This function is thread-safe, as long as cli_ips is not modified
+        while it is running.
+        '''
+        client_ips_active = 0
+        client_ips_inactive = 0
+        # count each distinct value once, with its frequency as the increment
+        num_active_completed_freq = {}
+        num_inactive_completed_freq = {}
+
+        for client in cli_ips.itervalues():
+            if client.is_active:
+                client_ips_active += 1
+            else:
+                client_ips_inactive += 1
+
+            num_active_completed = client.num_active_completed
+            num_active_completed_freq[num_active_completed] = \
+                num_active_completed_freq.get(num_active_completed, 0) + 1
+            num_inactive_completed = client.num_inactive_completed
+            num_inactive_completed_freq[num_inactive_completed] = \
+                num_inactive_completed_freq.get(num_inactive_completed, 0) + 1
+
+        return (client_ips_active, client_ips_inactive,
+                num_active_completed_freq, num_inactive_completed_freq)
+
+    def _increment_client_ip_counters(self, client_ip_summary,
+                                      from_thread=False):
+        '''
+        Increment the client IP counters using client_ip_summary from
+        _summarise_client_ips().
+        If from_thread is True, the summary was calculated in a thread.
+        '''
+        if from_thread:
+            self.pending_rotations -= 1
+        handles = self.counter_handles
+        # we stopped while the summary was being calculated
+        if handles is None:
+            logging.warning("Counters stopped before client IP rotation completed, ignoring rotated client IPs")
+            return
+
+        (client_ips_active, client_ips_inactive,
+         num_active_completed_freq, num_inactive_completed_freq) = \
+            client_ip_summary
+
+        handles['EntryClientIPActiveCircuitCount'].increment_many(
+            num_active_completed_freq.keys(),
+            incs=num_active_completed_freq.values())
+        handles['EntryClientIPInactiveCircuitCount'].increment_many(
+            num_inactive_completed_freq.keys(),
+            incs=num_inactive_completed_freq.values())
+
+        handles['EntryClientIPCount'].increment(bin=SINGLE_BIN,
+                                                inc=(client_ips_active + client_ips_inactive))
+        handles['EntryActiveClientIPCount'].increment(bin=SINGLE_BIN,
+                                                      inc=client_ips_active)
+        handles['EntryInactiveClientIPCount'].increment(bin=SINGLE_BIN,
+                                                        inc=client_ips_inactive)
+
+    def _expire_state(self):
+        '''
+        Advance the state timing wheels, and remove any circuit and stream
+        state that has not been used for the state timeout.
+        This state belongs to circuits and streams that have been closed,
+        but we didn't get the end event, or that have been idle for too long.
+        '''
+        (expired_tick, expired_keys) = self.circ_info_wheel.advance()
+        for (chanid, circid) in expired_keys:
+            circ = self.circ_info.get(chanid, {}).get(circid)
+            if circ is None or circ['last_tick'] != expired_tick:
+                continue
+            self.evicted_circ_info_count += 1
+            self.evicted_circ_info_bytes += Aggregator._get_circ_info_size(
+                                                                         circ)
+            # TODO: secure delete
+            self.circ_info[chanid].pop(circid, None)
+            if len(self.circ_info[chanid]) == 0:
+                self.circ_info.pop(chanid, None)
+
+        (expired_tick, expired_keys) = self.strm_bytes_wheel.advance()
+        for (strmid, circid) in expired_keys:
+            packet_buffer = self.strm_bytes.get(strmid, {}).get(circid)
+            if (packet_buffer is None or
+                packet_buffer.last_tick != expired_tick):
+                continue
+            self.evicted_strm_bytes_count += 1
+            self.evicted_strm_bytes_bytes += packet_buffer.get_size()
+            # TODO: secure delete
+            self.strm_bytes[strmid].pop(circid, None)
+            if len(self.strm_bytes[strmid]) == 0:
+                self.strm_bytes.pop(strmid, None)
+
+    @staticmethod
+    def _get_circ_info_size(circ):
+        '''
+        Returns the approximate number of bytes used by circ, a circ_info
+        entry.
+        '''
+        size = sys.getsizeof(circ)
+        size += sys.getsizeof(circ['num_streams'])
+        size += sys.getsizeof(circ['stream_starttimes'])
+        for starttimes in circ['stream_starttimes'].values():
+            size += sys.getsizeof(starttimes)
+            # each float is also an object
+            size += len(starttimes)*sys.getsizeof(0.0)
+        return size
+
+    @staticmethod
+    def _add_shard_state_contexts(shard_state_contexts):
+        '''
+        Returns a state context containing the total of each item in
+        shard_state_contexts, and the number of shards that have sent their
+        state. Shards that have not rotated yet are None.
+        '''
+        context = {
+            'circuit_state' : {},
+            'stream_state' : {},
+            'reported_shards' : 0,
+            }
+        for shard_context in shard_state_contexts:
+            if shard_context is None:
+                continue
+            context['reported_shards'] += 1
+            for state_key in ['circuit_state', 'stream_state']:
+                total_state = context[state_key]
+                for (key, value) in shard_context[state_key].iteritems():
+                    total_state[key] = total_state.get(key, 0) + value
+        return context
+
+    @staticmethod
+    def _get_client_ips_size(cli_ips):
+        '''
+        Returns the approximate number of bytes used by cli_ips, a dict of
+        packed IP addresses and ClientIPRecords.
+        '''
+        size = sys.getsizeof(cli_ips)
+        for (ip_key, client) in cli_ips.iteritems():
+            size += sys.getsizeof(ip_key) + sys.getsizeof(client)
+        return size
+
+    def get_state_context(self):
+        '''
+        Returns a dictionary containing the number of live and evicted
+        circuit and stream state entries, and their approximate size in
+        bytes.
+        The number of live client IP addresses is an exact
+        EntryClientIPCount, so it is not included.
+        If we have shards, returns the total of the state that each shard
+        sent after its last rotation.
+        '''
+        if self.shard_state_contexts is not None:
+            return Aggregator._add_shard_state_contexts(
+                self.shard_state_contexts)
+        circ_info_count = 0
+        circ_info_bytes = 0
+        for chan in self.circ_info.values():
+            for circ in chan.values():
+                circ_info_count += 1
+                circ_info_bytes += Aggregator._get_circ_info_size(circ)
+        strm_bytes_count = 0
+        strm_bytes_bytes = 0
+        for strm in self.strm_bytes.values():
+            for packet_buffer in strm.values():
+                strm_bytes_count += 1
+                strm_bytes_bytes += packet_buffer.get_size()
+        return {
+            'circuit_state' : {
+                'live_count' : circ_info_count,
+                'live_bytes' : circ_info_bytes,
+                'evicted_count' : self.evicted_circ_info_count,
+                'evicted_bytes' : self.evicted_circ_info_bytes,
+                },
+            'stream_state' : {
+                'live_count' : strm_bytes_count,
+                'live_bytes' : strm_bytes_bytes,
+                'evicted_count' : self.evicted_strm_bytes_count,
+                'evicted_bytes' : self.evicted_strm_bytes_bytes,
+                },
+            }
+
+# the format of the length of each message between an aggregator and its
+# shards
+SHARD_MESSAGE_LENGTH_FORMAT = '!I'
+SHARD_MESSAGE_LENGTH_SIZE = struct.calcsize(SHARD_MESSAGE_LENGTH_FORMAT)
+
+def pack_shard_message(command, payload):
+    '''
+    Returns a string containing command and payload, prefixed with its
+    length.
+    '''
+    message = pickle.dumps((command, payload), pickle.HIGHEST_PROTOCOL)
+    return struct.pack(SHARD_MESSAGE_LENGTH_FORMAT, len(message)) + message
+
+def read_shard_message(fin):
+    '''
+    Read a message written by pack_shard_message() from fin.
+    Returns a (command, payload) tuple.
+    Raises EOFError if fin ends before the end of the message.
+    '''
+    length_data = fin.read(SHARD_MESSAGE_LENGTH_SIZE)
+    if len(length_data) != SHARD_MESSAGE_LENGTH_SIZE:
+        raise EOFError()
+    (length,) = struct.unpack(SHARD_MESSAGE_LENGTH_FORMAT, length_data)
+    message = fin.read(length)
+    if len(message) != length:
+        raise EOFError()
+    return pickle.loads(message)
+
+class ShardMessageReader(object):
+    '''
+    Collects the data written by pack_shard_message() as it arrives, and
+    returns each message when it is complete.
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.data_length = 0
+        # the length of the current message, or None if we haven't read it
+        self.message_length = None
+
+    def _take(self, length):
+        '''
+        Remove and return the first length bytes of data.
+        '''
+        data = ''.join(self.chunks)
+        self.chunks = [data[length:]]
+        self.data_length -= length
+        return data[:length]
+
+    def add_data(self, data):
+        '''
+        Add data, and return a list containing the (command, payload) tuples
+        for each message that is now complete.
+        '''
+        self.chunks.append(data)
+        self.data_length += len(data)
+        messages = []
+        while True:
+            if self.message_length is None:
+                if self.data_length < SHARD_MESSAGE_LENGTH_SIZE:
+                    break
+                (self.message_length,) = struct.unpack(
+                    SHARD_MESSAGE_LENGTH_FORMAT,
+                    self._take(SHARD_MESSAGE_LENGTH_SIZE))
+            # large messages arrive in many reads, so we wait for the whole
+            # message before joining the chunks
+            if self.data_length < self.message_length:
+                break
+            messages.append(pickle.loads(self._take(self.message_length)))
+            self.message_length = None
+        return messages
+
+@implementer(IPushProducer)
+class AggregatorShardProtocol(ProcessProtocol):
+    '''
+    Sends events and commands to an aggregator shard process on its stdin,
+    and receives its state and counts on its stdout, without blocking the
+    reactor. Logs the messages the shard writes to its stderr.
+    The shard's stdin pauses us when its buffer is full, and we pause the
+    aggregator's event sources until the shard catches up.
+    '''
+
+    def __init__(self, aggregator, shard):
+        self.aggregator = aggregator
+        self.shard = shard
+        self.reader = ShardMessageReader()
+        self.log_buffer = ''
+        self.is_paused = False
+        self.has_exited = False
+        self.counts_deferred = None
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, True)
+
+    def send_message(self, command, payload):
+        '''
+        Queue command and payload for the shard's stdin.
+        Returns True on success, and False if the shard has exited.
+        '''
+        if self.has_exited:
+            return False
+        self.transport.write(pack_shard_message(command, payload))
+        return True
+
+    def stop(self):
+        '''
+        Ask the shard to stop, after processing the messages we have
+        already sent.
+        Returns a Deferred that fires with the shard's counts, or None if the
+        shard exits without sending its counts.
+        '''
+        self.counts_deferred = defer.Deferred()
+        counts_deferred = self.counts_deferred
+        if self.send_message(Aggregator.SHARD_STOP, None):
+            self.transport.closeStdin()
+        else:
+            self._finish_counts(None)
+        return counts_deferred
+
+    def kill(self):
+        '''
+        Kill the shard, and discard its counts.
+        '''
+        self.has_exited = True
+        try:
+            self.transport.signalProcess('KILL')
+        except error.ProcessExitedAlready:
+            pass
+
+    def _finish_counts(self, counts):
+        '''
+        If we are waiting for the shard's counts, fire the counts deferred
+        with counts.
+        '''
+        if self.counts_deferred is not None:
+            counts_deferred = self.counts_deferred
+            self.counts_deferred = None
+            counts_deferred.callback(counts)
+
+    def outReceived(self, data):
+        for (command, payload) in self.reader.add_data(data):
+            if command == Aggregator.SHARD_STATE:
+                self.aggregator._handle_shard_state(self.shard, payload)
+            elif command == Aggregator.SHARD_COUNTS:
+                self._finish_counts(payload)
+
+    def errReceived(self, data):
+        # the shard writes "levelno message" log lines
+        lines = (self.log_buffer + data).split('\n')
+        self.log_buffer = lines.pop()
+        for line in lines:
+            parts = line.split(' ', 1)
+            if len(parts) == 2 and parts[0].isdigit():
+                (level, message) = (int(parts[0]), parts[1])
+            else:
+                (level, message) = (logging.WARNING, line)
+            logging.log(level, "Aggregator shard {}: {}"
+                        .format(self.shard, message))
+
+    def outConnectionLost(self):
+        # the shard closes its stdout after sending its counts, or when it
+        # fails
+        self.has_exited = True
+        if self.counts_deferred is not None:
+            logging.warning("Aggregator shard {} exited without sending its counts"
+                            .format(self.shard))
+        self._finish_counts(None)
+
+    def pauseProducing(self):
+        # the shard's stdin calls this after every write while it is full
+        if not self.is_paused:
+            self.is_paused = True
+            self.aggregator._pause_events(self.shard)
+
+    def resumeProducing(self):
+        if self.is_paused:
+            self.is_paused = False
+            self.aggregator._resume_events(self.shard)
+
+    def stopProducing(self):
+        self.resumeProducing()
+
+def run_aggregator_shard():
+    '''
+    Process the events for an aggregator shard, which are sent by the
+    parent aggregator on stdin, until we receive Aggregator.SHARD_STOP.
+    Then write the shard's counts to stdout, and return.
+    The first message is Aggregator.SHARD_START, which contains the shard,
+    the Aggregator args and kwargs, and the log level. After each
+    Aggregator.SHARD_ROTATE, write the shard's state context to stdout.
+    The shard's counts are not blinded, and have no noise, so they must only
+    be sent to the parent aggregator.
+    This function runs in a separate process, so it ignores SIGINT, and
+    exits when stdin is closed.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    fin = os.fdopen(os.dup(0), 'rb')
+    fout = os.fdopen(os.dup(1), 'wb')
+    # anything else written to stdout would corrupt our messages
+    os.dup2(2, 1)
+    try:
+        (command, payload) = read_shard_message(fin)
+    except EOFError:
+        return
+    assert command == Aggregator.SHARD_START
+    (_, aggregator_args, aggregator_kwargs, log_level) = payload
+    logging.basicConfig(level=log_level, stream=sys.stderr,
+                        format='%(levelno)d %(message)s')
+    aggregator = Aggregator(*aggregator_args, **aggregator_kwargs)
+    while True:
+        try:
+            (command, payload) = read_shard_message(fin)
+        except EOFError:
+            logging.warning("Lost the connection to the aggregator, exiting")
+            return
+        if command == Aggregator.SHARD_EVENTS:
+            for line in payload.split("\n"):
+                try:
+                    is_handled = aggregator.handle_event(line.split(" "))
+                except (ValueError, IndexError):
+                    is_handled = False
+                if not is_handled:
+                    logging.warning("Failed to process event {}"
+                                    .format(line))
+        elif command == Aggregator.SHARD_ROTATE:
+            aggregator._do_rotate(rotate_time=payload)
+            fout.write(pack_shard_message(Aggregator.SHARD_STATE,
+                                          aggregator.get_state_context()))
+            fout.flush()
+        elif command == Aggregator.SHARD_START_WINDOW:
+            aggregator._start_rotation_window(payload)
+        elif command == Aggregator.SHARD_STOP:
+            # the shard has no shards or viterbi threads, so its counts are
+            # ready immediately
+            counts = []
+            aggregator._stop_secure_counters().addCallback(counts.append)
+            fout.write(pack_shard_message(Aggregator.SHARD_COUNTS, counts[0]))
+            fout.close()
+            return
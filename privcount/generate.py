@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+'''
+Generate a synthetic workload of tor PrivCount events, for load testing
+data collectors.
+
+The events are in time order, and are written to an event log, or injected
+into a data collector using the injector:
+python privcount/generate.py --events 1000000 --rate 5000 -o events.txt
+python privcount/generate.py --events 1000000 --inject --unix /tmp/privcount-inject
+
+See LICENSE for licensing information
+'''
+import sys
+import argparse
+import heapq
+import logging
+import math
+
+from random import Random
+from time import time
+
+from privcount.counter import BYTES_EVENT, STREAM_EVENT, CIRCUIT_EVENT, CONNECTION_EVENT
+from privcount.inject import PrivCountDataInjector, add_inject_listener_args, listen_inject
+
+# the number of bytes in a cell payload
+CELL_PAYLOAD_BYTES = 498
+
+# the number of distinct relay addresses that connect to us
+RELAY_IP_COUNT = 7000
+
+# the default workload, loosely based on a busy public relay
+DEFAULT_GENERATE_EVENTS = 100000
+DEFAULT_GENERATE_RATE = 1000.0
+DEFAULT_GENERATE_CLIENT_IPS = 10000
+DEFAULT_GENERATE_CLIENT_FRACTION = 0.5
+DEFAULT_GENERATE_CIRCUITS_PER_CONNECTION = 3.0
+DEFAULT_GENERATE_EXIT_FRACTION = 0.3
+DEFAULT_GENERATE_STREAMS_PER_CIRCUIT = 4.0
+DEFAULT_GENERATE_READ_BYTES = 100000.0
+DEFAULT_GENERATE_WRITE_BYTES = 2000.0
+DEFAULT_GENERATE_BYTES_SIGMA = 2.0
+DEFAULT_GENERATE_BYTES_EVENT_SIZE = 16384
+DEFAULT_GENERATE_PORTS = '443:50,80:30,22:2,6667:2,6881:4,53:1,8080:3,12345:8'
+DEFAULT_GENERATE_CONNECTION_LIFETIME = 300.0
+DEFAULT_GENERATE_CIRCUIT_LIFETIME = 120.0
+DEFAULT_GENERATE_STREAM_LIFETIME = 10.0
+# lifetimes are exponentially distributed, so some connections last many
+# times longer than the mean
+DEFAULT_GENERATE_WARMUP_LIFETIMES = 5.0
+
+def format_event_time(ts):
+    '''
+    Format ts like tor does
+    '''
+    return '{:.6f}'.format(ts)
+
+def parse_port_weights(port_weights):
+    '''
+    Parse port_weights, a comma-separated list of port:weight pairs.
+    Returns a list of (port, weight) tuples.
+    '''
+    weights = []
+    for port_weight in port_weights.split(','):
+        (port, weight) = port_weight.split(':')
+        weights.append((int(port), float(weight)))
+        assert weights[-1][0] > 0
+        assert weights[-1][1] > 0.0
+    return weights
+
+def get_client_ip(index):
+    '''
+    Return the client IP address for index. One in five addresses is IPv6.
+    '''
+    if index % 5 == 0:
+        return '2001:db8::{:x}:{:x}'.format(index >> 16, index & 0xffff)
+    else:
+        return '10.{}.{}.{}'.format((index >> 16) & 0xff, (index >> 8) & 0xff,
+                                    index & 0xff)
+
+def get_relay_ip(index):
+    '''
+    Return the relay IP address for index.
+    '''
+    return '100.64.{}.{}'.format((index >> 8) & 0xff, index & 0xff)
+
+class WorkloadGenerator(object):
+    '''
+    Generates connections, circuits, streams, and stream bytes, and the
+    events for them, in time order.
+
+    Each connection is from a client, or another relay. Client connections
+    carry entry circuits, and relay connections carry exit circuits and
+    middle circuits. Only exit circuits have streams.
+    Counts and lifetimes are exponentially distributed with the configured
+    means, and byte counts are log-normally distributed with the configured
+    means.
+    Connections arrive at random, spaced so that the mean event rate is the
+    target rate. Connection events happen when the connection ends, so
+    connections start during a warmup before the first event, so that the
+    event rate starts near the target rate. The warmup is several mean
+    connection, circuit, and stream lifetimes long, because a few
+    connections last much longer than the mean. Events before the first
+    event time are not created, so the warmup is cheap.
+    '''
+
+    def __init__(self, rng,
+                 rate=DEFAULT_GENERATE_RATE,
+                 start_time=None,
+                 client_ips=DEFAULT_GENERATE_CLIENT_IPS,
+                 client_fraction=DEFAULT_GENERATE_CLIENT_FRACTION,
+                 circuits_per_connection=DEFAULT_GENERATE_CIRCUITS_PER_CONNECTION,
+                 exit_fraction=DEFAULT_GENERATE_EXIT_FRACTION,
+                 streams_per_circuit=DEFAULT_GENERATE_STREAMS_PER_CIRCUIT,
+                 read_bytes=DEFAULT_GENERATE_READ_BYTES,
+                 write_bytes=DEFAULT_GENERATE_WRITE_BYTES,
+                 bytes_sigma=DEFAULT_GENERATE_BYTES_SIGMA,
+                 bytes_event_size=DEFAULT_GENERATE_BYTES_EVENT_SIZE,
+                 ports=DEFAULT_GENERATE_PORTS,
+                 connection_lifetime=DEFAULT_GENERATE_CONNECTION_LIFETIME,
+                 circuit_lifetime=DEFAULT_GENERATE_CIRCUIT_LIFETIME,
+                 stream_lifetime=DEFAULT_GENERATE_STREAM_LIFETIME,
+                 warmup=None):
+        '''
+        Create a generator that uses rng for randomness, and generates
+        rate events per second, starting at start_time (default: now).
+        Connections start warmup seconds before start_time (default:
+        DEFAULT_GENERATE_WARMUP_LIFETIMES times the sum of the mean
+        connection, circuit, and stream lifetimes), but only events after
+        start_time are generated.
+        If bytes_event_size is 0, no stream bytes events are generated.
+        ports is a comma-separated list of port:weight pairs.
+        '''
+        assert rate > 0.0
+        assert client_ips > 0
+        assert bytes_event_size >= 0
+        self.rng = rng
+        self.rate = float(rate)
+        self.start_time = time() if start_time is None else float(start_time)
+        self.client_ips = client_ips
+        self.client_fraction = client_fraction
+        self.circuits_per_connection = circuits_per_connection
+        self.exit_fraction = exit_fraction
+        self.streams_per_circuit = streams_per_circuit
+        # the log-normal mu for each mean byte count
+        self.bytes_sigma = bytes_sigma
+        self.read_bytes_mu = math.log(read_bytes) - bytes_sigma**2/2.0
+        self.write_bytes_mu = math.log(write_bytes) - bytes_sigma**2/2.0
+        self.bytes_event_size = bytes_event_size
+        port_weights = parse_port_weights(ports)
+        self.ports = [port for (port, _) in port_weights]
+        self.port_weights = [weight for (_, weight) in port_weights]
+        self.connection_lifetime = connection_lifetime
+        self.circuit_lifetime = circuit_lifetime
+        self.stream_lifetime = stream_lifetime
+        if warmup is None:
+            warmup = DEFAULT_GENERATE_WARMUP_LIFETIMES * (connection_lifetime +
+                                                          circuit_lifetime +
+                                                          stream_lifetime)
+        assert warmup >= 0.0
+        self.warmup = warmup
+
+        self.next_chanid = 1
+        self.next_circid = 1
+        self.next_strmid = 1
+        # (event_time, sequence, event) tuples
+        # the sequence keeps events with the same time in generated order
+        self.pending_events = []
+        self.pending_sequence = 0
+        self.event_counts = {}
+        self.used_client_ips = set()
+        self.last_event_time = None
+
+    def _push_event(self, event_time, event):
+        '''
+        Add event, which happens at event_time, to the pending events.
+        Events before start_time are discarded.
+        '''
+        if event_time < self.start_time:
+            return
+        heapq.heappush(self.pending_events,
+                       (event_time, self.pending_sequence, event))
+        self.pending_sequence += 1
+
+    def _get_count(self, mean):
+        '''
+        Return a count with mean, rounded from an exponential distribution.
+        '''
+        return int(self.rng.expovariate(1.0/mean) + 0.5) if mean > 0 else 0
+
+    def _get_port(self):
+        '''
+        Return a random port, using the port weights.
+        '''
+        target = self.rng.random() * sum(self.port_weights)
+        for (port, weight) in zip(self.ports, self.port_weights):
+            target -= weight
+            if target < 0.0:
+                return port
+        return self.ports[-1]
+
+    def _add_bytes_events(self, chanid, circid, strmid, is_outbound,
+                          n_bytes, start, end):
+        '''
+        Add stream bytes events for n_bytes in the is_outbound direction,
+        spread evenly between start and end. The first outbound event is at
+        start, because some traffic models can't start with an inbound
+        packet.
+        Returns the number of events, including any events before
+        start_time, which are not added.
+        '''
+        if self.bytes_event_size == 0 or n_bytes == 0:
+            return 0
+        n_events = (n_bytes + self.bytes_event_size - 1) // self.bytes_event_size
+        # skip most of the events before start_time during the warmup,
+        # _push_event() discards the rest
+        first_event = 0
+        if end < self.start_time:
+            first_event = n_events
+        elif start < self.start_time:
+            first_event = max(0, int((self.start_time - start) * n_events /
+                                     (end - start)) - 1)
+        for i in xrange(first_event, n_events):
+            ts = start + (end - start) * (i + 1 - is_outbound) / n_events
+            bw = min(self.bytes_event_size,
+                     n_bytes - i * self.bytes_event_size)
+            self._push_event(ts, [BYTES_EVENT, str(chanid), str(circid),
+                                  str(strmid), str(is_outbound), str(bw),
+                                  format_event_time(ts)])
+        return n_events
+
+    def _add_stream(self, chanid, circid, circ_start, circ_end):
+        '''
+        Add a stream that starts between circ_start and circ_end, and its
+        bytes events.
+        Returns a tuple containing the stream end time, its read and write
+        bytes, and the number of events, including any events before
+        start_time.
+        '''
+        strmid = self.next_strmid
+        self.next_strmid += 1
+        start = self.rng.uniform(circ_start, circ_end)
+        end = start + self.rng.expovariate(1.0/self.stream_lifetime)
+        read_bytes = int(self.rng.lognormvariate(self.read_bytes_mu,
+                                                 self.bytes_sigma))
+        write_bytes = int(self.rng.lognormvariate(self.write_bytes_mu,
+                                                  self.bytes_sigma))
+        # the client sends the request before the response
+        n_events = self._add_bytes_events(chanid, circid, strmid, 1,
+                                          write_bytes, start, end)
+        n_events += self._add_bytes_events(chanid, circid, strmid, 0,
+                                           read_bytes, start, end)
+        port = self._get_port()
+        remote_index = self.rng.randint(0, 255)
+        self._push_event(end, [STREAM_EVENT, str(chanid), str(circid),
+                               str(strmid), str(port), str(read_bytes),
+                               str(write_bytes), format_event_time(start),
+                               format_event_time(end),
+                               'www{}.example.com'.format(remote_index),
+                               '192.0.2.{}'.format(remote_index)])
+        return (end, read_bytes, write_bytes, n_events + 1)
+
+    def _add_circuit(self, chanid, conn_start, conn_end, prev_ip, is_client):
+        '''
+        Add a circuit that starts between conn_start and conn_end, and its
+        streams.
+        Returns a tuple containing the circuit end time, and the number of
+        events, including any events before start_time.
+        '''
+        circid = self.next_circid
+        self.next_circid += 1
+        start = self.rng.uniform(conn_start, conn_end)
+        end = start + self.rng.expovariate(1.0/self.circuit_lifetime)
+        is_exit = (not is_client) and self.rng.random() < self.exit_fraction
+        n_events = 0
+        exit_read_bytes = 0
+        exit_write_bytes = 0
+        if is_exit:
+            for _ in xrange(self._get_count(self.streams_per_circuit)):
+                (strm_end, read_bytes, write_bytes, strm_events) = \
+                    self._add_stream(chanid, circid, start, end)
+                end = max(end, strm_end)
+                exit_read_bytes += read_bytes
+                exit_write_bytes += write_bytes
+                n_events += strm_events
+            circ_read_bytes = exit_read_bytes
+            circ_write_bytes = exit_write_bytes
+        else:
+            circ_read_bytes = int(self.rng.lognormvariate(self.read_bytes_mu,
+                                                          self.bytes_sigma))
+            circ_write_bytes = int(self.rng.lognormvariate(self.write_bytes_mu,
+                                                           self.bytes_sigma))
+        # cells in carry the client's writes, cells out carry its reads
+        cells_in = 1 + circ_write_bytes // CELL_PAYLOAD_BYTES
+        cells_out = 1 + circ_read_bytes // CELL_PAYLOAD_BYTES
+        next_ip = '0.0.0.0' if is_exit else get_relay_ip(
+            self.rng.randrange(RELAY_IP_COUNT))
+        self._push_event(end, [CIRCUIT_EVENT, str(chanid), str(circid),
+                               str(cells_in), str(cells_out),
+                               str(exit_read_bytes), str(exit_write_bytes),
+                               format_event_time(start),
+                               format_event_time(end),
+                               prev_ip, '1' if is_client else '0',
+                               next_ip, '1' if is_exit else '0'])
+        return (end, n_events + 1)
+
+    def _add_connection(self, start):
+        '''
+        Add a connection that starts at start, and its circuits.
+        Returns the number of events, including any events before
+        start_time.
+        '''
+        chanid = self.next_chanid
+        self.next_chanid += 1
+        is_client = self.rng.random() < self.client_fraction
+        if is_client:
+            ip = get_client_ip(self.rng.randrange(self.client_ips))
+            self.used_client_ips.add(ip)
+        else:
+            ip = get_relay_ip(self.rng.randrange(RELAY_IP_COUNT))
+        conn_end = start + self.rng.expovariate(1.0/self.connection_lifetime)
+        end = conn_end
+        n_events = 0
+        for _ in xrange(self._get_count(self.circuits_per_connection)):
+            (circ_end, circ_events) = self._add_circuit(chanid, start,
+                                                        conn_end, ip,
+                                                        is_client)
+            end = max(end, circ_end)
+            n_events += circ_events
+        self._push_event(end, [CONNECTION_EVENT, str(chanid),
+                               format_event_time(start),
+                               format_event_time(end), ip,
+                               '1' if is_client else '0'])
+        return n_events + 1
+
+    def generate_events(self, n_events):
+        '''
+        A generator that yields n_events events, in time order. Each event
+        is a list of strings, starting with the event code.
+        '''
+        arrival_time = self.start_time - self.warmup
+        n_yielded = 0
+        while n_yielded < n_events:
+            # every event for later connections happens after their arrival
+            while (len(self.pending_events) > 0 and
+                   self.pending_events[0][0] <= arrival_time and
+                   n_yielded < n_events):
+                (event_time, _, event) = heapq.heappop(self.pending_events)
+                self.event_counts[event[0]] = (
+                    self.event_counts.get(event[0], 0) + 1)
+                self.last_event_time = event_time
+                n_yielded += 1
+                yield event
+            # space out the connections, so that the mean event rate is the
+            # target rate
+            conn_events = self._add_connection(arrival_time)
+            arrival_time += self.rng.expovariate(self.rate / conn_events)
+
+class GeneratedEventFile(object):
+    '''
+    A read-only file-like object, containing one event per line.
+    '''
+
+    def __init__(self, events):
+        '''
+        events is an iterator of events, each event is a list of strings.
+        '''
+        self.events = events
+
+    def readline(self):
+        '''
+        Return the next event line, or '' if there are no more events.
+        '''
+        if self.events is None:
+            return ''
+        try:
+            return ' '.join(next(self.events)) + '\n'
+        except StopIteration:
+            self.events = None
+            return ''
+
+    def close(self):
+        self.events = None
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate a synthetic workload of tor PrivCount events")
+    add_generate_args(ap)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    run_generate(args)
+
+def make_generator(args):
+    '''
+    Return a WorkloadGenerator configured using args.
+    '''
+    return WorkloadGenerator(Random(args.seed),
+                             rate=args.rate,
+                             start_time=args.start_time,
+                             client_ips=args.client_ips,
+                             client_fraction=args.client_fraction,
+                             circuits_per_connection=args.circuits_per_connection,
+                             exit_fraction=args.exit_fraction,
+                             streams_per_circuit=args.streams_per_circuit,
+                             read_bytes=args.read_bytes,
+                             write_bytes=args.write_bytes,
+                             bytes_sigma=args.bytes_sigma,
+                             bytes_event_size=args.bytes_event_size,
+                             ports=args.ports,
+                             connection_lifetime=args.connection_lifetime,
+                             circuit_lifetime=args.circuit_lifetime,
+                             stream_lifetime=args.stream_lifetime,
+                             warmup=args.warmup)
+
+def run_generate(args):
+    '''
+    Generate the events, and write them to args.output, or inject them
+    into a data collector
+    '''
+    generator = make_generator(args)
+    events = generator.generate_events(args.events)
+    if args.inject:
+        # the injector moves the event times to the current time, or the
+        # simulated replay time
+        # pylint: disable=E1101
+        injector = PrivCountDataInjector(None, args.simulate, 0.0,
+                                         float(sys.maxint),
+                                         args.control_password,
+                                         args.control_cookie_file,
+                                         args.batch_size,
+                                         args.speed,
+                                         event_file=GeneratedEventFile(events))
+        listen_inject(injector, args)
+    else:
+        fout = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            fout.writelines(' '.join(event) + '\n' for event in events)
+        finally:
+            if fout is not sys.stdout:
+                fout.close()
+    n_events = sum(generator.event_counts.values())
+    if n_events > 0 and generator.last_event_time > generator.start_time:
+        event_rate = n_events / (generator.last_event_time -
+                                 generator.start_time)
+    else:
+        event_rate = 0.0
+    logging.info("Generated {} events at {:.1f} events per second, for {} connections from {} client IP addresses: {}"
+                 .format(n_events, event_rate,
+                         generator.next_chanid - 1,
+                         len(generator.used_client_ips),
+                         ", ".join(["{} {}".format(count, event_code)
+                                    for (event_code, count)
+                                    in sorted(generator.event_counts.items())])))
+
+def add_generate_args(parser):
+    parser.add_argument('-o', '--output',
+                        help="a file PATH for the events, may be '-' for STDOUT",
+                        default='-')
+    parser.add_argument('--inject',
+                        action='store_true',
+                        help="inject the events into a data collector, rather than writing them to the output")
+    parser.add_argument('--seed',
+                        help="the seed for the generated events",
+                        type=int,
+                        default=1)
+    parser.add_argument('-n', '--events',
+                        help="the number of events",
+                        type=int,
+                        default=DEFAULT_GENERATE_EVENTS)
+    parser.add_argument('-r', '--rate',
+                        help="the mean number of events per second of event time",
+                        type=float,
+                        default=DEFAULT_GENERATE_RATE)
+    parser.add_argument('--start-time',
+                        help="the unix time of the first connection (default: now)",
+                        type=float,
+                        default=None)
+    parser.add_argument('--client-ips',
+                        help="the number of distinct client IP addresses",
+                        type=int,
+                        default=DEFAULT_GENERATE_CLIENT_IPS)
+    parser.add_argument('--client-fraction',
+                        help="the fraction of connections that are from clients, the rest are from relays",
+                        type=float,
+                        default=DEFAULT_GENERATE_CLIENT_FRACTION)
+    parser.add_argument('--circuits-per-connection',
+                        help="the mean number of circuits on each connection",
+                        type=float,
+                        default=DEFAULT_GENERATE_CIRCUITS_PER_CONNECTION)
+    parser.add_argument('--exit-fraction',
+                        help="the fraction of relay circuits that are exit circuits, the rest are middle circuits",
+                        type=float,
+                        default=DEFAULT_GENERATE_EXIT_FRACTION)
+    parser.add_argument('--streams-per-circuit',
+                        help="the mean number of streams on each exit circuit",
+                        type=float,
+                        default=DEFAULT_GENERATE_STREAMS_PER_CIRCUIT)
+    parser.add_argument('--read-bytes',
+                        help="the mean number of bytes read by each stream or circuit",
+                        type=float,
+                        default=DEFAULT_GENERATE_READ_BYTES)
+    parser.add_argument('--write-bytes',
+                        help="the mean number of bytes written by each stream or circuit",
+                        type=float,
+                        default=DEFAULT_GENERATE_WRITE_BYTES)
+    parser.add_argument('--bytes-sigma',
+                        help="the sigma of the log-normal byte distributions",
+                        type=float,
+                        default=DEFAULT_GENERATE_BYTES_SIGMA)
+    parser.add_argument('--bytes-event-size',
+                        help="the maximum number of bytes in each stream bytes event, or 0 for no stream bytes events",
+                        type=int,
+                        default=DEFAULT_GENERATE_BYTES_EVENT_SIZE)
+    parser.add_argument('--ports',
+                        help="a comma-separated list of port:weight pairs for stream ports",
+                        default=DEFAULT_GENERATE_PORTS)
+    parser.add_argument('--connection-lifetime',
+                        help="the mean connection lifetime in seconds, connections last until their circuits end",
+                        type=float,
+                        default=DEFAULT_GENERATE_CONNECTION_LIFETIME)
+    parser.add_argument('--circuit-lifetime',
+                        help="the mean circuit lifetime in seconds, circuits last until their streams end",
+                        type=float,
+                        default=DEFAULT_GENERATE_CIRCUIT_LIFETIME)
+    parser.add_argument('--stream-lifetime',
+                        help="the mean stream lifetime in seconds",
+                        type=float,
+                        default=DEFAULT_GENERATE_STREAM_LIFETIME)
+    parser.add_argument('--warmup',
+                        help="start generating connections this many seconds before the start time, so the event rate starts near the target rate. The events before the start time are discarded. (default: {} times the mean connection, circuit, and stream lifetimes)".format(DEFAULT_GENERATE_WARMUP_LIFETIMES),
+                        type=float,
+                        default=None)
+    add_inject_listener_args(parser)
+
+if __name__ == "__main__":
+    sys.exit(main())
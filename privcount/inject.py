@@ -12,7 +12,9 @@ import logging
 from time import time
 
 from twisted.internet import reactor, task
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import ServerFactory
+from zope.interface import implementer
 
 from privcount.config import normalise_path
 from privcount.connection import listen, stopListening
@@ -27,17 +29,46 @@ from privcount.protocol import TorControlServerProtocol
 # conflict with a running tor instance
 DEFAULT_PRIVCOUNT_INJECT_SOCKET = '/tmp/privcount-inject'
 
+# the default maximum number of events sent in each reactor turn
+# large batches amortise the per-turn timer and write overhead, and the
+# injector pauses when the data collector's connection buffers are full, so
+# it can't get far ahead of the data collector
+DEFAULT_PRIVCOUNT_INJECT_BATCH_SIZE = 10000
+
+# the default speed-up when simulating event inter-arrival times
+DEFAULT_PRIVCOUNT_INJECT_SPEED = 1.0
+
+@implementer(IPushProducer)
 class PrivCountDataInjector(ServerFactory):
+    '''
+    Injects the events in an event log into a PrivCount data collector.
+    Unless we are simulating event inter-arrival times, we send batches of
+    events. When simulating, we send the events that are due in each timer.
+    We act as a push producer for the connection, so we pause when the
+    connection's buffers are full.
+    '''
 
     def __init__(self, logpath, do_pause, prune_before, prune_after,
-                 control_password = None, control_cookie_file = None):
+                 control_password = None, control_cookie_file = None,
+                 batch_size = DEFAULT_PRIVCOUNT_INJECT_BATCH_SIZE,
+                 speed = DEFAULT_PRIVCOUNT_INJECT_SPEED,
+                 event_file = None):
+        '''
+        Inject the events in the file at logpath, or in event_file, an
+        open file-like object with readline() and close().
+        '''
         self.logpath = logpath
         self.do_pause = do_pause
         self.prune_before = prune_before
         self.prune_after = prune_after
         self.protocol = None
-        self.event_file = None
-        self.last_time_end = 0.0
+        self.event_file = event_file
+        self.last_time_end = None
+        self.next_event = None
+        self.speed = float(speed)
+        assert self.speed > 0.0
+        self.replay_start_time = None
+        self.replay_origin_time = None
         self.injecting = False
         self.pending_stop = False
         self.listeners = None
@@ -46,6 +77,11 @@ class PrivCountDataInjector(ServerFactory):
         self.input_line_count = 0
         self.output_line_count = 0
         self.output_event_count = 0
+        self.batch_size = int(batch_size)
+        assert self.batch_size >= 1
+        self.is_producing = False
+        self.is_paused = False
+        self.is_batch_pending = False
 
     def startFactory(self):
         # TODO
@@ -93,13 +129,24 @@ class PrivCountDataInjector(ServerFactory):
             # This breaks the reference loop
             self.listeners = None
         if self.do_pause:
-            logging.info("We will pause between the injection of each event to simulate actual event inter-arrival times, so this may take a while")
+            logging.info("We will pause between the injection of each event to simulate actual event inter-arrival times, {} times faster than they were recorded, so this may take a while"
+                         .format(self.speed))
+        else:
+            logging.info("Sending up to {} events at a time, as fast as the data collector reads them"
+                         .format(self.batch_size))
 
-        if self.logpath == '-':
+        if self.event_file is not None:
+            # we were given an open event file
+            pass
+        elif self.logpath == '-':
             self.event_file = sys.stdin
         else:
             self.event_file = open(normalise_path(self.logpath), 'r')
-        self._inject_events()
+        if (self.protocol is not None and
+            self.protocol.transport is not None):
+            self.protocol.transport.registerProducer(self, True)
+            self.is_producing = True
+        self._schedule_batch()
 
     def stop_injecting(self):
         '''
@@ -132,6 +179,11 @@ class PrivCountDataInjector(ServerFactory):
         if self.listeners is not None:
             stopListening(self.listeners)
             self.listeners = None
+        if self.is_producing:
+            self.is_producing = False
+            if (self.protocol is not None and
+                self.protocol.transport is not None):
+                self.protocol.transport.unregisterProducer()
         # Count lines and events
         event_info = ("Read {} lines, {} valid times, sent {} events"
                       .format(self.input_line_count, self.output_line_count,
@@ -162,38 +214,118 @@ class PrivCountDataInjector(ServerFactory):
             self.input_line_count += 1
             return line
 
-    def _flush_now(self, msg):
-        if (self.protocol is not None and self.protocol.transport is not None
-            and self.protocol.transport.connected and self.injecting):
-            # update event times so the data seems fresh to privcount
-            this_time_start, this_time_end = self._get_event_times(msg)
-            now = time()
-            alive = this_time_end - this_time_start
-            msg_adjusted_times = self._set_event_times(msg, now-alive, now)
-            event = "650 {}".format(msg_adjusted_times)
-            self.output_event_count += 1
-            logging.info("sending event {} '{}'".format(
-                    self.output_event_count, event))
-            self.protocol.sendLine(event)
-        elif self.injecting:
-            # No connection: stop sending
-            self.stop_injecting()
+    def _make_event_line(self, msg, now):
+        '''
+        Return a control port event line for msg, with its times updated so
+        that it ends at now, and the data seems fresh to privcount.
+        '''
+        this_time_start, this_time_end = self._get_event_times(msg)
+        alive = this_time_end - this_time_start
+        msg_adjusted_times = self._set_event_times(msg, now-alive, now)
+        return "650 {}".format(msg_adjusted_times)
+
+    # log every event at debug level, but only log a progress message
+    # at info level after every LOG_EVENT_INTERVAL events
+    LOG_EVENT_INTERVAL = 10000
+
+    def _log_sent_events(self, events):
+        '''
+        Log events, which have just been sent. output_event_count must
+        include events.
+        '''
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            first_event_count = self.output_event_count - len(events) + 1
+            for i in xrange(len(events)):
+                logging.debug("sending event {} '{}'".format(
+                        first_event_count + i, events[i]))
+        interval = PrivCountDataInjector.LOG_EVENT_INTERVAL
+        if (self.output_event_count // interval >
+            (self.output_event_count - len(events)) // interval):
+            logging.info("Sent {} events".format(self.output_event_count))
+
+    def pauseProducing(self):
+        '''
+        Stop sending events until resumeProducing is called.
+        Called by the transport when its buffers are full.
+        '''
+        self.is_paused = True
+
+    def resumeProducing(self):
+        '''
+        Start sending events again.
+        Called by the transport when its buffers have been written.
+        '''
+        self.is_paused = False
+        self._schedule_batch()
 
-    def _flush_later(self, msg):
+    def stopProducing(self):
         '''
+        Stop sending events, because the connection has closed.
+        '''
+        self.stop_injecting()
+
+    def _schedule_batch(self, wait_time=0.0):
+        '''
+        Send the next batch of events after wait_time, unless we are paused,
+        or a batch is already scheduled.
+        '''
+        if not self.injecting or self.is_paused or self.is_batch_pending:
+            return
+        self.is_batch_pending = True
+        # always yield to the reactor, so it can write the last batch, and
+        # check for incoming data
+        if self.do_pause:
+            batch_deferred = task.deferLater(reactor, wait_time,
+                                             self._inject_events)
+        else:
+            batch_deferred = task.deferLater(reactor, wait_time,
+                                             self._inject_batch)
+        batch_deferred.addErrback(errorCallback)
+
+    def _inject_batch(self):
+        '''
+        Send up to batch_size events, all with the current time, then
+        schedule the next batch.
         This function is called using deferLater, so any exceptions will be
         handled by errorCallback.
         '''
-        self._flush_now(msg)
-        self._inject_events()
+        self.is_batch_pending = False
+        if not self.injecting or self.is_paused:
+            return
+        if (self.protocol is None or self.protocol.transport is None or
+            not self.protocol.transport.connected):
+            # No connection: stop sending
+            self.stop_injecting()
+            return
+        now = time()
+        events = []
+        is_finished = False
+        while len(events) < self.batch_size:
+            event_info = self._get_event()
+            if event_info is None:
+                is_finished = True
+                break
+            events.append(self._make_event_line(event_info[0], now))
+        if len(events) > 0:
+            self.output_event_count += len(events)
+            self._log_sent_events(events)
+            self.protocol.sendLines(events)
+        if is_finished:
+            # We're done
+            self.stop_injecting()
+        else:
+            self._schedule_batch()
 
-    def _inject_events(self):
-        while self.injecting:
+    def _get_event(self):
+        '''
+        Read lines until we find an event inside our 'valid' event window.
+        Returns a tuple containing the event, and its start and end times,
+        or None if there are no more events.
+        '''
+        while True:
             line = self._get_line()
             if line is None:
-                # We're done
-                self.stop_injecting()
-                return
+                return None
 
             msg = line.strip()
             this_time_start, this_time_end = self._get_event_times(msg)
@@ -206,37 +338,94 @@ class PrivCountDataInjector(ServerFactory):
                 continue
 
             self.output_line_count += 1
+            return (msg, this_time_start, this_time_end)
+
+    # when simulating, events that are due within this many seconds of the
+    # first due event are sent together, so that high speeds don't create a
+    # timer for every event
+    SIMULATE_TIMER_RESOLUTION = 0.01
+    # the maximum number of due events sent in each reactor turn, when
+    # simulating
+    SIMULATE_BATCH_SIZE = DEFAULT_PRIVCOUNT_INJECT_BATCH_SIZE
+
+    def _get_replay_time(self, event_time):
+        '''
+        Return the time when event_time happens in the replay, which starts
+        at the first event, and runs speed times faster than the event log.
+        '''
+        return (self.replay_start_time +
+                (event_time - self.replay_origin_time) / self.speed)
 
-            # if we need to simulate event inter-arrival times
-            wait_time = 0.0
-            if self.do_pause:
-                wait_time = this_time_end - self.last_time_end
-                self.last_time_end = this_time_end
-
-            # ensure wait_time is sensible
-            if wait_time < 0.0:
-                logging.warning("Out of sequence event times")
-                wait_time = 0.0
-
-            if wait_time < 2.0:
-                logger = logging.debug
-            elif wait_time < 60.0:
-                logger = logging.info
-            else:
-                logger = logging.warning
-
-            logger("Waiting {} seconds to send event {}".format(wait_time, msg))
-
-            # we can't dump the entire file at once: it fills up the buffers
-            # without giving the twisted event loop time to flush them
-            # instead, use deferLater with a zero delay
-            # we can't sleep or twisted won't work correctly
-            inject_deferred = task.deferLater(reactor, wait_time,
-                                              self._flush_later, msg)
-            inject_deferred.addErrback(errorCallback)
-            # _flush_later will inject the next event when called
+    def _read_next_event(self):
+        '''
+        Read the next event into next_event, or set it to None if there are
+        no more events.
+        '''
+        self.next_event = self._get_event()
+        if self.next_event is None:
+            return
+        this_time_end = self.next_event[2]
+        if self.replay_start_time is None:
+            # the first event is sent immediately
+            self.replay_start_time = time()
+            self.replay_origin_time = this_time_end
+        elif this_time_end < self.last_time_end:
+            logging.warning("Out of sequence event times")
+        if self.last_time_end is None or this_time_end > self.last_time_end:
+            self.last_time_end = this_time_end
+
+    def _inject_events(self):
+        '''
+        Send the events that are due, with their times moved into the
+        replay, then schedule a timer for the next event.
+        This function is called using deferLater, so any exceptions will be
+        handled by errorCallback.
+        '''
+        self.is_batch_pending = False
+        if not self.injecting or self.is_paused:
+            return
+        if (self.protocol is None or self.protocol.transport is None or
+            not self.protocol.transport.connected):
+            # No connection: stop sending
+            self.stop_injecting()
+            return
+        if self.next_event is None:
+            self._read_next_event()
+        send_before = time() + PrivCountDataInjector.SIMULATE_TIMER_RESOLUTION
+        events = []
+        # out of sequence events are due immediately
+        while (self.next_event is not None and
+               len(events) < PrivCountDataInjector.SIMULATE_BATCH_SIZE and
+               self._get_replay_time(self.next_event[2]) <= send_before):
+            (msg, this_time_start, this_time_end) = self.next_event
+            events.append("650 {}".format(
+                    self._set_event_times(
+                        msg,
+                        self._get_replay_time(this_time_start),
+                        self._get_replay_time(this_time_end))))
+            self._read_next_event()
+        if len(events) > 0:
+            self.output_event_count += len(events)
+            self._log_sent_events(events)
+            self.protocol.sendLines(events)
+        if self.next_event is None:
+            # We're done
+            self.stop_injecting()
             return
 
+        wait_time = max(0.0, self._get_replay_time(self.next_event[2]) -
+                        time())
+        if wait_time < 2.0:
+            logger = logging.debug
+        elif wait_time < 60.0:
+            logger = logging.info
+        else:
+            logger = logging.warning
+
+        logger("Waiting {} seconds to send event {}"
+               .format(wait_time, self.next_event[0]))
+        self._schedule_batch(wait_time)
+
     def _get_event_times(self, msg):
         parts = msg.split()
         if parts[0] == 'PRIVCOUNT_STREAM_BYTES_TRANSFERRED' and len(parts) == Aggregator.STREAM_BYTES_ITEMS + 1:
@@ -263,7 +452,9 @@ class PrivCountDataInjector(ServerFactory):
             parts[2], parts[3] = start_time, end_time
         else:
             logging.warning("Wrong event field count or unknown event in: {}".format(msg))
-        return ' '.join([str(p) for p in parts])
+        # use the same precision as tor
+        return ' '.join(['{:.6f}'.format(p) if isinstance(p, float) else p
+                         for p in parts])
 
 def main():
     ap = argparse.ArgumentParser(description="Injects Tor events into a PrivCount DC")
@@ -276,7 +467,13 @@ def run_inject(args):
     start the injector, and start it listening
     '''
     # pylint: disable=E1101
-    injector = PrivCountDataInjector(args.log, args.simulate, float(args.prune_before), float(args.prune_after), args.control_password, args.control_cookie_file)
+    injector = PrivCountDataInjector(args.log, args.simulate, float(args.prune_before), float(args.prune_after), args.control_password, args.control_cookie_file, args.batch_size, args.speed)
+    listen_inject(injector, args)
+
+def listen_inject(injector, args):
+    '''
+    start injector listening on the addresses in args, and run the reactor
+    '''
     # The injector listens on all of IPv4, IPv6, and a control socket, and
     # injects events into the first client to connect
     # Since these are synthetic events, it is safe to use /tmp for the socket
@@ -294,6 +491,23 @@ def run_inject(args):
     reactor.run()
 
 def add_inject_args(parser):
+    parser.add_argument('-l', '--log',
+                        help="a file PATH to a PrivCount event log file, may be '-' for STDIN (default: STDIN)",
+                        required=True,
+                        default='-')
+    parser.add_argument('--prune-before',
+                        help="do not inject events that occurred before the given unix timestamp",
+                        default=float(0))
+    parser.add_argument('--prune-after',
+                        help="do not inject events that occurred after the given unix timestamp",
+                        default=float(sys.maxint))
+    add_inject_listener_args(parser)
+
+def add_inject_listener_args(parser):
+    '''
+    Add the arguments that configure how events are injected into a data
+    collector to parser
+    '''
     parser.add_argument('-p', '--port',
                         help="port on which to listen for PrivCount connections(default: no IP listener)",
                         required=False)
@@ -303,19 +517,17 @@ def add_inject_args(parser):
     parser.add_argument('-u', '--unix',
                         help="Unix socket on which to listen for PrivCount connections (default: no unix listener)",
                         required=False)
-    parser.add_argument('-l', '--log',
-                        help="a file PATH to a PrivCount event log file, may be '-' for STDIN (default: STDIN)",
-                        required=True,
-                        default='-')
     parser.add_argument('-s', '--simulate',
                         action='store_true',
                         help="add pauses between each event injection to simulate the inter-arrival times from the source data")
-    parser.add_argument('--prune-before',
-                        help="do not inject events that occurred before the given unix timestamp",
-                        default=float(0))
-    parser.add_argument('--prune-after',
-                        help="do not inject events that occurred after the given unix timestamp",
-                        default=float(sys.maxint))
+    parser.add_argument('--speed',
+                        type=float,
+                        help="when simulating, replay events this many times faster than the source data, scaling the event times and durations to match (default: {})".format(DEFAULT_PRIVCOUNT_INJECT_SPEED),
+                        default=DEFAULT_PRIVCOUNT_INJECT_SPEED)
+    parser.add_argument('-b', '--batch-size',
+                        type=int,
+                        help="send up to this many events in each reactor turn, pausing when the data collector falls behind. Use 1 to send one event per turn. Ignored when simulating. (default: {})".format(DEFAULT_PRIVCOUNT_INJECT_BATCH_SIZE),
+                        default=DEFAULT_PRIVCOUNT_INJECT_BATCH_SIZE)
     parser.add_argument('--control-password',
                         help="A file containing the tor control password. Set this in tor using tor --hash-password and HashedControlPassword")
     parser.add_argument('--control-cookie-file',
@@ -7,7 +7,7 @@ from os import urandom, path
 from base64 import b64encode, b64decode
 from binascii import hexlify, unhexlify
 
-from twisted.internet import task
+from twisted.internet import defer, task
 from twisted.protocols.basic import LineOnlyReceiver
 
 from cryptography.hazmat.primitives.hashes import SHA256
@@ -1101,12 +1101,21 @@ class PrivCountClientProtocol(PrivCountProtocol):
 
     def handle_stop_event(self, event_type, event_payload):
         stop_config = json.loads(event_payload)
-        result_data = self.factory.do_stop(stop_config)
+        # data collectors return a deferred, because they wait for their
+        # aggregator to stop
+        stop_deferred = defer.maybeDeferred(self.factory.do_stop, stop_config)
+        stop_deferred.addCallback(self.send_stop_result)
+        stop_deferred.addErrback(errorCallback)
+        return True
+
+    def send_stop_result(self, result_data):
+        '''
+        Send result_data from do_stop() to the tally server.
+        '''
         if result_data is not None:
             self.sendLine("STOP SUCCESS {}".format(json.dumps(result_data)))
         else:
             self.sendLine("STOP FAIL")
-        return True
 
     def handle_checkin_event(self, event_type, event_payload):
         if event_type == "CHECKIN":
@@ -1586,6 +1595,11 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
     def __init__(self, factory):
         TorControlProtocol.__init__(self, factory)
         self.clear()
+        # this set never changes, so we only build it once
+        self.valid_events = get_valid_events()
+        # factories can handle a list of events at once, or one event at a
+        # time
+        self.handle_events = getattr(factory, 'handle_events', None)
 
     def clear(self):
         '''
@@ -1712,6 +1726,61 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
         self.check_line_length(line, False, False)
         return LineOnlyReceiver.sendLine(self, line)
 
+    def dataReceived(self, data):
+        '''
+        Translates bytes into lines. In the processing state, each run of
+        PrivCount event lines is parsed in one loop, and sent to the factory
+        as a list of events. Other lines are passed to lineReceived().
+        Keeps the MAX_LENGTH checks from LineOnlyReceiver.dataReceived().
+        Overrides twisted function.
+        '''
+        lines = (self._buffer + data).split(self.delimiter)
+        self._buffer = lines.pop(-1)
+        warn_length = self.get_warn_length(True)
+        is_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        events = []
+        for line in lines:
+            # if we quit while handling a line, ignore the rest of the data
+            # (events are always handled before we check this)
+            if self.transport.disconnecting:
+                return
+            if len(line) > self.MAX_LENGTH:
+                self.handleEvents(events)
+                return self.lineLengthExceeded(line)
+            if self.state == 'processing' and line.startswith("650 PRIVCOUNT_"):
+                # check_line_length() does nothing for short lines
+                if len(line) > warn_length:
+                    self.check_line_length(line, True, False)
+                event = self.parseEventLine(line.rstrip(), is_debug)
+                if event is not None:
+                    events.append(event)
+            else:
+                # the line might change the state, so we handle the events
+                # before it first
+                self.handleEvents(events)
+                events = []
+                self.lineReceived(line)
+        self.handleEvents(events)
+        if len(self._buffer) > self.MAX_LENGTH:
+            return self.lineLengthExceeded(self._buffer)
+
+    def handleEvents(self, events):
+        '''
+        Send events, a list of PrivCount events, to the factory, in order.
+        Quit if the factory fails to handle any event, without sending it
+        the rest of the events.
+        '''
+        if len(events) == 0:
+            return
+        if self.handle_events is not None:
+            if not self.handle_events(events):
+                self.quit()
+            return
+        for event in events:
+            if not self.factory.handle_event(event):
+                self.quit()
+                return
+
     def lineReceived(self, line):
         '''
         Check that protocolinfo was successful.
@@ -1722,7 +1791,8 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
         'waiting' state.
         When the round is started, put the protocol in the 'processing' state,
         and send the list of events we want.
-        When events are received, process them.
+        When events are received, process them. (dataReceived() handles
+        most events itself, without calling this function.)
         Overrides twisted function.
         '''
         logging.debug("Received line '{}' from {}"
@@ -1936,27 +2006,42 @@ class TorControlClientProtocol(LineOnlyReceiver, TorControlProtocol):
             # log ok events while we're waiting for round start
             self.handleUnexpectedLine(line)
         elif self.state == 'processing' and line.startswith("650 PRIVCOUNT_"):
-            parts = line.split(" ")
-            assert len(parts) > 1
-            # log the event
-            self.has_received_events = True
-            logging.debug("receiving event '{}'".format(line))
-            # skip unwanted events
-            if not parts[1] in self.active_events:
-                if not parts[1] in get_valid_events():
-                    logging.warning("Unknown event type {}".format(line))
-                else:
-                    logging.warning("Unwanted event type {}".format(line))
-            # skip empty events
-            elif len(parts) <= 2:
-                logging.warning("Event with no data {}".format(line))
-            # send the event, including the event type
-            elif not self.factory.handle_event(parts[1:]):
-                self.quit()
-                return
+            event = self.parseEventLine(line,
+                                        logging.getLogger().isEnabledFor(
+                                            logging.DEBUG))
+            if event is not None:
+                self.handleEvents([event])
         else:
             self.handleUnexpectedLine(line)
 
+    def parseEventLine(self, line, is_debug):
+        '''
+        Parse the PrivCount event in line, and return the event, including
+        the event type. Log and return None for unwanted and empty events.
+        line must start with "650 PRIVCOUNT_", and have no trailing spaces.
+        If is_debug is True, log the event at debug level.
+        This is the only event parser, it is used by dataReceived() and
+        lineReceived().
+        '''
+        parts = line.split(" ")
+        # log the event
+        self.has_received_events = True
+        if is_debug:
+            logging.debug("receiving event '{}'".format(line))
+        # the common case: a wanted event with data
+        if parts[1] in self.active_events and len(parts) > 2:
+            return parts[1:]
+        # skip unwanted events
+        if not parts[1] in self.active_events:
+            if not parts[1] in self.valid_events:
+                logging.warning("Unknown event type {}".format(line))
+            else:
+                logging.warning("Unwanted event type {}".format(line))
+        # skip empty events
+        else:
+            logging.warning("Event with no data {}".format(line))
+        return None
+
     def handleUnexpectedLine(self, line):
         '''
         Log any unexpected responses at an appropriate level.
@@ -2123,6 +2208,15 @@ class TorControlServerProtocol(LineOnlyReceiver, TorControlProtocol):
         self.check_line_length(line, False, False)
         return LineOnlyReceiver.sendLine(self, line)
 
+    def sendLines(self, lines):
+        '''
+        Send lines in a single write, without logging each line.
+        '''
+        for line in lines:
+            self.check_line_length(line, False, False)
+        return self.transport.write(self.delimiter.join(lines) +
+                                    self.delimiter)
+
     def lineReceived(self, line):
         '''
         overrides twisted function
@@ -943,7 +943,11 @@ class CollectionPhase(object):
         self.stopping_ts = None
         self.encrypted_shares = {} # uids of SKs to which we send shares {sk_uid : share_data}
         self.need_shares = set() # uids of DCs from which we still need encrypted shares
-        self.final_counts = {} # uids of clients and their final reported counts
+        # the running tally of the final counts reported by clients
+        # each client's counts are added to the tally as soon as they arrive
+        self.tallied_counter = None
+        self.tallied_uids = set() # uids of clients whose counts are tallied
+        self.tally_failed = False
         self.need_counts = set() # uids of clients from which we still need final counts
         self.error_flag = False
 
@@ -1075,13 +1079,34 @@ class CollectionPhase(object):
                     logging.info("received {} counters ({} bins) from stopped client {}"
                                  .format(len(counts), count_bins(counts),
                                          cname))
-                    # add up the tallies from the client
-                    self.final_counts[client_uid] = counts
+                    # add the counts from the client to the running tally
+                    self.tally_counts(client_uid, counts)
                 else:
                     logging.warning("received counts: error from stopped client {}"
                                     .format(cname))
                 self.need_counts.remove(client_uid)
 
+    def tally_counts(self, client_uid, counts):
+        '''
+        Validate counts from client_uid, and add them to the running tally.
+        counts is not retained, so the tally server only needs to keep one
+        set of counts in memory, regardless of the number of clients.
+        If the counts do not match the counters config, the tally fails.
+        '''
+        if self.tally_failed:
+            return
+        if self.tallied_counter is None:
+            self.tallied_counter = SecureCounters(self.counters_config,
+                                                  self.modulus)
+        if self.tallied_counter.tally_counter(counts):
+            self.tallied_uids.add(client_uid)
+        else:
+            logging.warning("counts from {} did not match the counters config, final results will not be available"
+                            .format(TallyServer.get_client_display_name(client_uid)))
+            self.tally_failed = True
+            # we don't need the partial tally any more
+            self.tallied_counter = None
+
     def is_participating(self, client_uid):
         return True if client_uid in self.sk_uids or client_uid in self.dc_uids else False
 
@@ -1392,13 +1417,13 @@ class CollectionPhase(object):
 
         # keep going, we want the context for debugging
         tally_was_successful = False
-        if len(self.final_counts) <= 0:
+        if len(self.tallied_uids) <= 0 and not self.tally_failed:
             logging.warning("no tally results to write!")
-        else:
-            tallied_counter = SecureCounters(self.counters_config,
-                                             self.modulus)
-            tally_was_successful = tallied_counter.tally_counters(
-                self.final_counts.values())
+        elif not self.tally_failed:
+            # now adjust so our tally can register negative counts
+            tallied_counter = self.tallied_counter
+            tallied_counter.adjust_counts_signed()
+            tally_was_successful = True
 
         begin = int(round(self.starting_ts))
         end = int(round(self.stopping_ts))
@@ -1444,7 +1469,8 @@ class CollectionPhase(object):
                      "was successful" if tally_was_successful else "failed",
                      format_interval_time_between(begin, 'from', end),
                      filepath))
-        self.final_counts = {}
+        self.tallied_counter = None
+        self.tallied_uids = set()
 
     def log_status(self):
         message = "collection phase is in '{}' state".format(self.state)
@@ -7,6 +7,8 @@ See LICENSE for licensing information
 '''
 import math
 import logging
+import struct
+import sys
 
 from time import clock
 
@@ -193,16 +195,26 @@ class TrafficModel(object):
 
         return bins_dict
 
-    def run_viterbi(self, obs):
+    def run_viterbi(self, obs, prev_state=None):
         '''
         Given a list of packet observations of the form ('+' or '-', delay_time), e.g.:
             [('+', 10), ('+', 20), ('+', 50), ('+', 1000)]
         Run the viterbi dynamic programming algorithm to determine which path through the HMM has the highest probability, i.e., closest match to these observations.
+        If prev_state is not None, the observations continue a path that
+        ended in prev_state, so the path starts with a transition from
+        prev_state, rather than a starting state.
         '''
         SQRT_2_PI = math.sqrt(2*math.pi)
+        if prev_state is None:
+            initial_p = self.start_p
+        else:
+            initial_p = self.trans_p.get(prev_state, {})
         V = [{}]
         for st in self.states:
-            if st in self.start_p and self.start_p[st] > 0:
+            # states that can't emit the first packet's direction are
+            # impossible, like the t > 0 case below
+            if (st in initial_p and initial_p[st] > 0 and
+                obs[0][0] in self.emit_p[st]):
                 # updated emit_p here
                 (direction, delay) = obs[0]
                 (dp, mu, sigma) = self.emit_p[st][direction]
@@ -212,7 +224,7 @@ class TrafficModel(object):
                 fitprob = math.log(dp) + delay_logp
                 # replaced the following line
                 #V[0][st] = {"prob": start_p[st] * emit_p[st][obs[0]], "prev": None}
-                V[0][st] = {"prob": math.log(self.start_p[st]) + fitprob, "prev": None}
+                V[0][st] = {"prob": math.log(initial_p[st]) + fitprob, "prev": None}
             else:
                 V[0][st] = {"prob": float("-inf"), "prev": None }
         # Run Viterbi when t > 0
@@ -281,6 +293,13 @@ class TrafficModel(object):
         '''
         return (((amount + factor/2)/factor)*factor)
 
+    @staticmethod
+    def _add_inc(counter_incs, label, inc):
+        '''
+        Add inc to the total for label in counter_incs.
+        '''
+        counter_incs[label] = counter_incs.get(label, 0) + inc
+
     def _get_inter_packet_delays(self, strm_start_ts, byte_events):
         '''
         Take a list of (bw_bytes, is_outbound, ts) and turn them into packet delay
@@ -291,72 +310,12 @@ class TrafficModel(object):
           - the returned list of observations is suitable to pass to
             TrafficModel.run_viterbi() to find the most likly path (series of states)
             through our traffic model
+        See StreamPacketBuffer for details.
         '''
-        packet_delays = []
-        num_events = len(byte_events)
-        stream_packet_count = 0
-        logged_event_warning = False
-        logged_stream_warning = False
-        last_packet_ts = strm_start_ts
-        for i in xrange(num_events):
-            (bw_bytes, is_outbound, ts) = byte_events[i]
-
-            # a certain number of bytes were read from the kernel, turn these into packets
-            dir_code = '+' if is_outbound else '-' # '-' for "inbound" direction
-            # ts is unix timestamp in sec.microsec, like 12345678.123456
-            # so delay will be in microseconds
-            inter_packet_delay_seconds = ts - last_packet_ts
-            last_packet_ts = ts
-            micros = inter_packet_delay_seconds * 1000000
-            delay = max(long(0), long(micros))
-
-            # ceil(), but with integers
-            event_packet_count = ((bw_bytes + TrafficModel.PACKET_BYTE_COUNT - 1)
-                                  /TrafficModel.PACKET_BYTE_COUNT)
-            stream_packet_count += min(event_packet_count,
-                                       TrafficModel.MAX_EVENT_PACKET_COUNT)
-
-            # warn on large events, but only once per stream
-            # tor should never send us an event this big
-            if (event_packet_count > TrafficModel.MAX_EVENT_PACKET_COUNT
-                and not logged_event_warning):
-                # round the counts, for at least a little user protection
-                rounded_bw_bytes = TrafficModel._integer_round(
-                                            bw_bytes,
-                                            TrafficModel.MAX_EVENT_BYTE_COUNT)
-                rounded_event_packet_count = TrafficModel._integer_round(
-                                            event_packet_count,
-                                            TrafficModel.MAX_EVENT_PACKET_COUNT)
-
-                logging.warning("Large byte transfer event: {} bytes is {} packets. Limiting event to {} packets of {} bytes."
-                                .format(rounded_bw_bytes,
-                                        rounded_event_packet_count,
-                                        TrafficModel.MAX_EVENT_PACKET_COUNT,
-                                        TrafficModel.PACKET_BYTE_COUNT))
-                logged_event_warning = True
-
-            # create a packet delay for each packet
-            event_packet_count = 0
-            while bw_bytes > 0 and event_packet_count < TrafficModel.MAX_EVENT_PACKET_COUNT:
-                packet_delays.append((dir_code, delay))
-                event_packet_count += 1
-                # the first packet gets all of the delay, the others arrive at the same time
-                delay = 0
-                bw_bytes -= TrafficModel.PACKET_BYTE_COUNT
-
-        # we log a warning here in case PrivCount hangs in vitterbi
-        # (it could hang processing packets, but that's very unlikely)
-        if stream_packet_count > TrafficModel.MAX_STREAM_PACKET_COUNT:
-            # round the packet count to the nearest
-            # TrafficModel.MAX_STREAM_PACKET_COUNT, for at least a little user
-            # protection
-            rounded_stream_packet_count = TrafficModel._integer_round(
-                                          stream_packet_count,
-                                          TrafficModel.MAX_STREAM_PACKET_COUNT)
-            logging.info("Large stream packet count: ~{} packets. Stream packet limit is {} packets."
-                         .format(rounded_stream_packet_count,
-                                 TrafficModel.MAX_STREAM_PACKET_COUNT))
-        return packet_delays
+        packet_buffer = StreamPacketBuffer()
+        for (bw_bytes, is_outbound, ts) in byte_events:
+            packet_buffer.add_bytes_event(bw_bytes, is_outbound, ts)
+        return packet_buffer.get_packet_delays(strm_start_ts)
 
     def increment_traffic_counters(self, strm_start_ts, byte_events, secure_counters):
         '''
@@ -373,10 +332,126 @@ class TrafficModel(object):
         # turn the bytes events into 'packet' events, and compute delay between packets
         observed_packet_delays = self._get_inter_packet_delays(strm_start_ts, byte_events)
 
+        self.increment_packet_counters(observed_packet_delays, secure_counters,
+                                       packet_start_time=packet_start_time)
+
+    def increment_packet_buffer_counters(self, strm_start_ts, packet_buffer,
+                                         secure_counters, stream_times=None):
+        '''
+        Increment the appropriate secure counter labels for this model given
+        the packets in packet_buffer, a StreamPacketBuffer.
+          strm_start_ts: the start time of the stream carrying these packets,
+            or None if the first packet has no delay
+          packet_buffer: the packets on the stream
+          secure_counters: the SecureCounters object whose counters should
+            get incremented as a result of the observed packets
+          stream_times: see get_packet_counter_increments()
+        If some packets on the stream have already been decoded, the path
+        continues from packet_buffer.last_state. This function updates
+        packet_buffer.last_state to the state of the last packet.
+        '''
+        packet_start_time = clock()
+        observed_packet_delays = packet_buffer.get_packet_delays(strm_start_ts)
+        (counter_incs, packet_buffer.last_state) = self.decode_packet_delays(
+                                    observed_packet_delays,
+                                    prev_state=packet_buffer.last_state,
+                                    packet_start_time=packet_start_time,
+                                    stream_times=stream_times)
+        TrafficModel.increment_counters(counter_incs, secure_counters)
+
+    def increment_packet_counters(self, observed_packet_delays,
+                                  secure_counters, packet_start_time=None,
+                                  stream_times=None):
+        '''
+        Increment the appropriate secure counter labels for this model given
+        a list of packet delay observations, in the format returned by
+        _get_inter_packet_delays().
+          secure_counters: the SecureCounters object whose counters should
+            get incremented as a result of the observed packets
+          packet_start_time: the time we started turning bytes into packets,
+            used to log slow streams
+          stream_times: see get_packet_counter_increments()
+        '''
+        counter_incs = self.get_packet_counter_increments(
+                                    observed_packet_delays,
+                                    packet_start_time=packet_start_time,
+                                    stream_times=stream_times)
+        TrafficModel.increment_counters(counter_incs, secure_counters)
+
+    # the keys in each stream_times dict
+    STREAM_TIMES_KEYS = ['stream_count', 'packet_count', 'packet_seconds',
+                         'viterbi_seconds', 'counter_seconds']
+
+    @staticmethod
+    def new_stream_times():
+        '''
+        Return a new stream_times dict, with zero for each item.
+        '''
+        return dict((key, 0) for key in TrafficModel.STREAM_TIMES_KEYS)
+
+    @staticmethod
+    def add_stream_times(stream_times, add_times):
+        '''
+        Add each item in the stream_times dict add_times to stream_times.
+        '''
+        for key in TrafficModel.STREAM_TIMES_KEYS:
+            stream_times[key] += add_times[key]
+
+    @staticmethod
+    def increment_counters(counter_incs, secure_counters):
+        '''
+        Increment secure_counters using counter_incs, a dict of increments
+        for each counter label from get_packet_counter_increments().
+        '''
+        # the traffic model counters all have a single bin
+        for label in counter_incs:
+            secure_counters.increment(label,
+                                      bin=SINGLE_BIN,
+                                      inc=counter_incs[label])
+
+    def get_packet_counter_increments(self, observed_packet_delays,
+                                      packet_start_time=None,
+                                      stream_times=None):
+        '''
+        Return a dict containing the increment for each counter label for
+        this model given a list of packet delay observations, in the format
+        returned by _get_inter_packet_delays().
+          packet_start_time: the time we started turning bytes into packets,
+            used to log slow streams
+          stream_times: if not None, a dict from new_stream_times(), which
+            this function adds its stream and packet counts, and its
+            packet, viterbi, and counter processing times to
+        This function does not modify the model, so it can be called from
+        any thread.
+        '''
+        (counter_incs, _) = self.decode_packet_delays(
+                                    observed_packet_delays,
+                                    packet_start_time=packet_start_time,
+                                    stream_times=stream_times)
+        return counter_incs
+
+    def decode_packet_delays(self, observed_packet_delays, prev_state=None,
+                             packet_start_time=None, stream_times=None):
+        '''
+        Like get_packet_counter_increments(), but returns a tuple containing
+        the counter increments, and the state of the last packet.
+          prev_state: if not None, the state of the last packet before
+            observed_packet_delays on the same stream. The path continues
+            from prev_state: the first packet is counted as a transition from
+            prev_state, rather than a starting transition, and the stream is
+            not counted again in stream_times.
+        If observed_packet_delays is empty, the last state is prev_state.
+        '''
         viterbi_start_time = clock()
+        if packet_start_time is None:
+            packet_start_time = viterbi_start_time
 
         # get the likliest path through our model given the observed delays
-        likliest_states = self.run_viterbi(observed_packet_delays)
+        if len(observed_packet_delays) > 0:
+            likliest_states = self.run_viterbi(observed_packet_delays,
+                                               prev_state=prev_state)
+        else:
+            likliest_states = []
 
         counter_start_time = clock()
 
@@ -404,6 +479,9 @@ class TrafficModel(object):
             Blabbing_Blabbing, Blabbing_Blabbing, Blabbing_Thinking
         '''
 
+        # sum the increments for each counter, then increment each counter
+        # once, rather than once per packet
+        counter_incs = {}
         for i in xrange(num_packets):
             state = likliest_states[i]
 
@@ -415,44 +493,40 @@ class TrafficModel(object):
             # we don't want to count negatives, so override delay if needed
             ldelay = 0 if delay < 1 else int(math.log(delay))
 
-            secure_counters.increment('ExitStreamTrafficModelEmissionCount',
-                                      bin=SINGLE_BIN,
-                                      inc=1)
+            TrafficModel._add_inc(counter_incs,
+                                  'ExitStreamTrafficModelEmissionCount',
+                                  1)
             label = 'ExitStreamTrafficModelEmissionCount_{}_{}'.format(state, dir_code)
-            secure_counters.increment(label,
-                                      bin=SINGLE_BIN,
-                                      inc=1)
+            TrafficModel._add_inc(counter_incs, label, 1)
 
-            secure_counters.increment('ExitStreamTrafficModelLogDelayTime',
-                                      bin=SINGLE_BIN,
-                                      inc=ldelay)
+            TrafficModel._add_inc(counter_incs,
+                                  'ExitStreamTrafficModelLogDelayTime',
+                                  ldelay)
             label = 'ExitStreamTrafficModelLogDelayTime_{}_{}'.format(state, dir_code)
-            secure_counters.increment(label,
-                                      bin=SINGLE_BIN,
-                                      inc=ldelay)
+            TrafficModel._add_inc(counter_incs, label, ldelay)
 
-            secure_counters.increment('ExitStreamTrafficModelSquaredLogDelayTime',
-                                      bin=SINGLE_BIN,
-                                      inc=ldelay*ldelay)
+            TrafficModel._add_inc(counter_incs,
+                                  'ExitStreamTrafficModelSquaredLogDelayTime',
+                                  ldelay*ldelay)
             label = 'ExitStreamTrafficModelSquaredLogDelayTime_{}_{}'.format(state, dir_code)
-            secure_counters.increment(label,
-                                      bin=SINGLE_BIN,
-                                      inc=ldelay*ldelay)
+            TrafficModel._add_inc(counter_incs, label, ldelay*ldelay)
 
-            if i == 0: # track starting transitions
+            if i == 0 and prev_state is None: # track starting transitions
                 label = 'ExitStreamTrafficModelTransitionCount_START_{}'.format(state)
-                secure_counters.increment(label,
-                                          bin=SINGLE_BIN,
-                                          inc=1)
+                TrafficModel._add_inc(counter_incs, label, 1)
+            elif i == 0: # track the transition from the previous packets
+                TrafficModel._add_inc(counter_incs,
+                                      'ExitStreamTrafficModelTransitionCount',
+                                      1)
+                label = 'ExitStreamTrafficModelTransitionCount_{}_{}'.format(prev_state, state)
+                TrafficModel._add_inc(counter_incs, label, 1)
             if (i+1) < num_states:
                 next_state = likliest_states[i+1]
-                secure_counters.increment('ExitStreamTrafficModelTransitionCount',
-                                          bin=SINGLE_BIN,
-                                          inc=1)
+                TrafficModel._add_inc(counter_incs,
+                                      'ExitStreamTrafficModelTransitionCount',
+                                      1)
                 label = 'ExitStreamTrafficModelTransitionCount_{}_{}'.format(state, next_state)
-                secure_counters.increment(label,
-                                          bin=SINGLE_BIN,
-                                          inc=1)
+                TrafficModel._add_inc(counter_incs, label, 1)
 
         algo_end_time = clock()
         algo_elapsed = algo_end_time - packet_start_time
@@ -460,6 +534,14 @@ class TrafficModel(object):
         viterbi_elapsed = counter_start_time - viterbi_start_time
         counter_elapsed = algo_end_time - counter_start_time
 
+        if stream_times is not None:
+            if prev_state is None:
+                stream_times['stream_count'] += 1
+            stream_times['packet_count'] += num_packets
+            stream_times['packet_seconds'] += packet_elapsed
+            stream_times['viterbi_seconds'] += viterbi_elapsed
+            stream_times['counter_seconds'] += counter_elapsed
+
         if algo_elapsed > TrafficModel.MAX_STREAM_PROCESSING_TIME:
             rounded_num_packets = TrafficModel._integer_round(
                                           num_packets,
@@ -472,6 +554,9 @@ class TrafficModel(object):
         # TODO: secure delete
         #del observed_packet_delays
         #del likliest_states
+        if num_states > 0:
+            prev_state = likliest_states[-1]
+        return (counter_incs, prev_state)
 
     def update_from_tallies(self, tallies, trans_inertia=0.1, emit_inertia=0.1):
         '''
@@ -572,3 +657,157 @@ class TrafficModel(object):
             'emission_probability': self.emit_p
         }
         return updated_model_config
+
+class StreamPacketBuffer(object):
+    '''
+    A compact buffer containing the packets on a stream, for a TrafficModel.
+
+    Each bytes event is split into packets when it arrives. The event's
+    packets are stored as a run: a direction code, the delay before the
+    first packet, and a packet count. The other packets in the run arrive at
+    the same time as the first packet. Runs are packed into a single
+    bytearray, rather than storing a list per event.
+
+    The delay before the first packet on the stream is not known until the
+    stream ends, so it is calculated in get_packet_delays().
+    '''
+
+    __slots__ = ('packet_count', 'first_ts', 'last_ts', 'has_start_delay',
+                 'logged_event_warning', 'last_tick', 'last_state',
+                 'pending_delays', 'is_dropped', 'runs')
+
+    # direction code, delay in microseconds, packet count
+    # doubles hold integer delays exactly, up to 2**53 microseconds
+    RUN_STRUCT = struct.Struct('<cdB')
+    assert TrafficModel.MAX_EVENT_PACKET_COUNT < 256
+
+    def __init__(self):
+        self.runs = bytearray()
+        # the number of packets in runs
+        self.packet_count = 0
+        self.first_ts = None
+        self.last_ts = None
+        # does the first run need a delay from the stream start?
+        self.has_start_delay = False
+        self.logged_event_warning = False
+        # the owner of the buffer can use this to expire unused buffers
+        self.last_tick = None
+        # the likeliest state of the last decoded packet, if the stream has
+        # been decoded in parts
+        self.last_state = None
+        # the packet delays waiting for an earlier part of the stream to be
+        # decoded, or None if no part of the stream is being decoded
+        self.pending_delays = None
+        # were some packets on the stream not decoded?
+        self.is_dropped = False
+
+    def add_bytes_event(self, bw_bytes, is_outbound, ts):
+        '''
+        Split a bytes event into packets, and add them to the buffer.
+          bw_bytes: the number of bytes transferred
+          is_outbound: the direction of the transfer
+          ts: the time of the transfer, a unix timestamp in seconds, like
+            12345678.123456
+        Returns the number of packets added.
+        '''
+        # a certain number of bytes were read from the kernel, turn these into packets
+        dir_code = '+' if is_outbound else '-' # '-' for "inbound" direction
+        is_first_event = self.last_ts is None
+        if is_first_event:
+            # we don't know the stream start time yet
+            self.first_ts = ts
+            delay = 0
+        else:
+            # so delay will be in microseconds
+            inter_packet_delay_seconds = ts - self.last_ts
+            micros = inter_packet_delay_seconds * 1000000
+            delay = max(long(0), long(micros))
+        self.last_ts = ts
+
+        # ceil(), but with integers
+        event_packet_count = ((bw_bytes + TrafficModel.PACKET_BYTE_COUNT - 1)
+                              /TrafficModel.PACKET_BYTE_COUNT)
+
+        # warn on large events, but only once per stream
+        # tor should never send us an event this big
+        if (event_packet_count > TrafficModel.MAX_EVENT_PACKET_COUNT
+            and not self.logged_event_warning):
+            # round the counts, for at least a little user protection
+            rounded_bw_bytes = TrafficModel._integer_round(
+                                        bw_bytes,
+                                        TrafficModel.MAX_EVENT_BYTE_COUNT)
+            rounded_event_packet_count = TrafficModel._integer_round(
+                                        event_packet_count,
+                                        TrafficModel.MAX_EVENT_PACKET_COUNT)
+
+            logging.warning("Large byte transfer event: {} bytes is {} packets. Limiting event to {} packets of {} bytes."
+                            .format(rounded_bw_bytes,
+                                    rounded_event_packet_count,
+                                    TrafficModel.MAX_EVENT_PACKET_COUNT,
+                                    TrafficModel.PACKET_BYTE_COUNT))
+            self.logged_event_warning = True
+
+        if bw_bytes <= 0:
+            return 0
+        event_packet_count = min(event_packet_count,
+                                 TrafficModel.MAX_EVENT_PACKET_COUNT)
+        if is_first_event:
+            self.has_start_delay = True
+        self.runs += StreamPacketBuffer.RUN_STRUCT.pack(dir_code, delay,
+                                                        event_packet_count)
+        self.packet_count += event_packet_count
+        return event_packet_count
+
+    def get_packet_delays(self, strm_start_ts=None):
+        '''
+        Returns a list of packet delay observations of the form
+        [('+', 20), ('+', 10), ('+',50), ('+',1000)], in microseconds.
+        The first delay is the delay between strm_start_ts and the first
+        packet. If strm_start_ts is None, the first delay is zero.
+        Subsequent delays are inter-packet delays.
+        '''
+        packet_delays = []
+        run_size = StreamPacketBuffer.RUN_STRUCT.size
+        for offset in xrange(0, len(self.runs), run_size):
+            (dir_code, delay, run_packet_count) = \
+                StreamPacketBuffer.RUN_STRUCT.unpack_from(self.runs, offset)
+            if offset == 0 and self.has_start_delay:
+                if strm_start_ts is None:
+                    delay = long(0)
+                else:
+                    micros = (self.first_ts - strm_start_ts) * 1000000
+                    delay = max(long(0), long(micros))
+            else:
+                delay = long(delay)
+            packet_delays.append((dir_code, delay))
+            # the first packet gets all of the delay, the others arrive at the same time
+            packet_delays.extend([(dir_code, 0)] * (run_packet_count - 1))
+
+        # we log a warning here in case PrivCount hangs in vitterbi
+        # (it could hang processing packets, but that's very unlikely)
+        if self.packet_count > TrafficModel.MAX_STREAM_PACKET_COUNT:
+            # round the packet count to the nearest
+            # TrafficModel.MAX_STREAM_PACKET_COUNT, for at least a little user
+            # protection
+            rounded_stream_packet_count = TrafficModel._integer_round(
+                                          self.packet_count,
+                                          TrafficModel.MAX_STREAM_PACKET_COUNT)
+            logging.info("Large stream packet count: ~{} packets. Stream packet limit is {} packets."
+                         .format(rounded_stream_packet_count,
+                                 TrafficModel.MAX_STREAM_PACKET_COUNT))
+        return packet_delays
+
+    def get_size(self):
+        '''
+        Returns the approximate number of bytes used by this buffer.
+        '''
+        return sys.getsizeof(self) + sys.getsizeof(self.runs)
+
+    def clear_packets(self):
+        '''
+        Remove all the packets from the buffer, but keep the time of the last
+        event, so the delay before the next packet is correct.
+        '''
+        self.runs = bytearray()
+        self.packet_count = 0
+        self.has_start_delay = False
@@ -466,6 +466,30 @@ if [ "$PRIVCOUNT_UNIT_TESTS" -eq 1 ]; then
   python "$TEST_DIR/test_traffic_model.py"
   "$I" ""
 
+  "$I" "Testing tor control lines:"
+  python "$TEST_DIR/test_tor_ctl_lines.py"
+  "$I" ""
+
+  "$I" "Testing aggregator shards:"
+  python "$TEST_DIR/test_aggregator_shards.py"
+  "$I" ""
+
+  "$I" "Testing event logs:"
+  python "$TEST_DIR/test_event_log.py"
+  "$I" ""
+
+  "$I" "Testing event injection:"
+  python "$TEST_DIR/test_inject.py"
+  "$I" ""
+
+  "$I" "Testing workload generator:"
+  python "$TEST_DIR/test_generate.py"
+  "$I" ""
+
+  "$I" "Testing aggregator state expiry:"
+  python "$TEST_DIR/test_aggregator_state.py"
+  "$I" ""
+
   "$I" "Testing noise:"
   python "$TOOLS_DIR/compute_noise.py"
 
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# Check that a sharded Aggregator produces the same counts and state as an
+# unsharded Aggregator
+
+import os, random
+import yaml
+
+from twisted.internet import reactor
+from twisted.test.proto_helpers import StringTransport
+
+from privcount.counter import counter_modulus
+from privcount.data_collector import Aggregator
+from privcount.benchmark import synthetic_mixed_events, synthetic_client_circuit_events, wait_for_stop, WAIT_ITERATE_SECONDS
+
+# The path to the counters file, based on the location of privcount/test
+PRIVCOUNT_DIRECTORY = os.environ.get('PRIVCOUNT_DIRECTORY', os.getcwd())
+TEST_DIRECTORY = os.path.join(PRIVCOUNT_DIRECTORY, 'test')
+COUNTERS_FILENAME = os.path.join(TEST_DIRECTORY, "counters.bins.yaml")
+
+with open(COUNTERS_FILENAME, 'r') as fin:
+    counters = yaml.safe_load(fin)['counters']
+
+rng = random.Random(18)
+events = (synthetic_mixed_events(rng, 5000) +
+          synthetic_client_circuit_events(rng, 1000))
+rng.shuffle(events)
+# an event with the wrong number of items
+events.append(['PRIVCOUNT_CIRCUIT_ENDED', '1'])
+
+def get_counts(shard_count):
+    '''
+    Process events using an Aggregator with shard_count shards, rotating
+    three times, and return the results of each event, the final counts,
+    and the state context after the last rotation
+    '''
+    # no share keepers and no noise, so the counts are deterministic
+    aggregator = Aggregator(counters, None, [], {'*': 0.0},
+                            counter_modulus(), None, 600,
+                            state_timeout=1200, shard_count=shard_count)
+    results = []
+    for i in xrange(len(events)):
+        results.append(aggregator.handle_event(events[i]))
+        if i == len(events) // 2:
+            aggregator._do_rotate(rotate_time=1.0)
+    aggregator._do_rotate(rotate_time=2.0)
+    aggregator._do_rotate(rotate_time=3.0)
+    aggregator.noise_weight_value = 0.0
+    counts = wait_for_stop(aggregator)
+    # the shards send their state after each rotation, and they have
+    # processed every rotation when they stop
+    return (results, counts, aggregator.get_state_context())
+
+(unsharded_results, unsharded_counts, unsharded_state) = get_counts(1)
+assert unsharded_results[-1] == False
+assert unsharded_counts['EntryClientIPCount']['bins'][0][2] > 0
+# some circuits are expired by the rotations
+assert unsharded_state['circuit_state']['live_count'] > 0
+assert unsharded_state['circuit_state']['evicted_count'] > 0
+
+for shard_count in [2, 3]:
+    (sharded_results, sharded_counts, sharded_state) = get_counts(shard_count)
+    assert sharded_results == unsharded_results
+    assert sharded_counts == unsharded_counts
+    print "{} shards: counts match".format(shard_count)
+    # the state is split between the shards
+    assert sharded_state.pop('reported_shards') == shard_count
+    for state_key in ['circuit_state', 'stream_state']:
+        for count_key in ['live_count', 'evicted_count']:
+            assert (sharded_state[state_key][count_key] ==
+                    unsharded_state[state_key][count_key])
+    print "{} shards: state after rotation matches".format(shard_count)
+
+class ControlProtocol(object):
+    '''
+    A tor control protocol with a transport that can be paused
+    '''
+
+    def __init__(self):
+        self.transport = StringTransport()
+
+# when a shard's pipe is full, the aggregator stops reading events from tor,
+# until the shard catches up
+aggregator = Aggregator(counters, None, [], {'*': 0.0}, counter_modulus(),
+                        None, 600, shard_count=2)
+aggregator.protocol = ControlProtocol()
+for event in events:
+    aggregator.handle_event(event)
+assert aggregator.protocol.transport.producerState == 'paused'
+while aggregator.protocol.transport.producerState == 'paused':
+    reactor.iterate(WAIT_ITERATE_SECONDS)
+aggregator.protocol = None
+aggregator.noise_weight_value = 0.0
+assert wait_for_stop(aggregator) is not None
+print "shards pause and resume events"
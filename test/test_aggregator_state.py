@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# Check that the Aggregator's state timing wheels only hold the circuits and
+# streams that are still live, and that idle state is expired
+
+import os, json
+import yaml
+
+from random import Random
+
+from privcount.counter import counter_modulus
+from privcount.data_collector import Aggregator
+from privcount.generate import WorkloadGenerator
+from privcount.traffic_model import TrafficModel
+
+# The path to the counters and model files, based on the location of
+# privcount/test
+PRIVCOUNT_DIRECTORY = os.environ.get('PRIVCOUNT_DIRECTORY', os.getcwd())
+TEST_DIRECTORY = os.path.join(PRIVCOUNT_DIRECTORY, 'test')
+COUNTERS_FILENAME = os.path.join(TEST_DIRECTORY, "counters.bins.yaml")
+MODEL_FILENAME = os.path.join(TEST_DIRECTORY, "traffic.model.json")
+
+with open(COUNTERS_FILENAME, 'r') as fin:
+    counters = yaml.safe_load(fin)['counters']
+with open(MODEL_FILENAME, 'r') as fin:
+    model = json.load(fin)
+counters.update(TrafficModel(model).get_bins_init_config())
+
+STATE_TIMEOUT = 100
+
+def get_live_counts(aggregator):
+    '''
+    Return the number of live circuit and stream state entries
+    '''
+    state_context = aggregator.get_state_context()
+    return (state_context['circuit_state']['live_count'],
+            state_context['stream_state']['live_count'])
+
+def get_wheel_counts(aggregator):
+    '''
+    Return the number of keys in the circuit and stream timing wheels
+    '''
+    return (aggregator.circ_info_wheel.get_key_count(),
+            aggregator.strm_bytes_wheel.get_key_count())
+
+aggregator = Aggregator(counters, model, [], {'*': 0.0}, counter_modulus(),
+                        None, 1, state_timeout=STATE_TIMEOUT)
+generator = WorkloadGenerator(Random(15), start_time=1480000000.0,
+                              connection_lifetime=30.0, circuit_lifetime=10.0)
+for (i, event) in enumerate(generator.generate_events(20000)):
+    assert aggregator.handle_event(event)
+    # rotate about once per second of events
+    if i % 500 == 0:
+        aggregator._expire_state()
+
+# circuits and streams that have ended are not in the wheels
+(circuit_count, stream_count) = get_live_counts(aggregator)
+assert circuit_count > 0 and stream_count > 0
+assert generator.event_counts['PRIVCOUNT_STREAM_ENDED'] > stream_count
+assert get_wheel_counts(aggregator) == (circuit_count, stream_count)
+# we only keep slots for ticks that have keys
+assert len(aggregator.circ_info_wheel.slots) <= STATE_TIMEOUT + 1
+assert len(aggregator.strm_bytes_wheel.slots) <= STATE_TIMEOUT + 1
+print "{} live circuits and {} live streams are in the timing wheels".format(
+    circuit_count, stream_count)
+
+# idle state is expired after the state timeout
+for _ in xrange(STATE_TIMEOUT + 1):
+    aggregator._expire_state()
+assert get_live_counts(aggregator) == (0, 0)
+assert get_wheel_counts(aggregator) == (0, 0)
+assert len(aggregator.circ_info_wheel.slots) == 0
+state_context = aggregator.get_state_context()
+assert state_context['circuit_state']['evicted_count'] == circuit_count
+assert state_context['stream_state']['evicted_count'] == stream_count
+print "idle circuits and streams expire"
@@ -8,7 +8,7 @@ import sys
 from math import sqrt
 from random import SystemRandom
 
-from privcount.counter import SecureCounters, adjust_count_signed, counter_modulus, add_counter_limits_to_config, get_events_for_known_counters
+from privcount.counter import SecureCounters, adjust_count_signed, counter_modulus, add_counter_limits_to_config, get_events_for_known_counters, get_modulus_mask
 SINGLE_BIN = SecureCounters.SINGLE_BIN
 
 import logging
@@ -53,6 +53,126 @@ counters = {
   },
 }
 
+# Some counters with unusual bins, used to check the bin index
+index_counters = {
+  'UnsortedHistogram': {
+    'bins':
+    [
+      [100.0, float('inf')],
+      [-1.0, 0.0],
+      [10.0, 100.0],
+      # deliberate gap
+      [0.5, 1.0],
+    ],
+    'sigma': 0.0
+  },
+  'OverlappingHistogram': {
+    'bins':
+    [
+      [0.0, 10.0],
+      [5.0, 15.0],
+      [float('-inf'), float('inf')],
+    ],
+    'sigma': 0.0
+  },
+}
+
+# Values that are on, near, or between the bin boundaries above
+index_values = [float('-inf'), -1000.0, -1.0, -0.5, 0.0, 0.25, 0.5, 0.75, 1.0,
+                5.0, 9.99, 10.0, 14.0, 15.0, 99.0, 100.0, 1.0e300,
+                float('inf')]
+
+def check_bin_index(counters, values):
+    '''
+    check that increment() finds the same bins as is_in_bin() for each value
+    '''
+    for key in counters:
+        # single bin counters don't use the index
+        if len(counters[key]['bins']) == 1:
+            continue
+        for value in values:
+            sc = SecureCounters({key: counters[key]}, counter_modulus())
+            sc.increment(key, bin=value, inc=1)
+            counts = sc.detach_counts()
+            for item in counts[key]['bins']:
+                expected = 1 if SecureCounters.is_in_bin(item[0], item[1],
+                                                         value) else 0
+                assert item[2] == expected
+
+def check_increment_many(counters, values, incs=None):
+    '''
+    check that increment_many() gives the same counts as calling increment()
+    for each value, using both the numpy and pure-python binning
+    '''
+    for key in counters:
+        # single bin counters only accept SINGLE_BIN
+        if len(counters[key]['bins']) == 1:
+            key_values = [SINGLE_BIN] * len(values)
+        else:
+            key_values = values
+        sc_single = SecureCounters({key: counters[key]}, counter_modulus())
+        for i in xrange(len(key_values)):
+            sc_single.increment(key, bin=key_values[i],
+                                inc=1 if incs is None else incs[i])
+        expected = sc_single.detach_counts()
+        sc_many = SecureCounters({key: counters[key]}, counter_modulus())
+        sc_many.increment_many(key, key_values, incs)
+        assert sc_many.detach_counts() == expected
+        # force the pure-python binning
+        sc_python = SecureCounters({key: counters[key]}, counter_modulus())
+        sc_python.bin_arrays = {}
+        sc_python.increment_many(key, key_values, incs)
+        assert sc_python.detach_counts() == expected
+
+def check_counter_handles(counters, values, incs, modulus):
+    '''
+    check that counter handles give the same counts as increment() and
+    increment_many(), and that unknown counters get a handle that does nothing
+    '''
+    sc_name = SecureCounters(counters, modulus)
+    sc_handle = SecureCounters(counters, modulus)
+    handles = sc_handle.get_counter_handles(counters.keys() +
+                                            ['UnknownCounter'])
+    for key in counters:
+        # single bin counters only accept SINGLE_BIN
+        if len(counters[key]['bins']) == 1:
+            key_values = [SINGLE_BIN] * len(values)
+        else:
+            key_values = values
+        for i in xrange(len(key_values)):
+            sc_name.increment(key, bin=key_values[i], inc=incs[i])
+            handles[key].increment(bin=key_values[i], inc=incs[i])
+        sc_name.increment_many(key, key_values, incs)
+        handles[key].increment_many(key_values, incs)
+    handles['UnknownCounter'].increment(bin=SINGLE_BIN, inc=1)
+    handles['UnknownCounter'].increment_many(values)
+    # histogram handles do not accept SINGLE_BIN
+    for key in counters:
+        if len(counters[key]['bins']) == 1:
+            continue
+        try:
+            handles[key].increment(bin=SINGLE_BIN, inc=1)
+        except AssertionError:
+            pass
+        else:
+            assert False, "{} handle accepted SINGLE_BIN".format(key)
+    assert sc_handle.detach_counts() == sc_name.detach_counts()
+
+def check_modulus_mask(modulus):
+    '''
+    check that get_modulus_mask() reduces values exactly like %, including
+    negative values, and values much larger than modulus
+    '''
+    mask = get_modulus_mask(modulus)
+    if modulus & (modulus - 1L) != 0L:
+        assert mask is None
+        return
+    assert mask is not None
+    for value in [0L, 1L, -1L, modulus - 1L, modulus, modulus + 1L,
+                  -modulus, -modulus - 1L, modulus * 3L + 5L,
+                  SystemRandom().randrange(-modulus * 4L, modulus * 4L)]:
+        assert value & mask == value % modulus
+
 def check_adjust_count_signed(modulus):
     '''
     check that adjust_count_signed works as expected for modulus
@@ -83,9 +203,8 @@ def check_blinding_values(secure_counters, modulus):
     if not, there is a coding error that affects the security of the system
     '''
     blinding_value_list = []
-    for key in secure_counters.counters:
-        for item in secure_counters.counters[key]['bins']:
-            blinding_value_list.append(item[2])
+    for key in secure_counters.counts:
+        blinding_value_list.extend(secure_counters.counts[key])
     # are all the blinding values unique?
     # only check if the number of items is very small compared with modulus
     # RAM bit error rates are up to 10^-13 per second
@@ -277,7 +396,17 @@ def sum_counters(counters, modulus, dc_list, sk_list):
     counts_list = counts_dc_list + counts_sk_list
     is_tally_success = sc_ts.tally_counters(counts_list)
     assert is_tally_success
-    return sc_ts.detach_counts()
+    tallies = sc_ts.detach_counts()
+
+    # tally them up incrementally, like the tally server does
+    sc_inc = SecureCounters(counters, modulus)
+    for counts in counts_list:
+        assert sc_inc.tally_counter(counts)
+        # a mismatched counter is rejected, and does not change the tally
+        assert not sc_inc.tally_counter({})
+    sc_inc.adjust_counts_signed()
+    assert sc_inc.detach_counts() == tallies
+    return tallies
 
 def check_counters(tallies, N, multi_bin=True):
     '''
@@ -354,6 +483,38 @@ def try_counters(counters, modulus, N, X=None, multi_bin=True):
 # Check the counter table is valid, and perform internal checks
 assert len(get_events_for_known_counters()) > 0
 
+# Check that the bin index matches is_in_bin()
+logging.info("Bin index lookups:")
+check_bin_index(counters, index_values)
+check_bin_index(index_counters, index_values)
+logging.info("Success!")
+
+# Check that increment_many() matches increment()
+logging.info("Bulk increments:")
+many_values = index_values * SecureCounters.NUMPY_MIN_VALUES
+many_incs = [SystemRandom().choice([1, -1, 2.5, 2L**65L, -2L**69L])
+             for _ in many_values]
+for many_counters in [counters, index_counters]:
+    check_increment_many(many_counters, many_values)
+    check_increment_many(many_counters, many_values, many_incs)
+    check_increment_many(many_counters, index_values[:3], many_incs[:3])
+    check_increment_many(many_counters, [], [])
+logging.info("Success!")
+
+# Check that counter handles match increment()
+logging.info("Counter handles:")
+for handle_counters in [counters, index_counters]:
+    for modulus in [counter_modulus(), counter_modulus() + 1L]:
+        check_counter_handles(handle_counters, many_values, many_incs, modulus)
+logging.info("Success!")
+
+# Check that bitmask reduction matches %
+logging.info("Modulus bitmasks:")
+for modulus in [1L, 2L, 3L, 4L, 6L, 2L**64L, counter_modulus() - 1L,
+                counter_modulus(), counter_modulus() + 1L]:
+    check_modulus_mask(modulus)
+logging.info("Success!")
+
 # Check that unsigned to signed conversion works with odd and even modulus
 logging.info("Unsigned to signed counter conversion, modulus = 3:")
 # for odd  modulus, returns { -modulus//2, ... , 0, ... , modulus//2 }
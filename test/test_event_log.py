@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# Check that an Aggregator reading an event log produces the same counts,
+# regardless of how the log is split into files and reads, and whether the
+# Aggregator is sharded
+
+import os, random
+import yaml
+
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from privcount.counter import counter_modulus
+from privcount.data_collector import Aggregator
+from privcount.benchmark import synthetic_mixed_events, synthetic_client_circuit_events, wait_for_stop
+
+# The path to the counters file, based on the location of privcount/test
+PRIVCOUNT_DIRECTORY = os.environ.get('PRIVCOUNT_DIRECTORY', os.getcwd())
+TEST_DIRECTORY = os.path.join(PRIVCOUNT_DIRECTORY, 'test')
+COUNTERS_FILENAME = os.path.join(TEST_DIRECTORY, "counters.bins.yaml")
+
+with open(COUNTERS_FILENAME, 'r') as fin:
+    counters = yaml.safe_load(fin)['counters']
+
+rng = random.Random(22)
+events = (synthetic_mixed_events(rng, 3000) +
+          synthetic_client_circuit_events(rng, 1000))
+# event logs are mostly in time order
+events.sort(key=lambda event: float(event[Aggregator.EVENT_TIME_INDEX[event[0]] + 1]))
+lines = [' '.join(event) for event in events]
+
+def get_counts(event_log_path, shard_count=1):
+    '''
+    Read the events in event_log_path using an Aggregator with shard_count
+    shards, and return the number of rotations, the number of invalid
+    events, and the final counts
+    '''
+    # no share keepers and no noise, so the counts are deterministic
+    aggregator = Aggregator(counters, None, [], {'*': 0.0},
+                            counter_modulus(), {'event_log': event_log_path},
+                            100, shard_count=shard_count)
+    aggregator.noise_weight_value = 0.0
+    event_log_files = Aggregator.get_event_log_files(event_log_path)
+    for _ in aggregator.read_event_log(event_log_files):
+        pass
+    return (aggregator.num_rotations, aggregator.event_log_rejected_count,
+            wait_for_stop(aggregator))
+
+log_dir = mkdtemp()
+try:
+    # one file, read in large chunks
+    single_path = os.path.join(log_dir, 'events.txt')
+    with open(single_path, 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+    (rotations, rejected, single_counts) = get_counts(single_path)
+    assert rotations > 2
+    assert rejected == 0
+    assert single_counts['EntryClientIPCount']['bins'][0][2] > 0
+
+    # a directory of files, with control port prefixes, comments, an
+    # invalid event, and no final newline, read in small chunks
+    split_dir = os.path.join(log_dir, 'split')
+    os.mkdir(split_dir)
+    split_index = len(lines) // 3
+    with open(os.path.join(split_dir, 'events.1'), 'w') as fout:
+        fout.write('# recorded events\n')
+        fout.write('\n'.join(['650 ' + line
+                              for line in lines[:split_index]]) + '\n\n')
+    with open(os.path.join(split_dir, 'events.2'), 'w') as fout:
+        fout.write('PRIVCOUNT_CIRCUIT_ENDED 1\n')
+        fout.write('\r\n'.join(lines[split_index:]))
+    Aggregator.EVENT_LOG_READ_SIZE = 1000
+    (split_rotations, split_rejected, split_counts) = get_counts(split_dir)
+    assert split_rotations == rotations
+    assert split_rejected == 1
+    assert split_counts == single_counts
+    print "split event log: counts match"
+
+    (sharded_rotations, sharded_rejected, sharded_counts) = get_counts(
+        single_path, shard_count=2)
+    assert sharded_rotations == rotations
+    assert sharded_counts == single_counts
+    print "sharded event log: counts match"
+finally:
+    rmtree(log_dir)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# Check that the workload generator produces valid events, in time order,
+# that an Aggregator accepts
+
+import os
+import yaml
+
+from random import Random
+
+from privcount.counter import counter_modulus, BYTES_EVENT
+from privcount.data_collector import Aggregator
+from privcount.generate import WorkloadGenerator, GeneratedEventFile
+
+# The path to the counters file, based on the location of privcount/test
+PRIVCOUNT_DIRECTORY = os.environ.get('PRIVCOUNT_DIRECTORY', os.getcwd())
+TEST_DIRECTORY = os.path.join(PRIVCOUNT_DIRECTORY, 'test')
+COUNTERS_FILENAME = os.path.join(TEST_DIRECTORY, "counters.bins.yaml")
+
+with open(COUNTERS_FILENAME, 'r') as fin:
+    counters = yaml.safe_load(fin)['counters']
+
+START_TIME = 1480000000.0
+N_EVENTS = 20000
+RATE = 500.0
+# the measured event rate must be within this fraction of RATE
+RATE_TOLERANCE = 0.1
+# byte counts are heavy-tailed, so the rate of a single run varies a lot
+RATE_SEEDS = 10
+
+def generate(seed, **kwargs):
+    '''
+    Return N_EVENTS events, and the generator that generated them
+    '''
+    # short lifetimes keep the warmup short
+    generator = WorkloadGenerator(Random(seed), start_time=START_TIME,
+                                  connection_lifetime=30.0,
+                                  circuit_lifetime=10.0, **kwargs)
+    return (list(generator.generate_events(N_EVENTS)), generator)
+
+(events, generator) = generate(25, client_ips=100, rate=RATE)
+assert len(events) == N_EVENTS
+# the same seed generates the same events
+assert events == generate(25, client_ips=100, rate=RATE)[0]
+assert len(generator.used_client_ips) <= 100
+assert len(generator.event_counts) == 4
+
+aggregator = Aggregator(counters, None, [], {'*': 0.0}, counter_modulus(),
+                        None, 600)
+last_event_time = START_TIME
+for event in events:
+    assert len(event) - 1 == Aggregator.EVENT_ITEMS[event[0]]
+    event_time = float(event[Aggregator.EVENT_TIME_INDEX[event[0]] + 1])
+    assert event_time >= last_event_time
+    last_event_time = event_time
+    if event[0] == BYTES_EVENT:
+        assert int(event[5]) <= 16384
+    assert aggregator.handle_event(event)
+print "generated {} valid events at {:.1f} events per second".format(
+    len(events), len(events) / (last_event_time - START_TIME))
+
+# the event rate is the target rate, including at the start of the events
+total_duration = 0.0
+for seed in xrange(RATE_SEEDS):
+    generator = generate(seed, rate=RATE)[1]
+    assert generator.last_event_time > START_TIME
+    total_duration += generator.last_event_time - START_TIME
+event_rate = RATE_SEEDS * N_EVENTS / total_duration
+assert abs(event_rate / RATE - 1.0) < RATE_TOLERANCE
+print "generated {} runs at {:.1f} events per second, target {:.1f}".format(
+    RATE_SEEDS, event_rate, RATE)
+
+# no stream bytes events
+(events, generator) = generate(25, bytes_event_size=0)
+assert BYTES_EVENT not in generator.event_counts
+
+# the injector reads events as lines
+event_file = GeneratedEventFile(iter(events[:2]))
+assert event_file.readline() == ' '.join(events[0]) + '\n'
+assert event_file.readline() == ' '.join(events[1]) + '\n'
+assert event_file.readline() == ''
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# Check that the injector sends events in batches, in order, and stops
+# sending while the connection is paused
+
+import sys
+
+from StringIO import StringIO
+
+from twisted.internet import task
+from twisted.test.proto_helpers import StringTransport
+
+import privcount.inject
+from privcount.inject import PrivCountDataInjector
+
+# run the injector's timers using a fake clock
+clock = task.Clock()
+privcount.inject.reactor = clock
+
+N_EVENTS = 25
+BATCH_SIZE = 7
+
+class FullTransport(StringTransport):
+    '''
+    A transport that pauses its producer after every write, like a
+    connection with full buffers
+    '''
+
+    def write(self, data):
+        StringTransport.write(self, data)
+        if self.producer is not None:
+            self.producer.pauseProducing()
+
+# batches must contain at least one event
+try:
+    PrivCountDataInjector(None, False, 0.0, float(sys.maxint), batch_size=0)
+    assert False
+except AssertionError:
+    pass
+
+# each connection has a unique channel id, so we can check the order
+event_file = StringIO(''.join(
+    ['PRIVCOUNT_CONNECTION_ENDED {} 1000.0 1001.5 192.0.2.1 1\n'.format(i)
+     for i in xrange(N_EVENTS)]))
+injector = PrivCountDataInjector(None, False, 0.0, float(sys.maxint),
+                                 batch_size=BATCH_SIZE,
+                                 event_file=event_file)
+protocol = injector.buildProtocol(None)
+transport = FullTransport()
+protocol.makeConnection(transport)
+transport.clear()
+
+def get_sent_ids():
+    '''
+    Return the channel ids of the events sent so far
+    '''
+    lines = transport.value().split(protocol.delimiter)[:-1]
+    return [int(line.split()[2]) for line in lines]
+
+injector.start_injecting()
+assert transport.producer is injector
+clock.advance(0)
+assert get_sent_ids() == range(BATCH_SIZE)
+
+# nothing is sent while the transport is paused
+clock.advance(10.0)
+assert get_sent_ids() == range(BATCH_SIZE)
+
+# each time the transport's buffers are written, we send one more batch,
+# without losing or repeating any events
+sent_count = BATCH_SIZE
+while sent_count < N_EVENTS:
+    injector.resumeProducing()
+    clock.advance(0)
+    sent_count = min(sent_count + BATCH_SIZE, N_EVENTS)
+    assert get_sent_ids() == range(sent_count)
+print "sent {} events in order, in batches of {}".format(N_EVENTS,
+                                                         BATCH_SIZE)
+
+# after the last event, the injector stops injecting
+assert not injector.injecting
+assert injector.event_file is None
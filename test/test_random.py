@@ -9,8 +9,10 @@
 # MAX_DIVERGENCE from the full range or equal bin counts
 
 from random import SystemRandom
+from math import sqrt
 
-from privcount.counter import sample, sample_randint, derive_blinding_factor, counter_modulus
+import privcount.counter
+from privcount.counter import sample, sample_randint, derive_blinding_factor, counter_modulus, BufferedSampler
 
 # Allow this much divergence from the full range and equal bin counts
 MAX_DIVERGENCE = 0.02
@@ -56,6 +58,16 @@ def sample_randint_value(modulus):
     # sample_randint takes values a and b, and returns a random value in [a, b]
     return sample_randint(0, modulus - 1)
 
+# a single buffered sampler, so that values come from the same buffer
+BUFFERED_SAMPLER = BufferedSampler()
+
+def buffered_sample_value(modulus):
+    '''
+    call privcount.counter.BufferedSampler.sample with modulus
+    '''
+    # sample takes a modulus value, and returns a random value in [0, modulus)
+    return BUFFERED_SAMPLER.sample(modulus)
+
 def blinding_value(modulus):
     '''
     call privcount.util.blinding_value with modulus and POSITIVE
@@ -71,6 +83,34 @@ def blinding_value(modulus):
         value -= 1
     return value
 
+def gaussian_trial(result_count, use_numpy=True):
+    '''
+    Sample result_count values using BufferedSampler.sample_gaussian_list
+    If use_numpy is False, use the pure-python transform
+    Check that the mean, standard deviation, and the proportion of values
+    within one standard deviation are close to a standard normal distribution
+    '''
+    saved_numpy = privcount.counter.numpy
+    if not use_numpy:
+        privcount.counter.numpy = None
+    try:
+        values = BufferedSampler().sample_gaussian_list(result_count)
+    finally:
+        privcount.counter.numpy = saved_numpy
+    assert len(values) == result_count
+    mean = sum(values) / result_count
+    sd = sqrt(sum((value - mean)**2 for value in values) / result_count)
+    # about 68.27% of normally distributed values are within one sd
+    within_one_sd = sum(1 for value in values if abs(value) < 1.0)
+    print "Mean: {} (expected 0.0)".format(round(mean, 4))
+    print "SD: {} (expected 1.0)".format(round(sd, 4))
+    print "Within 1 SD: {}".format(format_difference(within_one_sd,
+                                                     int(0.6827*result_count),
+                                                     result_count))
+    assert abs(mean) < MAX_DIVERGENCE
+    assert abs(sd - 1.0) < MAX_DIVERGENCE
+    assert abs(float(within_one_sd) / result_count - 0.6827) < MAX_DIVERGENCE
+
 def range_trial(result_count, func, modulus):
     '''
     Observe the range of func(modulus) with random keys for result_count trials
@@ -185,9 +225,26 @@ print "privcount.sample:"
 run_trial(N_TRIALS, sample_value, PRIV_COUNTER_MODULUS, BIN_COUNT)
 print ""
 
+print "privcount.BufferedSampler.sample:"
+run_trial(N_TRIALS, buffered_sample_value, PRIV_COUNTER_MODULUS, BIN_COUNT)
+print ""
+
+print "privcount.BufferedSampler.sample, modulus + 1 (high rejection rate):"
+run_trial(N_TRIALS, buffered_sample_value, PRIV_COUNTER_MODULUS + 1, BIN_COUNT)
+print ""
+
 print "privcount.sample_randint:"
 run_trial(N_TRIALS, sample_randint_value, PRIV_COUNTER_MODULUS, BIN_COUNT)
 print ""
 
 print "privcount.derive_blinding_factor:"
 run_trial(N_TRIALS, blinding_value, PRIV_COUNTER_MODULUS, BIN_COUNT)
+print ""
+
+if privcount.counter.numpy is not None:
+    print "privcount.BufferedSampler.sample_gaussian_list (numpy):"
+    gaussian_trial(N_TRIALS)
+    print ""
+
+print "privcount.BufferedSampler.sample_gaussian_list (python):"
+gaussian_trial(N_TRIALS, use_numpy=False)
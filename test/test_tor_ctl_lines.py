@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# See LICENSE for licensing information
+
+# Check that TorControlClientProtocol.dataReceived() handles lines in the
+# same way as LineOnlyReceiver.dataReceived(), regardless of how the data
+# is split into reads
+
+import random
+
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.test.proto_helpers import StringTransport
+
+import privcount.protocol
+from privcount.protocol import TorControlClientProtocol
+
+# over-length lines stop the reactor and exit, so record the exit code
+# instead
+stop_reactor_codes = []
+privcount.protocol.stop_reactor = stop_reactor_codes.append
+
+class RecordingFactory(object):
+    '''
+    A tor control protocol factory that records the events it handles, and
+    fails to handle events with FAIL_ITEM as their last item
+    '''
+
+    FAIL_ITEM = 'fail'
+
+    def __init__(self):
+        self.events = []
+
+    def handle_event(self, event):
+        if event[-1] == RecordingFactory.FAIL_ITEM:
+            return False
+        self.events.append(event)
+        return True
+
+class RecordingBatchFactory(RecordingFactory):
+    '''
+    A RecordingFactory that can also handle a list of events at once
+    '''
+
+    def handle_events(self, events):
+        for event in events:
+            if not self.handle_event(event):
+                return False
+        return True
+
+class RecordingProtocol(TorControlClientProtocol):
+    '''
+    A TorControlClientProtocol that records the lines that exceed
+    MAX_LENGTH
+    '''
+
+    def __init__(self, factory):
+        TorControlClientProtocol.__init__(self, factory)
+        self.long_lines = []
+
+    def lineLengthExceeded(self, line):
+        self.long_lines.append(line)
+        return TorControlClientProtocol.lineLengthExceeded(self, line)
+
+class LineOnlyProtocol(RecordingProtocol):
+    '''
+    A RecordingProtocol that uses the LineOnlyReceiver line parser, which
+    sends every line to lineReceived()
+    '''
+
+    dataReceived = LineOnlyReceiver.dataReceived
+
+ACTIVE_EVENTS = set(['PRIVCOUNT_STREAM_ENDED', 'PRIVCOUNT_CIRCUIT_ENDED'])
+
+def receive(protocol_class, factory_class, chunks):
+    '''
+    Deliver chunks to a new protocol_class with a new factory_class, which
+    is processing ACTIVE_EVENTS. Returns the events handled by the factory,
+    the lines that exceeded MAX_LENGTH, the reactor exit codes, the data
+    sent by the protocol, and whether it is disconnecting.
+    '''
+    del stop_reactor_codes[:]
+    factory = factory_class()
+    protocol = protocol_class(factory)
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.state = 'processing'
+    protocol.active_events = ACTIVE_EVENTS
+    protocol.collection_events = ACTIVE_EVENTS
+    transport.clear()
+    for chunk in chunks:
+        protocol.dataReceived(chunk)
+    return (factory.events, protocol.long_lines, list(stop_reactor_codes),
+            transport.value(), transport.disconnecting)
+
+def split_randomly(rng, data):
+    '''
+    Split data into chunks of random sizes, including empty chunks.
+    '''
+    chunks = []
+    while len(data) > 0:
+        size = rng.choice([0, 1, 2, rng.randint(1, 50), rng.randint(1, 5000)])
+        chunks.append(data[:size])
+        data = data[size:]
+    return chunks
+
+rng = random.Random(21)
+events = []
+for i in xrange(200):
+    events.append('650 PRIVCOUNT_STREAM_ENDED {} 1 2 443'.format(i))
+    events.append('650 PRIVCOUNT_CIRCUIT_ENDED {} 3 4 '.format(i))
+# unwanted, unknown and empty events, and replies, interleaved with events
+other_lines = ['650 PRIVCOUNT_CONNECTION_ENDED 1 2 3',
+               '650 PRIVCOUNT_NOT_AN_EVENT 1',
+               '650 PRIVCOUNT_STREAM_ENDED',
+               '650 PRIVCOUNT_CIRCUIT_ENDED ',
+               '250 OK',
+               '250-version=0.2.9.10']
+lines = list(events)
+for line in other_lines:
+    lines.insert(rng.randint(0, len(lines)), line)
+MAX_LENGTH = TorControlClientProtocol.MAX_LENGTH
+scenarios = {
+    'events': lines,
+    'failing handler': (lines[:100] +
+                        ['650 PRIVCOUNT_STREAM_ENDED 1 2 ' +
+                         RecordingFactory.FAIL_ITEM] +
+                        lines[100:]),
+    'error reply': lines[:100] + ['552 Unrecognized event'] + lines[100:],
+    'long line': (lines[:100] +
+                  ['650 PRIVCOUNT_STREAM_ENDED ' + 'x' * MAX_LENGTH] +
+                  lines[100:]),
+    'long partial line': lines + ['650 PRIVCOUNT_STREAM_ENDED ' +
+                                  'x' * MAX_LENGTH],
+    }
+
+for (name, scenario_lines) in sorted(scenarios.items()):
+    data = TorControlClientProtocol.delimiter.join(scenario_lines)
+    if name != 'long partial line':
+        data += TorControlClientProtocol.delimiter
+    expected = receive(LineOnlyProtocol, RecordingFactory, [data])
+    (handled_events, long_lines, exit_codes, sent_data,
+     is_disconnecting) = expected
+    for factory_class in [RecordingFactory, RecordingBatchFactory]:
+        for _ in xrange(20):
+            chunks = split_randomly(rng, data)
+            result = receive(RecordingProtocol, factory_class, chunks)
+            assert result == receive(LineOnlyProtocol, factory_class, chunks)
+            # when a long line is split, the partial line exceeds MAX_LENGTH,
+            # and so does the buffer after each later read
+            (split_events, split_long_lines, split_exit_codes, split_sent_data,
+             split_is_disconnecting) = result
+            assert split_events == handled_events
+            assert (len(split_long_lines) > 0) == (len(long_lines) > 0)
+            assert (len(split_exit_codes) > 0) == (len(exit_codes) > 0)
+            assert split_sent_data == sent_data
+            assert split_is_disconnecting == is_disconnecting
+    # the rest of the lines are ignored after a failure
+    if name == 'events' or name == 'long partial line':
+        assert len(handled_events) == len(events)
+    else:
+        assert len(handled_events) < len(events)
+    assert is_disconnecting == (name != 'events')
+    if name.startswith('long'):
+        assert len(long_lines) == 1
+        assert exit_codes == [1]
+    else:
+        assert len(long_lines) == 0
+        assert exit_codes == []
+    if name == 'failing handler' or name == 'error reply':
+        # we tell tor to stop sending events
+        assert sent_data.endswith('QUIT' + TorControlClientProtocol.delimiter)
+    print "{}: lines are handled the same way".format(name)
@@ -2,7 +2,7 @@
 # See LICENSE for licensing information
 
 import os, json
-from privcount.traffic_model import TrafficModel
+from privcount.traffic_model import TrafficModel, StreamPacketBuffer
 
 # The path to the model file, based on the location of privcount/test
 PRIVCOUNT_DIRECTORY = os.environ.get('PRIVCOUNT_DIRECTORY', os.getcwd())
@@ -53,3 +53,146 @@ observations = [('+', 20), ('+', 10), ('+', 50), ('+', 1000)]
 print "The most likly path through the traffic model given the observations is:"
 print "->".join(tmod.run_viterbi(observations))
 print ""
+
+# sample bytes events: [bw_bytes, is_outbound, ts]
+# the stream starts at 1000.0, there is a large event, an empty event, and a
+# second empty event that only updates the time of the next packet
+byte_events = [[3000, 1, 1000.5], [1, 0, 1000.5], [0, 0, 1001.0],
+               [1500, 1, 1001.25], [200*1500, 0, 1002.0]]
+delays = tmod._get_inter_packet_delays(1000.0, byte_events)
+print "The packet delays for the sample bytes events are:"
+print delays
+print ""
+expected_delays = ([('+', 500000), ('+', 0), ('-', 0), ('+', 250000),
+                    ('-', 750000)] +
+                   [('-', 0)]*(TrafficModel.MAX_EVENT_PACKET_COUNT - 1))
+assert delays == expected_delays
+
+# the packed buffer gives the same delays as the list of events
+packet_buffer = StreamPacketBuffer()
+for (bw_bytes, is_outbound, ts) in byte_events:
+    packet_buffer.add_bytes_event(bw_bytes, is_outbound, ts)
+assert packet_buffer.packet_count == len(expected_delays)
+assert packet_buffer.get_packet_delays(1000.0) == expected_delays
+# without a stream start time, the first packet has no delay
+assert packet_buffer.get_packet_delays(None) == [('+', 0)] + expected_delays[1:]
+
+# after clearing, the delay is from the last event
+packet_buffer.clear_packets()
+assert packet_buffer.packet_count == 0
+assert packet_buffer.get_packet_delays(1000.0) == []
+packet_buffer.add_bytes_event(10, 1, 1003.0)
+assert packet_buffer.get_packet_delays(1000.0) == [('+', 1000000)]
+
+# decoding streams in viterbi threads gives the same counts as decoding them
+# in the event handler, including streams that overflow the queue
+import random
+from privcount.counter import counter_modulus
+from privcount.data_collector import Aggregator
+from privcount.benchmark import wait_for_deferred, wait_for_stop, WAIT_ITERATE_SECONDS
+from twisted.internet import reactor
+
+rng = random.Random(19)
+events = []
+for strmid in xrange(1, 21):
+    ts = 1000.0
+    for i in xrange(rng.randint(1, 50)):
+        ts += rng.expovariate(10.0)
+        events.append(['PRIVCOUNT_STREAM_BYTES_TRANSFERRED', '1', '1',
+                       str(strmid), '1' if i == 0 else str(rng.randint(0, 1)),
+                       str(rng.choice([498, 1500, 4000])), str(ts)])
+    events.append(['PRIVCOUNT_STREAM_ENDED', '1', '1', str(strmid), '443',
+                   '5000', '300', '1000.0', str(ts), 'example.com',
+                   '192.0.2.1'])
+
+# the context items that contain exact or near-exact counts of events,
+# circuits, or streams
+COUNT_KEYS = set(['event_state', 'pending_streams', 'pending_streams_max',
+                  'read_bytes'])
+COUNT_KEY_SUFFIXES = ('_count', '_counts', '_bins')
+# the configured number of viterbi threads is not a count of events
+CONFIG_KEYS = set(['thread_count'])
+
+def check_no_counts(context):
+    '''
+    Check that context, and the dictionaries it contains, do not have any
+    count items
+    '''
+    for (key, value) in context.iteritems():
+        assert key not in COUNT_KEYS
+        assert key in CONFIG_KEYS or not key.endswith(COUNT_KEY_SUFFIXES)
+        if isinstance(value, dict):
+            check_no_counts(value)
+        if key.endswith('_fractions'):
+            for (_, _, fraction) in value:
+                assert 0.0 <= fraction <= 1.0
+
+def get_traffic_model_counts(viterbi_threads, stream_packet_limit=None):
+    # no share keepers and no noise, so the counts are deterministic
+    aggregator = Aggregator(tmod.get_bins_init_config(), model, [],
+                            {'*': 0.0}, counter_modulus(), None, 600,
+                            stream_packet_limit=stream_packet_limit,
+                            viterbi_threads=viterbi_threads,
+                            viterbi_queue_limit=5)
+    for event in events:
+        assert aggregator.handle_event(event)
+    aggregator.noise_weight_value = 0.0
+    viterbi_context = aggregator.get_viterbi_context(exact_counts=True)
+    counts = wait_for_stop(aggregator)
+    # every stream has been decoded
+    context = aggregator.get_context(exact_counts=True)
+    assert context['viterbi_times']['stream_count'] == 20
+    stream_stats = context['event_stats']['PRIVCOUNT_STREAM_ENDED']
+    assert stream_stats['received_count'] == 20
+    assert stream_stats['handled_count'] == 20
+    assert stream_stats['latency_mean'] > 0.0
+    assert sum(count for (_, _, count) in stream_stats['latency_bins']) > 0
+    # exact counts are not in the context by default
+    context = aggregator.get_context()
+    check_no_counts(context)
+    stream_stats = context['event_stats']['PRIVCOUNT_STREAM_ENDED']
+    assert stream_stats['latency_mean'] > 0.0
+    assert abs(sum(fraction for (_, _, fraction)
+                   in stream_stats['latency_fractions']) - 1.0) < 1e-9
+    return (counts, viterbi_context)
+
+(counts, viterbi_context) = get_traffic_model_counts(0)
+assert viterbi_context['submitted_streams'] == 0
+(threaded_counts, viterbi_context) = get_traffic_model_counts(2)
+assert viterbi_context['submitted_streams'] > 0
+assert threaded_counts == counts
+print "Decoding streams in viterbi threads gives the same counts"
+
+# when the counts are not valid, the viterbi pool discards its queued streams
+# rather than blocking stop()
+aggregator = Aggregator(tmod.get_bins_init_config(), model, [],
+                        {'*': 0.0}, counter_modulus(), None, 600,
+                        viterbi_threads=2, viterbi_queue_limit=5)
+for event in events:
+    assert aggregator.handle_event(event)
+assert wait_for_deferred(aggregator.stop(counts_are_valid=False)) is None
+wait_for_deferred(aggregator._drain_viterbi_pool())
+assert aggregator.viterbi_pending == 0
+while aggregator.viterbi_pool is not None:
+    reactor.iterate(WAIT_ITERATE_SECONDS)
+print "Stopping with invalid counts discards the viterbi queue"
+
+def get_count(counts, label):
+    return counts[label]['bins'][0][2]
+
+# streams over the packet limit are decoded in parts, but each stream still
+# has one starting transition, and a transition between each packet
+(limited_counts, viterbi_context) = get_traffic_model_counts(
+    0, stream_packet_limit=10)
+packet_count = get_count(limited_counts, 'ExitStreamTrafficModelEmissionCount')
+assert packet_count == get_count(counts, 'ExitStreamTrafficModelEmissionCount')
+start_count = sum(get_count(limited_counts, label)
+                  for label in limited_counts
+                  if label.startswith('ExitStreamTrafficModelTransitionCount_START_'))
+assert start_count == 20
+assert (get_count(limited_counts, 'ExitStreamTrafficModelTransitionCount') ==
+        packet_count - 20)
+(threaded_limited_counts, viterbi_context) = get_traffic_model_counts(
+    2, stream_packet_limit=10)
+assert threaded_limited_counts == limited_counts
+print "Decoding streams in parts gives consistent counts"